@@ -1,3 +1,4 @@
 from setuptools import setup
 
-setup(name='smali', version='0.1', packages=['smali', 'smali.objects'])
+setup(name='smali', version='0.1', packages=['smali', 'smali.objects'],
+      extras_require={'vector': ['numpy']})
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# This file is part of the Smali Emulator.
+#
+# This file may be licensed under the terms of of the
+# GNU General Public License Version 3 (the ``GPL'').
+#
+# Software distributed under the License is distributed
+# on an ``AS IS'' basis, WITHOUT WARRANTY OF ANY KIND, either
+# express or implied. See the GPL for the specific language
+# governing rights and limitations.
+#
+# You should have received a copy of the GPL along with this
+# program. If not, go to http://www.gnu.org/licenses/gpl.html
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""
+On-disk cache of parsed classes.
+
+Reading, parsing and decoding a smali file is done once: the resulting
+JavaClassParser, with its class name, fields and methods and the decoded
+instructions, label and catch tables of every method, is pickled into the
+cache directory under the hash of the file content. Loading the same content
+again unpickles this image. The forms built when the methods run (closures,
+compiled functions) are not cached, see DecodedMethod.__getstate__.
+
+Images are pickles: the cache directory must only be writable by the users
+trusted to run code.
+"""
+import hashlib
+import io
+import os
+import pickle
+import tempfile
+
+import smali.javaclass
+import smali.opcodes
+import smali.source
+
+# bumped whenever the image of a class changes, old images are then ignored
+FORMAT = 4
+
+
+def dispatch_table():
+    """DispatchTable of the shared opcode handlers."""
+    return smali.opcodes.DispatchTable([
+        smali.opcodes.shared(name) for name in dir(smali.opcodes) if name.startswith('op_')
+    ])
+
+
+_dispatch = None  # DispatchTable of parse_class, built on first use in each process
+
+
+def parse_class(filename, content):
+    """Parse the class of a file from its content and decode all its
+    methods, returning the JavaClassParser image."""
+    global _dispatch
+    if _dispatch is None:
+        _dispatch = dispatch_table()
+    # the lines of get_source_from_file
+    lines = io.TextIOWrapper(io.BytesIO(content), encoding='utf-8').readlines()
+    parsed_class = smali.javaclass.JavaClassParser(
+        filename, source=smali.source.Source(lines=lines))
+    parsed_class.class_name, parsed_class.fields  # parsed on first use
+    for method in parsed_class.methods:
+        method.decode(_dispatch)
+    return parsed_class
+
+
+class ClassCache(object):
+    """Directory of the images of the classes, by content hash."""
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, content):
+        digest = hashlib.sha256(b'smali-class-image-%d\0' % FORMAT)
+        digest.update(content)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def load(self, filename):
+        """Return the JavaClassParser of a file, from its image if the file
+        content was cached, else parsing the file and caching it."""
+        with open(filename, 'rb') as fd:
+            content = fd.read()
+        parsed_class = self.lookup(content)
+        if parsed_class is None:
+            parsed_class = self.parse(filename, content)
+            self.store(content, parsed_class)
+        parsed_class.filepath = filename
+        return parsed_class
+
+    def lookup(self, content):
+        """The cached image of a file content, None if there is none."""
+        return self.read(self.path(self.key(content)))
+
+    def store(self, content, parsed_class):
+        """Cache the image of a file content."""
+        self.write(self.path(self.key(content)), parsed_class)
+
+    @staticmethod
+    def read(path):
+        """Unpickle an image, None if it is missing or can not be read."""
+        try:
+            with open(path, 'rb') as fd:
+                return pickle.load(fd)
+        except Exception:  # missing, truncated or from another version of the code
+            return None
+
+    def write(self, path, parsed_class):
+        """Pickle an image, through a temporary file so that concurrent
+        loaders never read a partial one."""
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                pickle.dump(parsed_class, output, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    @staticmethod
+    def parse(filename, content):
+        """Parse a class and decode all its methods."""
+        return parse_class(filename, content)
+
+    def warm(self, root):
+        """Cache the .smali files found under a directory, return their
+        number."""
+        import smali.classloader  # imports this module
+        count = 0
+        for filename in smali.classloader.smali_files(root):
+            self.load(filename)
+            count += 1
+        return count
@@ -1,26 +1,204 @@
+import concurrent.futures
+import io
+import os
+
+import smali.cache
 import smali.javaclass
+import smali.parser
 
 from smali.objects import (
+    Object,
     String,
     StringBuilder,
     Integer,
 )
 
 class ClassLoader(object):
-    """Load a class and keep the class name in a dictionary."""
+    """Load a class and keep the class name in a dictionary.
+
+    The `backend` keyword is the default execution backend of the emulators
+    created with this class loader (see smali.emulator.BACKENDS). With the
+    `cache` keyword, a smali.cache.ClassCache or its directory, the classes
+    are loaded from their cached image while their file is unchanged.
+
+    With the `root` keyword, a directory such as the output of apktool, the
+    smali files under it are indexed by class and a class is only loaded
+    when the emulated code first uses it, see `index` and `find_class`.
+    `load_classes` loads many classes at once, on several processes."""
     def __init__(self, *args, **kwargs):
         self.loaded_classes = kwargs.get('loaded_classes') or {}
+        self.backend = kwargs.get('backend')
+        cache = kwargs.get('cache')
+        if cache is not None and not isinstance(cache, smali.cache.ClassCache):
+            cache = smali.cache.ClassCache(cache)
+        self.cache = cache
+        self.class_paths = {}  # class descriptor -> smali file, see index
+        self.initialized = set()  # descriptors of the classes <clinit> ran for
+        self.generation = 0  # changes of loaded_classes, see smali.opcodes.CallSite
+        self.dependents = {}  # descriptor -> linked classes extending or implementing it
         self.load_std_lib_classes()
+        if kwargs.get('root') is not None:
+            self.index(kwargs['root'])
 
     def load_std_lib_classes(self):
         self.loaded_classes.update({
+            Object.name(): Object,
             String.name(): String,
             StringBuilder.name(): StringBuilder,
             Integer.name(): Integer,
         })
+        self.generation += 1
 
     def load_class(self, filename):
-        new_class = smali.javaclass.MetaJavaClass(filename)
+        parsed_class = self.cache.load(filename) if self.cache is not None else None
+        return self.define_class(filename, parsed_class)
+
+    def define_class(self, filename, parsed_class=None):
+        """Add the class of a file, given its JavaClassParser if parsed."""
+        new_class = smali.javaclass.MetaJavaClass(filename, parsed_class)
         new_class.classloader = self
         self.loaded_classes[new_class.__name__] = new_class
-        return new_class
\ No newline at end of file
+        self.generation += 1
+        self.unlink(new_class.__name__)
+        return new_class
+
+    def load_classes(self, filenames, workers=None):
+        """Load many smali files at once and return their classes.
+
+        The files are read ahead on a pool of threads, and parsed and
+        decoded by batches on a pool of `workers` processes (one per CPU by
+        default, none if `workers` is 1) which send back the images of the
+        classes, see smali.cache. Cached classes are not parsed again."""
+        filenames = list(filenames)
+        workers = workers or os.cpu_count() or 1
+        images = {}
+        batches = []  # (batch of (filename, content), its parsed classes or their future)
+        with concurrent.futures.ThreadPoolExecutor(READERS) as readers:
+            parsers = concurrent.futures.ProcessPoolExecutor(workers) if workers > 1 else None
+            parse = parsers.submit if parsers is not None else (lambda function, batch: function(batch))
+            try:
+                batch = []
+                for filename, content in zip(filenames, readers.map(read_file, filenames)):
+                    parsed_class = self.cache.lookup(content) if self.cache is not None else None
+                    if parsed_class is not None:
+                        parsed_class.filepath = filename
+                        images[filename] = parsed_class
+                        continue
+                    batch.append((filename, content))
+                    if len(batch) == BATCH:
+                        batches.append((batch, parse(parse_classes, batch)))
+                        batch = []
+                if batch:
+                    batches.append((batch, parse(parse_classes, batch)))
+                for batch, parsed_classes in batches:
+                    if parsers is not None:
+                        parsed_classes = parsed_classes.result()
+                    for (filename, content), parsed_class in zip(batch, parsed_classes):
+                        if self.cache is not None:
+                            self.cache.store(content, parsed_class)
+                        images[filename] = parsed_class
+            finally:
+                if parsers is not None:
+                    parsers.shutdown()
+        return [self.define_class(filename, images[filename]) for filename in filenames]
+
+    def link(self, java_class):
+        """Build the method tables of a class (see BaseClass.link) with its
+        superclass and interfaces, loading them if needed. The ones that are
+        not available, such as the Java library classes, are left out."""
+        parsed_class = java_class.parsed_class
+        names = [parsed_class.super_class] if parsed_class.super_class else []
+        names.extend(parsed_class.interfaces)
+        classes = [self.find_class(name) for name in names]
+        for name in names:
+            self.dependents.setdefault(name, set()).add(java_class)
+        superclass = classes[0] if parsed_class.super_class else None
+        interfaces = list(zip(names, classes))[1 if parsed_class.super_class else 0:]
+        java_class.link(superclass, interfaces)
+
+    def unlink(self, class_name):
+        """Drop the method tables of the classes extending or implementing a
+        class, and of their own subclasses, linked again on first use."""
+        for java_class in self.dependents.pop(class_name, ()):
+            java_class.unlink()
+            self.unlink(java_class.__name__)
+
+    def index(self, root):
+        """Map the class of each .smali file under `root` to its path,
+        reading the files up to their .class line only. Return the number
+        of classes indexed."""
+        count = 0
+        for path in smali_files(root):
+            class_name = read_class_name(path)
+            if class_name is not None:
+                self.class_paths[class_name] = path
+                count += 1
+        return count
+
+    def find_class(self, class_name):
+        """Return the loaded class of a descriptor ('Lcom/a/B;') or Java
+        name ('java.lang.String'), loading it from its indexed file on first
+        use, None if there is no such class."""
+        loaded_class = self.loaded_classes.get(class_name)
+        if loaded_class is not None:
+            return loaded_class
+        if class_name.endswith(';'):
+            loaded_class = self.loaded_classes.get(smali.parser.extract_class_name(class_name))
+            if loaded_class is not None:
+                return loaded_class
+        path = self.class_paths.get(class_name)
+        if path is None:
+            return None
+        return self.load_class(path)
+
+    def initialize(self, class_name, emulator):
+        """Run, once, the <clinit> method of a class on `emulator` so that
+        its static fields are set. Return False if there is no such class."""
+        java_class = self.find_class(class_name)
+        if java_class is None:
+            return False
+        if class_name not in self.initialized:
+            self.initialized.add(class_name)
+            try:
+                method = java_class.get_method('<clinit>()V')
+            except IndexError:
+                method = None
+            if method is not None:
+                emulator.call(method.decode(emulator.dispatch), [])
+        return True
+
+
+# threads reading the files of load_classes ahead of their parsing
+READERS = 8
+# files parsed by a worker process at a time
+BATCH = 32
+
+
+def parse_classes(batch):
+    """Images of the classes of a list of (filename, content)."""
+    return [smali.cache.parse_class(filename, content) for filename, content in batch]
+
+
+def read_file(filename):
+    with open(filename, 'rb') as smali_file:
+        return smali_file.read()
+
+
+def smali_files(root):
+    """Paths of the .smali files under a directory, in a stable order."""
+    for directory, directories, filenames in os.walk(root):
+        directories.sort()
+        for filename in sorted(filenames):
+            if filename.endswith('.smali'):
+                yield os.path.join(directory, filename)
+
+
+def read_class_name(path):
+    """Descriptor of the class declared by a smali file, None if there is
+    no .class line."""
+    with io.open(path, encoding='utf-8') as smali_file:
+        for line in smali_file:
+            line = line.strip()
+            if line.startswith('.class'):
+                return smali.parser.get_classname_from_declaration_line(line)
+    return None
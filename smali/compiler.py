@@ -0,0 +1,656 @@
+# -*- coding: utf-8 -*-
+# This file is part of the Smali Emulator.
+#
+# This file may be licensed under the terms of of the
+# GNU General Public License Version 3 (the ``GPL'').
+#
+# Software distributed under the License is distributed
+# on an ``AS IS'' basis, WITHOUT WARRANTY OF ANY KIND, either
+# express or implied. See the GPL for the specific language
+# governing rights and limitations.
+#
+# You should have received a copy of the GPL along with this
+# program. If not, go to http://www.gnu.org/licenses/gpl.html
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""
+Method level compiler.
+
+A decoded method is translated into the source of a Python function where
+the slots of the register file are local variables. The control flow is recovered at the basic
+block level: each block becomes straight-line Python code and the blocks are
+selected by a binary search on the block index, so a jump costs a few integer
+comparisons.
+
+Opcodes without a source template are executed through their threaded
+closure, after the local registers are written back to the VM, which keeps
+every opcode supported. Methods which cannot be compiled at all are run by
+the threaded backend.
+
+The same templates translate the short instruction sequences fused into
+superinstructions (see smali.superinstructions).
+
+Compiled methods count the instructions of the blocks they run and charge
+them to the statistics of the run on returns and, by batches, on loop
+back-edges, where the budget of the run is checked.
+"""
+import struct
+
+from smali.opcodes import (
+    op_AddInt,
+    op_AddInt2Addr,
+    op_AddIntLit,
+    op_Aget,
+    op_AndInt,
+    op_AndInt2Addr,
+    op_AndIntLit,
+    op_APut,
+    op_ArrayLength,
+    op_Const,
+    op_ConstString,
+    op_DivInt,
+    op_DivIntLit,
+    op_DivLong,
+    op_GoTo,
+    op_IfEq,
+    op_IfEqz,
+    op_IfGe,
+    op_IfGez,
+    op_IfGt,
+    op_IfGtz,
+    op_IfLe,
+    op_IfLez,
+    op_IfLt,
+    op_IfLtz,
+    op_IfNe,
+    op_IfNez,
+    op_IntToType,
+    op_LongToType,
+    op_Move,
+    op_MoveResult,
+    op_MulInt,
+    op_MulIntLit,
+    op_MulNum2Addr,
+    op_NegInt,
+    op_NewArray,
+    op_Nop,
+    op_OrInt,
+    op_OrInt2Addr,
+    op_OrIntLiteral,
+    op_RemInt,
+    op_RemIntLit,
+    op_RemLong2Addr,
+    op_Return,
+    op_RSubInt,
+    op_RSubIntLiteral,
+    op_ShlInt,
+    op_ShlIntLit,
+    op_ShrIntLit,
+    op_SubInt,
+    op_SubInt2Addr,
+    op_SubLong2Addr,
+    op_UshrInt,
+    op_UshrIntLit,
+    op_XorInt2Addr,
+    op_XorIntLit,
+)
+
+
+# Instructions a compiled method runs before charging them on a back-edge
+CHARGE_TICKS = 1024
+
+
+class Unsupported(Exception):
+    """Raised by a template when an instruction can not be translated."""
+    pass
+
+
+def return_value(value):
+    """Mirror of the return-* opcode conversion of the value."""
+    try:
+        return value.decode('ascii')
+    except AttributeError:
+        return value
+
+
+def rsub_literal(register_size, source, constant):
+    """Mirror of op_RSubIntLiteral.eval."""
+    result = constant - source
+    assert all(-(2 ** (register_size - 1)) <= x <= (2 ** (register_size - 1) - 1)
+               for x in (source, constant, result))
+    return result
+
+
+# Source templates, each one receives the MethodCompiler and the decoded
+# operands of the instruction and emits its Python translation.
+
+def binary(expression):
+    def template(c, vx, vy, vz):
+        c.line('{} = {}'.format(c.reg(vx), expression.format(c.reg(vy), c.reg(vz))))
+    return template
+
+
+def binary_2addr(expression):
+    def template(c, vx, vy):
+        c.line('{} = {}'.format(c.reg(vx), expression.format(c.reg(vx), c.reg(vy))))
+    return template
+
+
+def literal(expression):
+    def template(c, vx, vy, lit):
+        c.line('{} = {}'.format(c.reg(vx), expression.format(c.reg(vy), c.literal(lit))))
+    return template
+
+
+def if_compare(operator):
+    def template(c, vx, vy, target):
+        c.branch('{} {} {}'.format(c.reg(vx), operator, c.reg(vy)), target)
+    return template
+
+
+def if_zero(operator):
+    def template(c, vx, target):
+        c.branch('{} {} 0'.format(c.reg(vx), operator), target)
+    return template
+
+
+def const(c, vx, lit):
+    c.line('{} = {}'.format(c.reg(vx), c.literal(lit)))
+
+
+def const_string(c, vx, s):
+    c.line('{} = {}'.format(c.reg(vx), c.constant(s)))
+
+
+def move(c, is_from, vx, vy):
+    c.line('{} = {}'.format(c.reg(vx), c.reg(vy)))
+
+
+def move_result(c, dest):
+    c.line('{} = vm.return_v'.format(c.reg(dest)))
+
+
+def array_length(c, vx, vy):
+    c.line('{} = len({})'.format(c.reg(vx), c.reg(vy)))
+
+
+def aget(c, vx, vy, vz):
+    c.line('{} = {}[{}]'.format(c.reg(vx), c.reg(vy), c.reg(vz)))
+
+
+def aput(c, vx, vy, vz):
+    value, array, index = c.reg(vx), c.reg(vy), c.reg(vz)
+    c.line('index = int({})'.format(index))
+    c.line('if len({}) > index:'.format(array))
+    c.line('    {}[index] = {}'.format(array, value))
+    c.line('elif index == len({}):'.format(array))
+    c.line('    {}.append({})'.format(array, value))
+
+
+def xor_2addr(c, vx, vy):
+    value = c.reg(vy)
+    c.line('{} ^= int({}) if isinstance({}, int) else ord({})'.format(c.reg(vx), value, value, value))
+
+
+def xor_literal(c, vx, vy, lit):
+    value = c.reg(vy)
+    c.line('{} = (int({}) if isinstance({}, int) else ord({})) ^ {}'.format(
+        c.reg(vx), value, value, value, c.literal(lit)))
+
+
+def or_literal(c, size, vx, vy, lit):
+    value = c.reg(vy)
+    c.line('{} = (int({}) if isinstance({}, int) else ord({})) | {}'.format(
+        c.reg(vx), value, value, value, c.literal(lit)))
+
+
+def mul_2addr(c, kind, vx, vy):
+    c.line('{} = {} * {}'.format(c.reg(vx), c.reg(vx), c.reg(vy)))
+
+
+def shl_literal(c, vx, vy, lit):
+    c.line('{} = {} << {}'.format(c.reg(vx), c.reg(vy), c.literal(lit) & 0x1f))
+
+
+def shr_literal(c, vx, vy, lit):
+    c.line('{} = {} >> {}'.format(c.reg(vx), c.reg(vy), c.literal(lit) & 0x1f))
+
+
+def rsub(c, vx, vy, lit):
+    c.line('{} = {} - {}'.format(c.reg(vx), c.literal(lit), c.reg(vy)))
+
+
+def rsub_lit(c, size, vx, vy, lit):
+    c.line('{} = rsub_literal({}, {}, {})'.format(c.reg(vx), int(size), c.reg(vy), c.literal(lit)))
+
+
+def new_array(c, vx, vy, klass):
+    c.line('{} = [""] * {}'.format(c.reg(vx), c.reg(vy)))
+
+
+INT_CONVERSIONS = {
+    'long': '{} & 0xFFFFFFFFFFFFFFFF',
+    'int': '{} & 0xFFFFFFFF',
+    'char': 'chr({} & 0xFFFF)',
+    'byte': "pack('>i', {})[-1]",
+}
+
+
+def int_to_type(c, ctype, vx, vy):
+    if ctype not in INT_CONVERSIONS:
+        raise Unsupported(ctype)
+    c.line('{} = {}'.format(c.reg(vx), INT_CONVERSIONS[ctype].format(c.reg(vy))))
+
+
+def return_(c, ctype, vx):
+    if (ctype is None and vx is None) or ctype == '-void':
+        c.ret('None')
+    elif ctype in ('-wide', '-object') or (ctype is None and vx is not None):
+        c.ret('return_value({})'.format(c.reg(vx)))
+    else:
+        raise Unsupported(ctype)
+
+
+def negate(c, vx, vy):
+    c.line('{} = -{}'.format(c.reg(vx), c.reg(vy)))
+
+
+def goto(c, target):
+    c.jump(target)
+
+
+def nop(c, *args):
+    c.line('pass')
+
+
+TEMPLATES = {
+    op_Const: const,
+    op_ConstString: const_string,
+    op_Move: move,
+    op_MoveResult: move_result,
+    op_IfLe: if_compare('<='),
+    op_IfGe: if_compare('>='),
+    op_IfGt: if_compare('>'),
+    op_IfLt: if_compare('<'),
+    op_IfEq: if_compare('=='),
+    op_IfNe: if_compare('!='),
+    op_IfLez: if_zero('<='),
+    op_IfGez: if_zero('>='),
+    op_IfGtz: if_zero('>'),
+    op_IfLtz: if_zero('<'),
+    op_IfEqz: if_zero('=='),
+    op_IfNez: if_zero('!='),
+    op_ArrayLength: array_length,
+    op_Aget: aget,
+    op_APut: aput,
+    op_AddIntLit: literal('{} + {}'),
+    op_MulIntLit: literal('{} * {}'),
+    op_DivIntLit: literal('{} // {}'),
+    op_RemIntLit: literal('int({}) % {}'),
+    op_AndIntLit: literal('int({}) & {}'),
+    op_XorIntLit: xor_literal,
+    op_OrIntLiteral: or_literal,
+    op_ShlIntLit: shl_literal,
+    op_ShrIntLit: shr_literal,
+    op_UshrIntLit: shr_literal,
+    op_RSubInt: rsub,
+    op_RSubIntLiteral: rsub_lit,
+    op_AddInt: binary('{} + {}'),
+    op_SubInt: binary('{} - {}'),
+    op_MulInt: binary('{} * {}'),
+    op_DivInt: binary('{} // {}'),
+    op_DivLong: binary('{} // {}'),
+    op_RemInt: binary('{} % {}'),
+    op_AndInt: binary('{} & {}'),
+    op_OrInt: binary('{} | {}'),
+    op_ShlInt: binary('({} << ({} & 0x1f)) & 0xffffffff'),
+    op_UshrInt: binary('{} >> ({} & 0x1f)'),
+    op_AddInt2Addr: binary_2addr('{1} + {0}'),
+    op_SubInt2Addr: binary_2addr('{0} - {1}'),
+    op_OrInt2Addr: binary_2addr('{1} | {0}'),
+    op_SubLong2Addr: binary_2addr('{0} - {1}'),
+    op_RemLong2Addr: binary_2addr('{0} % {1}'),
+    op_AndInt2Addr: binary_2addr('int({1}) & int({0})'),
+    op_MulNum2Addr: mul_2addr,
+    op_XorInt2Addr: xor_2addr,
+    op_NegInt: negate,
+    op_IntToType: int_to_type,
+    op_LongToType: int_to_type,
+    op_NewArray: new_array,
+    op_GoTo: goto,
+    op_Return: return_,
+    op_Nop: nop,
+}
+
+
+class MethodCompiler(object):
+    """Translate a DecodedMethod to the source of a Python function."""
+    INDENT = '    '
+
+    def __init__(self, code):
+        self.code = code
+        self.registers = {}  # register slot -> local variable name
+        self.constants = []  # values referenced from the generated source
+        self.block = None    # lines of the block being emitted
+        self.terminated = False  # the current block ended with a jump
+        self.exit = None         # how the current block ends, see `loop`
+        self.index = None        # index of the instruction being emitted
+        self.pc_is_set = False   # vm.pc may point inside a catch range
+        self.catch_ranges = code.catch_blocks
+        self.operations = {}  # index -> closure of the instructions run as is
+
+    # -- helpers used by the templates
+
+    def reg(self, slot):
+        if slot not in self.registers:
+            if not isinstance(slot, int):
+                raise Unsupported(slot)
+            self.registers[slot] = 'r{}'.format(slot)
+        return self.registers[slot]
+
+    def literal(self, value):
+        if not isinstance(value, int):
+            raise Unsupported(value)
+        return value
+
+    def constant(self, value):
+        self.constants.append(value)
+        return 'constants[{}]'.format(len(self.constants) - 1)
+
+    def line(self, statement):
+        self.block.append(statement)
+
+    def branch(self, condition, target):
+        target = self.target(target)
+        self.line('if {}:'.format(condition))
+        self.back_edge(target, '    ')
+        self.line('    pc = {}'.format(target))
+        self.line('    continue')
+        self.exit = ('branch', target, len(self.block) - 1)
+
+    def jump(self, target):
+        target = self.target(target)
+        self.back_edge(target)
+        self.line('pc = {}'.format(target))
+        self.line('continue')
+        self.terminated = True
+        self.exit = ('jump', target)
+
+    def ret(self, expression):
+        self.line('vm.return_v = {}'.format(expression))
+        self.line('vm.stop = True')
+        self.spill()
+        self.line('vm.emu.charge(ticks)')
+        self.line('return')
+        self.terminated = True
+
+    def back_edge(self, target, indent=''):
+        """Charge the instructions run so far if `target` closes a loop."""
+        if target <= self.index:
+            self.line(indent + 'if ticks >= {}:'.format(CHARGE_TICKS))
+            self.line(indent + '    ticks = vm.emu.charge(ticks)')
+
+    def target(self, target):
+        if not isinstance(target, int):
+            raise Unsupported(target)
+        return target
+
+    def spill(self):
+        """Placeholder replaced by the write back of the local registers."""
+        self.line('#spill')
+
+    def reload(self):
+        """Placeholder replaced by the read of the local registers."""
+        self.line('#reload')
+
+    # -- translation
+
+    def leaders(self):
+        """Instruction indexes starting a basic block."""
+        instructions = self.code.instructions
+        leaders = {0}
+        leaders.update(self.code.labels.values())
+        leaders.update(self.catch_ranges.starts)
+        for index, instruction in enumerate(instructions):
+            if instruction.handler is None or type(instruction.handler) not in TEMPLATES:
+                leaders.add(index + 1)
+            elif instruction.handler.label_operands or isinstance(instruction.handler, op_Return):
+                leaders.add(index + 1)
+        return sorted(leader for leader in leaders if leader <= len(instructions))
+
+    def in_catch_range(self, index):
+        return self.catch_ranges.covers(index)
+
+    def emit_instruction(self, index, instruction):
+        self.index = index
+        self.exit = None
+        set_pc = False
+        if self.catch_ranges:
+            # keep vm.pc accurate wherever an exception may be caught
+            in_range = self.in_catch_range(index)
+            set_pc = in_range or self.pc_is_set
+            if set_pc:
+                self.line('vm.pc = {}'.format(index + 1))
+            self.pc_is_set = in_range
+
+        template = TEMPLATES.get(type(instruction.handler))
+        if template is not None:
+            start = len(self.block)
+            try:
+                template(self, *instruction.args)
+                return
+            except Unsupported:
+                del self.block[start:]
+                self.terminated = False
+
+        self.fallback(index, set_pc)
+
+    def fallback(self, index, pc_already_set):
+        """Execute the instruction with its threaded closure. An invoke
+        starts the callee in a new frame and returns, the function being run
+        again from the next instruction once the callee returns."""
+        self.operations[index] = self.code.plain[index].compile()
+        if not pc_already_set:
+            self.line('vm.pc = {}'.format(index + 1))
+        self.spill()
+        self.line('try:')
+        self.line('    operations[{}](vm)'.format(index))
+        self.line('except Exception as e:')
+        self.line('    vm.exception(e)')
+        self.reload()
+        self.line('if vm.stop:')
+        self.line('    vm.emu.charge(ticks)')
+        self.line('    return')
+        self.line('if vm.pc != {}:'.format(index + 1))
+        self.line('    pc = vm.pc')
+        self.line('    continue')
+
+    def emit_block(self, start, end):
+        """Return the lines of the block and how it ends."""
+        self.block = []
+        self.exit = None
+        self.terminated = False
+        self.pc_is_set = bool(self.catch_ranges)
+        self.line('ticks += {}'.format(end - start))
+        instructions = self.code.instructions
+        for index in range(start, end):
+            self.emit_instruction(index, instructions[index])
+        if not self.terminated:
+            self.line('pc = {}'.format(end))
+            self.line('continue')
+        return self.block, self.exit
+
+    @staticmethod
+    def loop(header, header_exit, body, body_exit):
+        """Recover a `while` loop made of a header block ending with a
+        conditional exit and a body block jumping back to the header.
+
+        Return the lines of the loop, or None if the blocks do not have this
+        shape."""
+        leader, lines = header
+        body_leader, body_lines = body
+        if not (header_exit and header_exit[0] == 'branch'
+                and body_exit == ('jump', leader)):
+            return None
+        # the header branch leaves the loop, its fallthrough enters the body
+        lines = list(lines[:-2])
+        lines[header_exit[2]] = '    break'
+        loop = ['while True:']
+        loop.extend('    ' + line for line in lines + body_lines)
+        loop.append('continue')
+        return loop
+
+    def dispatch(self, blocks, depth):
+        """Binary search on the block index, `blocks` is a sorted list of
+        (leader, lines)."""
+        indent = self.INDENT * depth
+        if len(blocks) == 1:
+            return [indent + line for line in blocks[0][1]]
+        middle = len(blocks) // 2
+        return (
+            [indent + 'if pc < {}:'.format(blocks[middle][0])]
+            + self.dispatch(blocks[:middle], depth + 1)
+            + [indent + 'else:']
+            + self.dispatch(blocks[middle:], depth + 1)
+        )
+
+    def source(self, name):
+        leaders = self.leaders()
+        end = len(self.code.instructions)
+        blocks, exits = [], []
+        for start, stop in zip(leaders, leaders[1:] + [end]):
+            if start < end:
+                lines, exit = self.emit_block(start, stop)
+                blocks.append((start, lines))
+                exits.append(exit)
+        vector_loops = self.code.vector_loops
+        for position in range(len(blocks) - 1):
+            loop = self.loop(blocks[position], exits[position],
+                             blocks[position + 1], exits[position + 1])
+            if loop is not None:
+                vector_loop = vector_loops.get(blocks[position][0])
+                if vector_loop is not None:
+                    # run at once when it can, see smali.vectorizer
+                    loop = [
+                        '#spill',
+                        'if {}(vm):'.format(self.constant(vector_loop.run)),
+                        '    ticks += 1',  # the exit test of the header
+                        '    #reload',
+                        '    pc = vm.pc',
+                        '    continue',
+                    ] + loop
+                blocks[position] = (blocks[position][0], loop)
+        # falling from the last instruction ends the method
+        blocks.append((end, ['#spill', 'vm.emu.charge(ticks)', 'return']))
+
+        names = sorted(self.registers.items())
+        spill = ['registers[{}] = {}'.format(*name) for name in names]
+        reload = ['{1} = registers[{0}]'.format(*name) for name in names]
+
+        body = []
+        for line in self.dispatch(blocks, 3):
+            stripped = line.strip()
+            indent = line[:len(line) - len(line.lstrip())]
+            if stripped == '#spill':
+                body.extend(indent + statement for statement in spill)
+            elif stripped == '#reload':
+                body.extend(indent + statement for statement in reload)
+            else:
+                body.append(line)
+
+        indent = self.INDENT
+        lines = ['def {}(vm):'.format(name), indent + 'registers = vm.registers']
+        lines.extend(indent + statement for statement in reload)
+        lines.append(indent + 'pc = vm.pc')
+        lines.append(indent + 'ticks = 0')
+        lines.append(indent + 'while True:')
+        lines.append(indent * 2 + 'try:')
+        lines.append(indent * 3 + 'while True:')
+        lines.extend(indent + line for line in body)
+        lines.append(indent * 2 + 'except Exception as e:')
+        lines.extend(indent * 3 + statement for statement in spill)
+        lines.append(indent * 3 + 'vm.exception(e)')
+        lines.extend(indent * 3 + statement for statement in reload)
+        lines.append(indent * 3 + 'pc = vm.pc')
+        return '\n'.join(lines) + '\n'
+
+
+class SequenceCompiler(MethodCompiler):
+    """Translate a few consecutive instructions to a Python function working
+    on the register file of the vm, used for superinstructions.
+
+    vm.pc is set before each instruction, as the run loop does, so that an
+    exception is reported on the instruction raising it."""
+    def __init__(self):
+        self.constants = []
+        self.operations = {}
+        self.block = []
+        self.terminated = False
+
+    def reg(self, slot):
+        if not isinstance(slot, int):
+            raise Unsupported(slot)
+        return 'registers[{}]'.format(slot)
+
+    def branch(self, condition, target):
+        self.line('if {}:'.format(condition))
+        self.line('    vm.pc = {}'.format(self.target(target)))
+
+    def jump(self, target):
+        self.line('vm.pc = {}'.format(self.target(target)))
+
+    def ret(self, expression):
+        self.line('vm.return_v = {}'.format(expression))
+        self.line('vm.stop = True')
+
+    def source(self, name, instructions, positions):
+        """`positions` are the index of each instruction in the method."""
+        for index, (instruction, position) in enumerate(zip(instructions, positions)):
+            self.line('vm.pc = {}'.format(position + 1))
+            template = TEMPLATES.get(type(instruction.handler))
+            start = len(self.block)
+            try:
+                if template is None:
+                    raise Unsupported(instruction)
+                template(self, *instruction.args)
+            except Unsupported:
+                del self.block[start:]
+                self.operations[index] = instruction.compile()
+                self.line('operations[{}](vm)'.format(index))
+        lines = ['def {}(vm):'.format(name), self.INDENT + 'registers = vm.registers']
+        # the run loop counts the first instruction as it dispatches it
+        lines.append(self.INDENT + 'vm.emu.stats.steps += {}'.format(len(instructions) - 1))
+        lines.extend(self.INDENT + line for line in self.block)
+        return '\n'.join(lines) + '\n'
+
+
+def build(compiler, name, *args):
+    """Exec the source generated by the compiler, None if it fails."""
+    try:
+        source = compiler.source(name, *args)
+        namespace = {
+            'constants': compiler.constants,
+            'operations': compiler.operations,
+            'pack': struct.pack,
+            'return_value': return_value,
+            'rsub_literal': rsub_literal,
+        }
+        exec(compile(source, '<smali {}>'.format(name), 'exec'), namespace)
+    except (SyntaxError, RecursionError, MemoryError, ValueError):
+        return None
+    function = namespace[name]
+    function.source = source
+    return function
+
+
+def compile_method(code, name='compiled_method'):
+    """Compile a DecodedMethod to a Python function taking the vm.
+
+    Return None if the method can not be compiled."""
+    return build(MethodCompiler(code), name)
+
+
+def compile_sequence(instructions, positions, name='superinstruction'):
+    """Compile consecutive instructions, found at the indexes `positions`,
+    to a single Python function taking the vm."""
+    return build(SequenceCompiler(), name, instructions, positions)
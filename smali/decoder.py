@@ -0,0 +1,567 @@
+# -*- coding: utf-8 -*-
+# This file is part of the Smali Emulator.
+#
+# This file may be licensed under the terms of of the
+# GNU General Public License Version 3 (the ``GPL'').
+#
+# Software distributed under the License is distributed
+# on an ``AS IS'' basis, WITHOUT WARRANTY OF ANY KIND, either
+# express or implied. See the GPL for the specific language
+# governing rights and limitations.
+#
+# You should have received a copy of the GPL along with this
+# program. If not, go to http://www.gnu.org/licenses/gpl.html
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""
+Decode stage of the emulator.
+
+A method source is turned once into a compact list of `Instruction` objects,
+one per executable line, holding the resolved opcode handler and its ready to
+use operands, so that the run loop does not have to strip, match and split
+the text lines on every step nor step over directives, labels and comments.
+Jump labels and try/catch ranges are mapped to indexes in this list, and the
+source line of each instruction is kept aside for error reports and traces.
+Register operands are resolved to the slots of the method register file, see
+`RegisterLayout`, and the literals, strings, data blocks and try/catch blocks
+are parsed into the `ConstantPool` of the method.
+"""
+from __future__ import print_function
+
+import bisect
+import re
+
+import smali.compiler
+import smali.objects
+import smali.superinstructions
+import smali.vectorizer
+from smali.opcodes import CallSite, OpCode, op_Invoke
+from smali.preprocessors import (
+    ArrayDataPreprocessor,
+    PackedSwitchPreprocessor,
+    TryCatchPreprocessor,
+)
+
+# directives opening a block of lines which are neither labels nor
+# instructions, and the line closing each of them
+DATA_BLOCKS = {
+    '.packed-switch': '.end packed-switch',
+    '.sparse-switch': '.end sparse-switch',
+    '.array-data': '.end array-data',
+    '.annotation': '.end annotation',
+}
+
+# Python exceptions raised by the opcodes where Java raises the exception a
+# catch block names. Throwable, Exception, RuntimeException and .catchall
+# (None) catch any error, the other types nothing the emulator raises.
+JAVA_EXCEPTIONS = {
+    None: (Exception,),
+    'Ljava/lang/Throwable;': (Exception,),
+    'Ljava/lang/Exception;': (Exception,),
+    'Ljava/lang/RuntimeException;': (Exception,),
+    'Ljava/lang/ArithmeticException;': (ArithmeticError,),
+    'Ljava/lang/ArrayIndexOutOfBoundsException;': (IndexError,),
+    'Ljava/lang/IndexOutOfBoundsException;': (IndexError,),
+    'Ljava/lang/StringIndexOutOfBoundsException;': (IndexError,),
+    'Ljava/lang/NullPointerException;': (AttributeError, TypeError),
+    'Ljava/lang/NumberFormatException;': (ValueError,),
+}
+
+REGISTER = re.compile(r'^([vp])(\d+)$')
+FRAME_DIRECTIVE = re.compile(r'^\.(locals|registers)\s+(\d+)')
+
+
+class Instruction(object):
+    """A decoded executable line."""
+    __slots__ = ('handler', 'args', 'text')
+
+    def __init__(self, handler, args, text):
+        self.handler = handler  # opcode handler instance
+        self.args = args        # operands given to the handler `eval`
+        self.text = text        # original source line
+
+    def execute(self, vm):
+        try:
+            self.handler.eval(vm, *self.args)
+        except Exception as e:
+            vm.exception(e)
+
+    def compile(self):
+        """Closure executing this instruction (threaded backend)."""
+        return self.handler.compile(*self.args)
+
+    def __repr__(self):
+        return 'Instruction({!r})'.format(self.text)
+
+
+class InvalidInstruction(Instruction):
+    """A line whose operands can not be decoded, raising the decoding error
+    once executed as the handler would have."""
+    def __init__(self, text, error):
+        Instruction.__init__(self, None, (), text)
+        self.error = error
+
+    def execute(self, vm):
+        vm.exception(self.error)
+
+    def compile(self):
+        error = self.error
+
+        def invalid(vm):
+            raise error
+        return invalid
+
+
+class UnsupportedInstruction(Instruction):
+    """A line no handler is able to parse, only fatal once executed."""
+    def __init__(self, text):
+        Instruction.__init__(self, None, (), text)
+
+    def execute(self, vm):
+        vm.fatal("Unsupported opcode.")
+
+    def compile(self):
+        return self.execute
+
+
+class CallInstruction(Instruction):
+    """An invoke run by the frame loop of the emulator, starting the method
+    in a new frame instead of a nested run (see Emulator.enter)."""
+    __slots__ = ()
+
+    def execute(self, vm):
+        try:
+            self.handler.enter(vm, *self.args)
+        except Exception as e:
+            vm.exception(e)
+
+    def compile(self):
+        enter, args = self.handler.enter, self.args
+
+        def call(vm):
+            enter(vm, *args)
+        return call
+
+
+def with_calls(instructions):
+    """Return a copy of the instructions where the invokes are
+    CallInstructions."""
+    return [
+        CallInstruction(instruction.handler, instruction.args, instruction.text)
+        if type(instruction) is Instruction and isinstance(instruction.handler, op_Invoke)
+        else instruction
+        for instruction in instructions
+    ]
+
+
+class DecodedMethod(object):
+    """Decoded form of a method source.
+
+    `instructions` holds the executable lines only, `lines` the index of the
+    source line of each of them. Labels map to the index of the instruction
+    following them, and `catch_blocks` is the HandlerTable of the try/catch
+    blocks.
+    """
+    def __init__(self, source, instructions, labels, layout, constants, name=None,
+                 lines=None):
+        self.source = source
+        self.instructions = instructions
+        self.lines = lines if lines is not None else list(range(len(instructions)))
+        self.labels = labels
+        self.layout = layout
+        self.constants = constants
+        self.catch_blocks = constants.catch_blocks
+        self.name = name
+        # execution counters and current tier of the tiered backend
+        self.invocations = 0
+        self.back_edges = 0
+        self.tier = 'interpreter'
+        self._plain = None
+        self._fused = None
+        self._interpreted = None
+        self._vector_loops = None
+        self._threaded = None
+        self._compiled = None
+
+    @property
+    def vector_loops(self):
+        """Loops run as array operations (see smali.vectorizer), by line
+        index of their header. Built on first use."""
+        if self._vector_loops is None:
+            self._vector_loops = smali.vectorizer.find_loops(self.instructions, self.labels)
+        return self._vector_loops
+
+    @property
+    def plain(self):
+        """Instructions run one by one by the frame loop of the emulator,
+        built on first use. As the ones below, invokes start a new frame
+        (see CallInstruction)."""
+        if self._plain is None:
+            self._plain = with_calls(self.instructions)
+        return self._plain
+
+    @property
+    def fused(self):
+        """Instructions with the superinstructions in place of the sequences
+        they fuse (see smali.superinstructions) and the vectorized loops in
+        place of their header, built on first use."""
+        if self._fused is None:
+            fused = smali.superinstructions.fuse(self.instructions, self.labels)
+            fused = smali.vectorizer.vectorize(fused, self.vector_loops)
+            self._fused = with_calls(fused)
+        return self._fused
+
+    @property
+    def interpreted(self):
+        """Instructions as callables evaluating their handler."""
+        if self._interpreted is None:
+            self._interpreted = [instruction.execute for instruction in self.fused]
+        return self._interpreted
+
+    @property
+    def threaded(self):
+        """Instructions compiled to closures, built on first use."""
+        if self._threaded is None:
+            self._threaded = [instruction.compile() for instruction in self.fused]
+        return self._threaded
+
+    @property
+    def compiled(self):
+        """Method compiled to a Python function (see smali.compiler), None
+        if it can not be compiled. Built on first use."""
+        if self._compiled is None:
+            self._compiled = smali.compiler.compile_method(self) or False
+        return self._compiled or None
+
+    def __getstate__(self):
+        """The decoded method only: the forms built on first use and the
+        counters of the tiered backend start afresh when it is unpickled."""
+        return {
+            'source': self.source, 'instructions': self.instructions,
+            'labels': self.labels, 'layout': self.layout,
+            'constants': self.constants, 'name': self.name, 'lines': self.lines,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def line_number(self, pc):
+        """Number, counted from 1, of the source line of the instruction run
+        last when vm.pc is `pc`."""
+        if 0 < pc <= len(self.lines):
+            return self.lines[pc - 1] + 1
+        return pc
+
+    def __len__(self):
+        return len(self.instructions)
+
+
+class ConstantPool(object):
+    """Literals, strings, data blocks and try/catch blocks of a method, parsed
+    once when it is decoded. Equal constants share the same value.
+
+    >>> pool = ConstantPool()
+    >>> pool.literal('0x10'), pool.literal('-0x1t')
+    (16, -1)
+    >>> pool.string('abc') is pool.string('abc')
+    True
+    >>> lines = [':pswitch_0', ':pswitch_1', ':pswitch_data_0',
+    ...          '.packed-switch 0x3', ':pswitch_1', ':pswitch_0', '.end packed-switch']
+    >>> pool.add_blocks(lines, collect_labels(lines))
+    >>> pool.data(':pswitch_data_0')
+    (3, (1, 0))
+    """
+    def __init__(self):
+        self.literals = {}
+        self.strings = {}
+        self.array_data = {}  # label -> array, as built by ArrayDataPreprocessor
+        self.packed_switches = {}  # label -> (first value, case instruction indexes)
+        self.catch_blocks = HandlerTable()
+
+    def literal(self, text):
+        try:
+            return self.literals[text]
+        except KeyError:
+            value = self.literals[text] = OpCode.get_int_value(text)
+            return value
+
+    def string(self, text):
+        try:
+            return self.strings[text]
+        except KeyError:
+            value = self.strings[text] = smali.objects.String(text)
+            return value
+
+    def data(self, label):
+        """Content of the data block following a label."""
+        if label in self.packed_switches:
+            return self.packed_switches[label]
+        return self.array_data[label]["elements"]
+
+    def add_blocks(self, lines, labels):
+        """Parse the data and try/catch blocks, resolving their jump labels
+        with `labels`. Catch handlers and switches with an unknown label are
+        left out."""
+        self.catch_blocks = []  # (type, start label, end label, handler label)
+        for index, line in enumerate(lines):
+            for preprocessor in (ArrayDataPreprocessor, PackedSwitchPreprocessor,
+                                 TryCatchPreprocessor):
+                if preprocessor.check(line):
+                    preprocessor.process(self, line, index, lines)
+        for name, switch in list(self.packed_switches.items()):
+            if not isinstance(switch, dict):
+                continue
+            if all(case in labels for case in switch["cases"]):
+                targets = tuple(labels[case] for case in switch["cases"])
+                self.packed_switches[name] = (switch["first_value"], targets)
+            else:  # unknown case label, the packed-switch is invalid
+                del self.packed_switches[name]
+        self.catch_blocks = HandlerTable(
+            (labels[start], labels[end], kind, labels[label])
+            for kind, start, end, label in self.catch_blocks
+            if start in labels and end in labels and label in labels
+        )
+
+    def fatal(self, message):
+        raise SyntaxError(message)
+
+
+class HandlerTable(object):
+    """Try/catch blocks of a method, as (start, end, exception type, handler
+    index) covering the instructions start to end - 1, the type being None
+    for a catch-all.
+
+    The blocks are split at their bounds into disjoint intervals, each one
+    with the handlers covering it from the innermost, so that the handler of
+    an exception is found by a binary search on the intervals.
+
+    >>> table = HandlerTable([(0, 10, None, 20),
+    ...                       (2, 4, 'Ljava/lang/ArithmeticException;', 30)])
+    >>> table.find(3, ZeroDivisionError()), table.find(3, IndexError())
+    (30, 20)
+    >>> table.find(4, ZeroDivisionError()), table.find(10, ZeroDivisionError())
+    (20, None)
+    """
+    def __init__(self, blocks=()):
+        self.blocks = tuple(blocks)
+        bounds = sorted({start for start, _, _, _ in self.blocks}
+                        | {end for _, end, _, _ in self.blocks})
+        self.starts = []    # first instruction of each interval
+        self.ends = []      # instruction following each interval
+        self.handlers = []  # (Python exception classes, handler index) of each interval
+        for start, end in zip(bounds, bounds[1:]):
+            covering = [block for block in self.blocks
+                        if block[0] <= start and end <= block[1]]
+            if not covering:
+                continue
+            # innermost first, the blocks of a same range in their order
+            covering.sort(key=lambda block: block[1] - block[0])
+            self.starts.append(start)
+            self.ends.append(end)
+            self.handlers.append(tuple(
+                (JAVA_EXCEPTIONS.get(kind, ()), target)
+                for _, _, kind, target in covering
+            ))
+
+    def covers(self, index):
+        """Whether an instruction is in a try block."""
+        position = bisect.bisect_right(self.starts, index) - 1
+        return position >= 0 and index < self.ends[position]
+
+    def find(self, index, exception):
+        """Index of the handler of `exception` raised by the instruction at
+        `index`, None if it is not caught."""
+        position = bisect.bisect_right(self.starts, index) - 1
+        if position < 0 or index >= self.ends[position]:
+            return None
+        for classes, target in self.handlers[position]:
+            if isinstance(exception, classes):
+                return target
+        return None
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __repr__(self):
+        return 'HandlerTable({!r})'.format(list(self.blocks))
+
+
+class RegisterLayout(object):
+    """Slots of the registers of a method in its register file.
+
+    As in Dalvik, vN is the slot N and pN the slot `locals` + N. Registers
+    named otherwise, as the snippets of the tests do, get the slots following
+    them and are listed in `named`.
+
+    >>> layout = RegisterLayout(['v0', 'p1', 'a', 'v1'], locals_count=3)
+    >>> sorted(layout.slots.items())
+    [('a', 5), ('p1', 4), ('v0', 0), ('v1', 1)]
+    >>> layout.size, layout.named
+    (6, ('a',))
+    """
+    def __init__(self, names, locals_count=None, ins_count=None):
+        numbers = {'v': [-1], 'p': [-1]}
+        named = []
+        for name in names:
+            match = REGISTER.match(name)
+            if match:
+                numbers[match.group(1)].append(int(match.group(2)))
+            elif name not in named:
+                named.append(name)
+        if locals_count is None:
+            locals_count = max(numbers['v']) + 1
+        if ins_count is None:
+            ins_count = max(numbers['p']) + 1
+
+        self.locals = locals_count
+        self.size = max(locals_count + ins_count, max(numbers['v']) + 1)
+        self.slots = {}
+        for name in names:
+            match = REGISTER.match(name)
+            if match:
+                number = int(match.group(2))
+                self.slots[name] = number if match.group(1) == 'v' else locals_count + number
+        self.size = max([self.size] + [slot + 1 for slot in self.slots.values()])
+        for name in named:
+            self.slots[name] = self.size
+            self.size += 1
+        self.named = tuple(named)
+
+    @classmethod
+    def from_method(cls, lines, names, ins_count=None):
+        """Layout sized from the .locals or .registers directive, if any."""
+        for line in lines:
+            match = FRAME_DIRECTIVE.match(line)
+            if match is None:
+                continue
+            count = int(match.group(2))
+            if match.group(1) == 'locals':
+                return cls(names, count, ins_count)
+            if ins_count is None:
+                ins_count = max([-1] + [int(name[1:]) for name in names
+                                        if REGISTER.match(name) and name[0] == 'p']) + 1
+            return cls(names, max(count - ins_count, 0), ins_count)
+        return cls(names, None, ins_count)
+
+
+def is_executable(line):
+    return not (line == "" or line[0] == '#' or line[0] == ':' or line[0] == '.')
+
+
+def outside_blocks(lines):
+    """Yield the (index, line) of the lines out of the data blocks.
+
+    >>> list(outside_blocks(['nop', '.array-data 1', '0x1t', '.end array-data', 'nop']))
+    [(0, 'nop'), (1, '.array-data 1'), (4, 'nop')]
+    """
+    closing = None
+    for index, line in enumerate(lines):
+        if closing is not None:
+            if line == closing:
+                closing = None
+            continue
+        yield index, line
+        if line[:1] == '.':
+            closing = DATA_BLOCKS.get(line.split(' ', 1)[0])
+
+
+def collect_labels(lines):
+    """Map every jump label to its line index.
+
+    >>> labels = collect_labels([':goto_0', 'nop', ':data', '.array-data 1', ':x', '.end array-data'])
+    >>> sorted(labels.items())
+    [(':data', 2), (':goto_0', 0)]
+    """
+    return {line: index for index, line in outside_blocks(lines) if line[:1] == ':'}
+
+
+def executable_lines(lines):
+    """Return the index of the executable lines and, for every line and the
+    end of the method, the number of executable lines before it.
+
+    >>> executable_lines(['.locals 1', ':label', 'nop', '# comment', 'return-void'])
+    ([2, 4], [0, 0, 0, 1, 1, 2])
+    """
+    positions = [index for index, line in outside_blocks(lines) if is_executable(line)]
+    offsets = []
+    for count, position in enumerate(positions):
+        offsets.extend([count] * (position + 1 - len(offsets)))
+    offsets.extend([len(positions)] * (len(lines) + 1 - len(offsets)))
+    return positions, offsets
+
+
+def register_names(handler, args):
+    """Names of the registers used by the operands of an instruction."""
+    names = [args[position] for position in handler.register_operands
+             if args[position] is not None]
+    for position in handler.register_list_operands:
+        names.extend(split_register_list(args[position]))
+    return names
+
+
+def split_register_list(operand):
+    """
+    >>> split_register_list('v0, p1')
+    ['v0', 'p1']
+    >>> split_register_list('')
+    []
+    """
+    return [name.strip() for name in operand.split(',') if name.strip()]
+
+
+def decode_operands(handler, args, labels, layout, constants):
+    """Resolve label operands to line indices, register operands to slots
+    and constants to their value in the pool."""
+    args = list(args)
+    slots = layout.slots
+    for position in handler.register_operands:
+        if args[position] is not None:
+            args[position] = slots[args[position]]
+    for position in handler.register_list_operands:
+        args[position] = tuple(slots[name] for name in split_register_list(args[position]))
+    for position in handler.label_operands:
+        args[position] = labels[args[position]]
+    for position in handler.literal_operands:
+        args[position] = constants.literal(args[position])
+    for position in handler.string_operands:
+        args[position] = constants.string(args[position])
+    for position in handler.data_operands:
+        args[position] = constants.data(args[position])
+    for position in handler.call_operands:
+        args[position] = CallSite(args[position])
+    return tuple(args)
+
+
+def decode_line(line, handler, args, labels, layout, constants):
+    if handler is None:
+        return UnsupportedInstruction(line)
+    try:
+        args = decode_operands(handler, args, labels, layout, constants)
+    except (ValueError, SyntaxError, KeyError) as e:  # invalid literal, unknown label
+        return InvalidInstruction(line, e)
+    return Instruction(handler, args, line)
+
+
+def decode(source, dispatch, name=None, ins_count=None):
+    """Decode the lines of a Source object with the given DispatchTable.
+
+    `ins_count` is the number of parameter registers of the method, guessed
+    from the pN registers used when not given."""
+    lines = source.lines = [line.strip() for line in source.lines]
+    positions, offsets = executable_lines(lines)
+    labels = {label: offsets[index] for label, index in collect_labels(lines).items()}
+    parsed = [dispatch.decode(lines[position]) for position in positions]
+
+    names = []
+    for handler, args in parsed:
+        if handler is not None:
+            names.extend(register_names(handler, args))
+    layout = RegisterLayout.from_method(lines, names, ins_count)
+    constants = ConstantPool()
+    constants.add_blocks(lines, labels)
+
+    instructions = [
+        decode_line(lines[position], handler, args, labels, layout, constants)
+        for position, (handler, args) in zip(positions, parsed)
+    ]
+    return DecodedMethod(source, instructions, labels, layout, constants, name, positions)
@@ -19,23 +19,82 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 from __future__ import print_function
 
-import re
 import sys
 import time
 import warnings
 
 import smali
+import smali.decoder
+import smali.events
 import smali.javaclass
+import smali.javamethod
+import smali.profiler
 import smali.vm
 
-from smali.opcodes import OpCode
+from smali.opcodes import DispatchTable
 from smali.source import Source, get_source_from_file
-from smali.preprocessors import (
-    PackedSwitchPreprocessor,
-    TryCatchPreprocessor,
-    ArrayDataPreprocessor,
+
+
+# Execution backends, see Emulator.run
+INTERPRETER = 'interpreter'  # executes the decoded instructions
+THREADED = 'threaded'        # executes instructions compiled to closures
+COMPILED = 'compiled'        # executes methods compiled to Python functions
+TIERED = 'tiered'            # promotes hot methods from one backend to the next
+BACKENDS = (INTERPRETER, THREADED, COMPILED, TIERED)
+
+# Tiers of the TIERED backend, with the number of invocations or loop
+# back-edges of a method after which it is promoted to the tier.
+PROMOTIONS = (
+    (THREADED, 2, 256),
+    (COMPILED, 16, 4096),
 )
 
+# Default limit of nested method calls, see Emulator.enter
+MAX_DEPTH = 8192
+
+# Steps run between two checks of the budget of a run, see Budget
+CHECK_INTERVAL = 4096
+
+
+class UnknownBackend(Exception):
+    pass
+
+
+class StackOverflow(Exception):
+    """More nested method calls than the `max_depth` of the emulator."""
+    pass
+
+
+class BudgetExceeded(Exception):
+    """The run went over its instruction count or its deadline. `stats` are
+    the statistics of the run up to that point."""
+    def __init__(self, message, stats):
+        Exception.__init__(self, message)
+        self.stats = stats
+
+
+class Budget(object):
+    """Limits of a run: at most `max_steps` instructions and `timeout`
+    seconds of wall-clock time, None for no limit."""
+    def __init__(self, max_steps=None, timeout=None):
+        self.max_steps = max_steps
+        self.timeout = timeout
+        self.deadline = None if timeout is None else time.time() + timeout
+
+    def check(self, stats):
+        """Raise BudgetExceeded if a limit is reached, else return the steps
+        count at which to check again."""
+        if self.max_steps is not None and stats.steps > self.max_steps:
+            raise BudgetExceeded(
+                "More than {} instructions executed".format(self.max_steps), stats)
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise BudgetExceeded(
+                "Deadline of {} seconds exceeded".format(self.timeout), stats)
+        checkpoint = stats.steps + CHECK_INTERVAL
+        if self.max_steps is not None:
+            checkpoint = min(checkpoint, self.max_steps)
+        return checkpoint
+
 
 class Stats(object):
     """Statistics about the running process."""
@@ -44,6 +103,9 @@ class Stats(object):
         self.preproc = 0
         self.execution = 0
         self.steps = 0
+        self.promotions = []  # (method name, tier) promoted during the run
+        # Profiler of the emulator, counting over all its runs
+        self.profiler = getattr(vm, 'profiler', None)
 
     def __repr__(self):
         return (
@@ -51,90 +113,74 @@ class Stats(object):
             "preprocessing time : {} ms\n"
             "execution time     : {} ms\n"
             "execution steps    : {}\n"
-        ).format(self.opcodes, self.preproc, self.execution, self.steps)
+            "promotions         : {}\n"
+            "{}"
+        ).format(self.opcodes, self.preproc, self.execution, self.steps,
+                 ', '.join('{} -> {}'.format(*p) for p in self.promotions),
+                 '' if self.profiler is None else repr(self.profiler) + '\n')
 
 
 class Emulator(object):
     """Global Emulator class. Represent a complete virtual machine.
 
-    Instanciate this if you want to do some work on the smali file."""
+    Instanciate this if you want to do some work on the smali file.
+
+    The `backend` keyword selects how instructions are executed, it defaults
+    to the backend of the class loader and then to TIERED, which starts
+    every method in the interpreter and promotes it along `promotions`.
+
+    Methods calling each other run in one loop managing the frames of the vm,
+    up to `max_depth` nested calls whatever the Python recursion limit.
+
+    A run may be given a Budget, the run loops then check it every
+    CHECK_INTERVAL steps and compiled methods at their loop back-edges, and
+    raise BudgetExceeded once it is spent.
+
+    Callbacks subscribed to the events of smali.events are called as the
+    methods run, see `subscribe`. With `profile=True`, the `profiler`
+    (see smali.profiler) counts the opcodes, methods and instructions run."""
     def __init__(self, class_loader=None, current=None, **kwargs):
-        # Code preprocessors.
-        self.preprocessors = [
-            TryCatchPreprocessor,
-            PackedSwitchPreprocessor,
-            ArrayDataPreprocessor
-        ]
         self.current_class = current  # current class being executed
         self.opcodes = []  # Opcodes handlers.
         for op_code_symbol in [
             entry for entry in dir(smali.opcodes) if entry.startswith('op_')
         ]:
             self.opcodes.append(getattr(smali.opcodes, op_code_symbol)())
+        self.dispatch = DispatchTable(self.opcodes)  # mnemonic -> opcode handler
 
+        self.hooks = smali.events.Hooks()  # event subscribers
+        self.profiler = None  # Profiler counting the runs, see `profile`
+        if kwargs.get('profile'):
+            self.profiler = smali.profiler.Profiler().attach(self)
         self.vm = kwargs.get('vm') or smali.vm.VM(self)           # Instance of the virtual machine.
         self.source = kwargs.get('source')               # Instance of the source file.
         self.stats = kwargs.get('stats') or Stats(self)  # Instance of the statistics object.
         self.class_loader = class_loader
+        self.backend = (
+            kwargs.get('backend') or getattr(class_loader, 'backend', None) or TIERED
+        )
+        if self.backend not in BACKENDS:
+            raise UnknownBackend("Unknown backend '{}'".format(self.backend))
+        self.promotions = kwargs.get('promotions') or PROMOTIONS
+        self.max_depth = kwargs.get('max_depth') or MAX_DEPTH
+        self.budget = None  # Budget of the current run
+        self.sampler = None  # SamplingProfiler of the runs, see smali.profiler
 
     @property
     def javaclasses(self):
         return self.class_loader.loaded_classes
 
-    def __preprocess(self):
-        """
-        Start the preprocessing phase which will save all the labels and their line index
-        for fast lookups while jumping and will pre parse all the try/catch directives.
-        """
-        next_line = None
-        self.source.lines = [line.strip() for line in self.source.lines]
-        for index, line in enumerate(self.source.lines):
-            # we're inside a block which was already processed
-            if next_line is not None and index <= next_line:
-                next_line = None if index == next_line else next_line
-                continue
-
-            # skip empty lines
-            elif line == '':
-                continue
-
-            elif line[0] == ':':  # we've found something to preprocess
-                # loop each preprocessors and search for the one responsible to parse this line
-                # TODO: refactor this block. This is a dirty way to do the branching.
-                # TODO: It should use a dictionary or  something like that.
-                for preproc in self.preprocessors:
-                    if preproc.check(line):
-                        next_line = preproc.process(self.vm, line, index, self.source.lines)
-                        break
-                else:
-                    self.vm.labels[line] = index
-
-    def __parse_line(self, line):
-        # Search for appropriate parser.
-        for parser in self.opcodes:
-            if parser.parse(line, self.vm):
-                return True
-
-        return False
-
-    @staticmethod
-    def __should_skip_line(line):
-        """
-        Helper method used to determine if a line must be skipped/ignored.
-        :param line: The line to check.
-        :return: True if the line can be ignored, otherwise False.
-        """
-        line = line.strip()
-        return line == "" or line[0] == '#' or line[0] == ':' or line[0] == '.'
-
     def fatal(self, message):
         """
         Display an error message, the current line being executed and quit.
         :param message: The error message to display.
         """
+        code = self.vm.code
+        line = code.line_number(self.vm.pc) if code else self.vm.pc
+        source = code.source if code else self.source
         print("\n-------------------------")
-        print("Fatal error on line %03d:\n" % self.vm.pc)
-        print("  %03d %s" % (self.vm.pc, self.source[self.vm.pc - 1]))
+        print("Fatal error on line %03d:\n" % line)
+        print("  %03d %s" % (line, source[line - 1]))
         print("\n%s" % message)
         sys.exit()
 
@@ -157,61 +203,321 @@ class Emulator(object):
         javaclass = smali.javaclass.JavaClassParser(filename)
         self.javaclasses[javaclass.class_name] = javaclass
 
-    def exec_method(self, class_name, method_name, args=None, trace=False):
+    def exec_method(self, class_name, method_name, args=None, trace=False,
+                    max_steps=None, timeout=None):
         """Exec the method given the method_name and a list of arguments from
-        current javaclass."""
+        current javaclass, see `run` for the budget."""
         class_name = class_name or 'empty'
         javaclass = self.javaclasses[class_name]
         javaobj = javaclass()
         # TODO: use a `class` object to get the method and execute it
         method = smali.javaclass.resolve_method(method_name, args, javaobj.methods())
-        result = self.run(method.source_code, args=args, trace=trace, vm=self.vm)
+        result = self.run(method, args=args, trace=trace, vm=self.vm,
+                          max_steps=max_steps, timeout=timeout)
         return result
 
-    def preproc_source(self, source_object=None):
-        """Preprocess labels and try/catch blocks for fast lookup."""
-        self.source = self.source or source_object
-        s = time.time() * 1000
-        self.__preprocess()
-        e = time.time() * 1000
-        self.stats.preproc = e - s
-
-    def run(self, source_object, args=None, trace=False, vm=None):
+    def decode(self, source_object, args=None):
+        """Return the decoded instruction stream of a Source or a JavaMethod.
+
+        JavaMethod objects keep their decoded form, so a method invoked many
+        times is only decoded once. The parameter registers of a Source are
+        the pN `args` it is given."""
+        if isinstance(source_object, smali.javamethod.JavaMethod):
+            return source_object.decode(self.dispatch)
+        ins_count = None
+        if args:
+            numbers = [int(name[1:]) for name in args
+                       if smali.decoder.REGISTER.match(name) and name[0] == 'p']
+            ins_count = max(numbers) + 1 if numbers else None
+        return smali.decoder.decode(source_object, self.dispatch, ins_count=ins_count)
+
+    def run(self, source_object, args=None, trace=False, vm=None,
+            max_steps=None, timeout=None):
         """Load a smali file and start emulating it.
 
-        :param source_object: A Source() instance containing the source code to run.
+        :param source_object: A Source() instance containing the source code to run, or a JavaMethod.
         :param args: A dictionary of optional initialization variables for the VM, used for arguments.
         :param trace: If true every opcode being executed will be printed.
+        :param max_steps: Maximum number of instructions to execute, None for no limit.
+        :param timeout: Maximum wall-clock time of the run in seconds, None for no limit.
         :return: The return value of the emulated method or None if no return-* opcode was executed.
+        :raise BudgetExceeded: If max_steps or timeout is reached, the vm is then ready for another run.
         """
-        OpCode.trace = trace
-        self.source = source_object
-        self.vm = smali.vm.VM(self) if not vm else vm
-        self.stats = Stats(self)
-
         args = {} if not args else eval(args) if not isinstance(args, dict) else args
-        self.vm.variables.update(args)
-        self.preproc_source(self.source)
-
-        # Loop each line and emulate.
+        self.vm = vm = smali.vm.VM(self) if not vm else vm
+        nested = vm.code is not None  # called from a running method
+        if not nested:
+            self.stats = Stats(self)
+        stats = self.stats
         s = time.time() * 1000
-        while self.vm.stop is False and self.source.has_line(self.vm.pc):
-            self.stats.steps += 1
-            line = self.source[self.vm.pc]
-            self.vm.pc += 1
+        code = self.decode(source_object, args)
+        stats.preproc += time.time() * 1000 - s
+        self.source = code.source
+
+        budget = self.budget
+        if max_steps is not None or timeout is not None:
+            self.budget = Budget(max_steps, timeout)
+        traced = trace and not self.hooks.listening(smali.events.STEP)
+        if traced:
+            self.subscribe(smali.events.STEP, smali.events.print_trace)
+        depth = len(vm.frames)
+        vm.push_frame(code)
+        try:
+            for name, value in args.items():
+                vm[name] = value
+            s = time.time() * 1000
+            try:
+                self.check_budget()
+                self.__run_frames(vm, stats)
+            finally:
+                if not nested:
+                    stats.execution = time.time() * 1000 - s
+            vm.save_named()
+        finally:
+            if traced:
+                self.unsubscribe(smali.events.STEP, smali.events.print_trace)
+            self.budget = budget
+            vm.checkpoint = stats.steps  # the budget is checked again
+            self.__unwind(vm, depth)
+            result = vm.pop_frame()
+        return result
+
+    def call(self, code, arguments):
+        """Run the DecodedMethod `code` called by the running method, its
+        parameter registers holding the `arguments` values, and return its
+        return value."""
+        vm = self.vm
+        self.__check_depth(vm)
+        depth = len(vm.frames)
+        vm.push_frame(code, arguments)
+        try:
+            self.__run_frames(vm, self.stats)
+        finally:
+            self.__unwind(vm, depth)
+            result = vm.pop_frame()
+        return result
 
-            if self.__should_skip_line(line):
+    def enter(self, code, arguments):
+        """Start the DecodedMethod `code` called by the running method in a
+        new frame, without running it: the run loop of the caller stops and
+        `__run_frames` goes on with the callee."""
+        vm = self.vm
+        self.__check_depth(vm)
+        vm.push_frame(code, arguments)
+        vm.stop = True
+
+    def subscribe(self, kind, callback):
+        """Call `callback` with an Event each time the `kind` event of
+        smali.events happens. Runs are slower while anything is subscribed."""
+        self.hooks.subscribe(kind, callback)
+
+    def unsubscribe(self, kind, callback):
+        self.hooks.unsubscribe(kind, callback)
+
+    def check_budget(self):
+        """Raise BudgetExceeded if the budget of the run is spent, else set
+        the steps count of its next check and return it. The sampler, if
+        any, takes its samples at these checks too."""
+        vm = self.vm
+        checkpoint = sys.maxsize
+        if self.budget is not None:
+            checkpoint = self.budget.check(self.stats)
+        if self.sampler is not None:
+            checkpoint = min(checkpoint, self.sampler.sample(vm, self.stats))
+        vm.checkpoint = checkpoint
+        return checkpoint
+
+    def charge(self, steps):
+        """Count `steps` instructions run by a compiled method, checking the
+        budget when they cross its checkpoint. Return 0, the count of the
+        instructions left to charge."""
+        stats = self.stats
+        stats.steps += steps
+        if stats.steps > self.vm.checkpoint:
+            self.check_budget()
+        return 0
+
+    @staticmethod
+    def __unwind(vm, depth):
+        """Drop the frames the run left over `depth` + 1 when it raised."""
+        while len(vm.frames) > depth + 1:
+            vm.pop_frame()
+
+    def __check_depth(self, vm):
+        if len(vm.frames) >= self.max_depth:
+            raise StackOverflow("More than {} nested calls".format(self.max_depth))
+
+    def __run_frames(self, vm, stats):
+        """Run the method of the current frame until it returns, along with
+        the methods it enters in new frames."""
+        hooks = self.hooks
+        depth = level = len(vm.frames)
+        entering = True
+        if hooks.active:
+            hooks.fire(smali.events.CALL, vm, vm.code, vm.pc)
+        while True:
+            self.__dispatch(vm.code, vm, stats, entering)
+            if len(vm.frames) > level:  # entered a callee
+                vm.stop = False
+                level, entering = len(vm.frames), True
+                if hooks.active:
+                    hooks.fire(smali.events.CALL, vm, vm.code, vm.pc)
                 continue
+            if hooks.active:
+                hooks.fire(smali.events.RETURN, vm, vm.code, vm.pc, value=vm.return_v)
+            if level == depth:
+                return
+            # the callee returned, resume its caller
+            vm.return_v = vm.pop_frame()
+            level, entering = len(vm.frames), False
+
+    def __dispatch(self, code, vm, stats, entering):
+        if self.hooks.active:  # one instruction at a time, without superinstructions
+            self.__run_hooked(code, vm, stats)
+        elif self.backend == TIERED:
+            self.__run_tiered(code, vm, stats, entering)
+        else:
+            self.__execute(code, vm, stats, self.backend)
+
+    def __execute(self, code, vm, stats, backend):
+        if backend == COMPILED and code.compiled is not None:
+            code.compiled(vm)
+        elif backend in (THREADED, COMPILED):
+            self.__run_threaded(code, vm, stats)
+        else:
+            self.__run_interpreter(code.fused, vm, stats)
+
+    def promote(self, code, stats):
+        """Move the method to the highest tier its counters allow."""
+        tiers = [INTERPRETER] + [tier for tier, _, _ in self.promotions]
+        for tier, invocations, back_edges in self.promotions:
+            if tiers.index(tier) <= tiers.index(code.tier):
+                continue
+            if code.invocations < invocations and code.back_edges < back_edges:
+                break
+            if tier == COMPILED and code.compiled is None:
+                break
+            code.tier = tier
+            stats.promotions.append((code.name, tier))
+
+    def __back_edge_limit(self, code):
+        """Back-edges count promoting the method out of its current tier."""
+        tiers = [INTERPRETER] + [tier for tier, _, _ in self.promotions]
+        position = tiers.index(code.tier)
+        if position == len(self.promotions):
+            return None
+        return self.promotions[position][2]
+
+    def __run_tiered(self, code, vm, stats, entering=True):
+        """Run the method in its current tier, counting the invocations and
+        loop back-edges and switching to a faster tier, even in the middle
+        of the method, once it is hot enough. `entering` is False when the
+        method resumes after a call."""
+        if entering:
+            code.invocations += 1
+            self.promote(code, stats)
+        limit = self.__back_edge_limit(code)
+        while limit is not None and code.tier != COMPILED:
+            operations = (code.threaded if code.tier == THREADED
+                          else code.interpreted)
+            if self.__run_counting(operations, code, vm, stats, limit):
+                return
+            self.promote(code, stats)
+            new_limit = self.__back_edge_limit(code)
+            if new_limit == limit:  # not promotable, e.g. failed to compile
+                break
+            limit = new_limit
+        self.__execute(code, vm, stats, code.tier)
 
-            success = self.__parse_line(line)
+    @staticmethod
+    def __run_counting(operations, code, vm, stats, limit):
+        """Loop each operation until the method returns (True) or `limit`
+        back-edges were taken (False)."""
+        end = len(operations)
+        checkpoint = vm.checkpoint
+        while vm.stop is False and 0 <= vm.pc < end:
+            if code.back_edges >= limit:
+                return False
+            stats.steps += 1
+            if stats.steps > checkpoint:
+                checkpoint = vm.emu.check_budget()
+            pc = vm.pc
+            operation = operations[pc]
+            vm.pc += 1
+
+            try:
+                operation(vm)
+            except Exception as e:
+                vm.exception(e)
+            if vm.pc <= pc:
+                code.back_edges += 1
+        return True
 
-            if not success:
-                self.fatal("Unsupported opcode.")
+    @staticmethod
+    def __run_interpreter(instructions, vm, stats):
+        """Loop each decoded instruction and emulate."""
+        end = len(instructions)
+        checkpoint = vm.checkpoint
+        while vm.stop is False and 0 <= vm.pc < end:
+            stats.steps += 1
+            if stats.steps > checkpoint:
+                checkpoint = vm.emu.check_budget()
+            instruction = instructions[vm.pc]
+            vm.pc += 1
+            instruction.execute(vm)
+
+    def __run_hooked(self, code, vm, stats):
+        """Loop each decoded instruction, firing the events subscribers
+        listen to."""
+        hooks = self.hooks
+        steps = hooks.subscribers[smali.events.STEP]
+        branches = hooks.subscribers[smali.events.BRANCH]
+        instructions = code.plain
+        end = len(instructions)
+        checkpoint = vm.checkpoint
+        while vm.stop is False and 0 <= vm.pc < end:
+            stats.steps += 1
+            if stats.steps > checkpoint:
+                checkpoint = self.check_budget()
+            pc = vm.pc
+            instruction = instructions[pc]
+            if steps:
+                hooks.fire(smali.events.STEP, vm, code, pc, instruction=instruction)
+            vm.pc += 1
+            if not branches:
+                instruction.execute(vm)
+                continue
+            raised = len(vm.exceptions)
+            instruction.execute(vm)
+            if (vm.pc != pc + 1 and vm.code is code and len(vm.exceptions) == raised
+                    and not vm.stop and is_branch(instruction)):
+                hooks.fire(smali.events.BRANCH, vm, code, pc,
+                           instruction=instruction, target=vm.pc)
 
-        e = time.time() * 1000
-        self.stats.execution = e - s
-        self.vm.clean_vm()
-        return self.vm.return_v
+    @staticmethod
+    def __run_threaded(code, vm, stats):
+        """Loop each instruction compiled to a closure and call it."""
+        operations = code.threaded
+        end = len(operations)
+        checkpoint = vm.checkpoint
+        while vm.stop is False and 0 <= vm.pc < end:
+            stats.steps += 1
+            if stats.steps > checkpoint:
+                checkpoint = vm.emu.check_budget()
+            operation = operations[vm.pc]
+            vm.pc += 1
+
+            try:
+                operation(vm)
+            except Exception as e:
+                vm.exception(e)
+
+
+def is_branch(instruction):
+    """Whether the instruction may jump elsewhere than the next one."""
+    handler = instruction.handler
+    return handler is not None and bool(
+        handler.label_operands or isinstance(handler, smali.opcodes.op_PackedSwitch))
 
 
 class FrameEmulator(Emulator):
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# This file is part of the Smali Emulator.
+#
+# This file may be licensed under the terms of of the
+# GNU General Public License Version 3 (the ``GPL'').
+#
+# Software distributed under the License is distributed
+# on an ``AS IS'' basis, WITHOUT WARRANTY OF ANY KIND, either
+# express or implied. See the GPL for the specific language
+# governing rights and limitations.
+#
+# You should have received a copy of the GPL along with this
+# program. If not, go to http://www.gnu.org/licenses/gpl.html
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""
+Instrumentation events of the emulator.
+
+Callbacks subscribed with `Emulator.subscribe` are called with an `Event`
+for every instruction about to run (STEP), method entered (CALL) or left
+(RETURN), branch taken (BRANCH) and exception raised (EXCEPTION). While
+something is subscribed the methods run one instruction at a time in a loop
+firing these events, otherwise the run loops do not check for subscribers.
+"""
+from __future__ import print_function
+
+STEP = 'step'            # an instruction is about to run
+CALL = 'call'            # a method starts running in a new frame
+RETURN = 'return'        # a method stops running, its frame is dropped next
+BRANCH = 'branch'        # a branch instruction jumped to `target`
+EXCEPTION = 'exception'  # an instruction raised, `target` is its handler
+EVENTS = (STEP, CALL, RETURN, BRANCH, EXCEPTION)
+
+
+class UnknownEvent(Exception):
+    pass
+
+
+class Event(object):
+    """What happened, in the method `code` (a DecodedMethod) running on
+    `vm`: `pc` is the index of the instruction concerned. Valid during the
+    callback only, the vm going on afterwards."""
+    __slots__ = ('kind', 'vm', 'code', 'pc', 'instruction', 'target', 'value', 'exception')
+
+    def __init__(self, kind, vm, code, pc, instruction=None, target=None,
+                 value=None, exception=None):
+        self.kind = kind
+        self.vm = vm
+        self.code = code
+        self.pc = pc
+        self.instruction = instruction  # Instruction of STEP and BRANCH events
+        self.target = target  # instruction index jumped to, None for an uncaught exception
+        self.value = value  # value returned by the method of a RETURN event
+        self.exception = exception  # exception of an EXCEPTION event
+
+    @property
+    def method(self):
+        """Name of the method, None for a source run directly."""
+        return self.code.name
+
+    @property
+    def opcode(self):
+        """Mnemonic of the instruction, None if there is none."""
+        if self.instruction is None:
+            return None
+        return self.instruction.text.split(None, 1)[0]
+
+    @property
+    def line(self):
+        """Number, counted from 1, of the source line of the instruction."""
+        if 0 <= self.pc < len(self.code.lines):
+            return self.code.lines[self.pc] + 1
+        return self.pc
+
+    def registers(self):
+        """Copy of the registers of the method, by name."""
+        vm = self.vm
+        names = {slot: name for name, slot in vm.slots.items()}
+        snapshot = {}
+        for slot, value in enumerate(vm.registers):
+            name = names.get(slot)
+            if name is None:
+                name = 'v{}'.format(slot) if slot < vm.locals else 'p{}'.format(slot - vm.locals)
+            snapshot[name] = value
+        return snapshot
+
+    def __repr__(self):
+        return 'Event({}, {}, pc={})'.format(self.kind, self.method, self.pc)
+
+
+class Hooks(object):
+    """Callbacks subscribed to each kind of event.
+
+    >>> hooks = Hooks()
+    >>> hooks.subscribe(STEP, print)
+    >>> hooks.active, hooks.listening(STEP), hooks.listening(CALL)
+    (True, True, False)
+    >>> hooks.unsubscribe(STEP, print)
+    >>> hooks.active
+    False
+    """
+    def __init__(self):
+        self.subscribers = {kind: [] for kind in EVENTS}
+        self.active = False  # anything subscribed
+
+    def subscribe(self, kind, callback):
+        if kind not in self.subscribers:
+            raise UnknownEvent("Unknown event '{}'".format(kind))
+        self.subscribers[kind].append(callback)
+        self.active = True
+
+    def unsubscribe(self, kind, callback):
+        self.subscribers[kind].remove(callback)
+        self.active = any(self.subscribers.values())
+
+    def listening(self, kind):
+        return bool(self.subscribers[kind])
+
+    def fire(self, kind, vm, code, pc, **data):
+        callbacks = self.subscribers[kind]
+        if callbacks:
+            event = Event(kind, vm, code, pc, **data)
+            for callback in list(callbacks):
+                callback(event)
+
+
+def print_trace(event):
+    """STEP callback printing each instruction with its line number, as
+    traced runs do."""
+    print("%03d %s" % (event.line, event.instruction.text))
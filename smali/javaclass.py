@@ -48,21 +48,34 @@ def set_baseclass_of_method(class_object, method_object):
     return method_object
 
 
-def attributes_and_methods(filepath):
+def attributes_and_methods(filepath, parsed_class=None):
     return {
         'name': classmethod(lambda cls: cls.parsed_class.class_name),
         'new_instance': lambda self: self,
-        'parsed_class': JavaClassParser(filepath),
-        'methods': classmethod(lambda cls: [set_baseclass_of_method(cls, method)
-                                            for method in cls.parsed_class.methods]),
+        'parsed_class': parsed_class or JavaClassParser(filepath),
+        'methods': classmethod(lambda cls: cls.parsed_class.methods),
         'fields': classmethod(lambda cls: cls.parsed_class.fields),
+        'link_class': classmethod(link_class),
     }
 
 
+def link_class(cls):
+    """Link a class with its superclass and interfaces if it was loaded by a
+    class loader, on its own otherwise."""
+    classloader = getattr(cls, 'classloader', None)
+    if classloader is not None:
+        classloader.link(cls)
+    else:
+        cls.link()
+
+
 class MetaJavaClass(type):
-    """Static information about the class (method list, field list, etc)."""
-    def __new__(metacls, filepath):
-        class_attributes = attributes_and_methods(filepath)
+    """Static information about the class (method list, field list, etc).
+
+    `parsed_class` is the JavaClassParser of the file when it is already
+    parsed, e.g. loaded from a smali.cache.ClassCache."""
+    def __new__(metacls, filepath, parsed_class=None):
+        class_attributes = attributes_and_methods(filepath, parsed_class)
         return type.__new__(
             metacls,
             class_attributes['parsed_class'].class_name or 'empty',  # java class name
@@ -70,22 +83,33 @@ class MetaJavaClass(type):
             class_attributes,                                        # class attributes
         )
 
-    def __init__(self, filepath):
-        class_attributes = attributes_and_methods(filepath)
+    def __init__(self, filepath, parsed_class=None):
+        # the attributes are set by __new__, the file is not parsed again
         super(MetaJavaClass, self).__init__(
-            class_attributes['parsed_class'].class_name or 'empty',  # java class name
-            (smali.objects.baseclass.BaseClass,),  # base classes                                # java tuple
-            class_attributes,  # class attributes
+            self.__name__,                           # java class name
+            (smali.objects.baseclass.BaseClass,),  # base classes
+            {},
         )
+        for method in self.parsed_class.methods:
+            set_baseclass_of_method(self, method)
 
 class JavaClassParser(object):
-    def __init__(self, filepath):
+    def __init__(self, filepath, source=None):
         self.filepath = filepath
-        self.source = smali.source.get_source_from_file(filepath)
+        self.source = source or smali.source.get_source_from_file(filepath)
         self.emulator = None
+        self._outline = None
         self._methods = None
         self._fields = None
         self._class_name = None
+        self._overloads = None
+
+    @property
+    def outline(self):
+        """Declarations of the class, found in one pass over the source."""
+        if self._outline is None:
+            self._outline = smali.parser.scan_class(self.source)
+        return self._outline
 
     @property
     def methods(self):
@@ -94,7 +118,7 @@ class JavaClassParser(object):
             for (
                 (qualifier, method_name, input_types, output_type),
                 source_code,
-            ) in smali.parser.extract_methods(self.source).items():
+            ) in self.outline.methods.items():
                 self._methods.append(smali.javamethod.JavaMethod(
                     self.class_name, method_name, input_types, output_type, source_code, qualifier,
                     is_private='private' in qualifier, is_static='static' in qualifier,
@@ -112,16 +136,29 @@ class JavaClassParser(object):
                     'static' in qualifier,
                     'private' in qualifier,
                 )
-                for (qualifier, name, kind) in smali.parser.extract_attribute_names(self.source)
+                for (qualifier, name, kind) in self.outline.fields
             ]
         return self._fields
 
     @property
     def class_name(self):
         if not self._class_name:
-            self._class_name = smali.parser.get_classname_from_source(self.source)
+            self._class_name = self.outline.class_name
         return self._class_name
 
+    @property
+    def super_class(self):
+        return self.outline.super_class
+
+    @property
+    def interfaces(self):
+        return self.outline.interfaces
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['emulator'] = None
+        return state
+
     def get_class(self):
         """Should return a class object."""
         raise NotImplementedError()
@@ -130,15 +167,27 @@ class JavaClassParser(object):
         """Usually call <clinit> on this class."""
         raise NotImplementedError()
 
+    @property
+    def overloads(self):
+        """Methods by name, built on first use."""
+        if self._overloads is None:
+            self._overloads = {}
+            for method in self.methods:
+                self._overloads.setdefault(method.method_name, []).append(method)
+        return self._overloads
+
     def get_method(self, method_name, argument_list):
         return resolve_method(
             method_name,
             argument_list,
-            self.methods
+            self.overloads.get(method_name, [])
         )
 
-    def invoke(self, method_name, argument_list, emulator=None, trace=None):
-        """Exec the method with given name list of arguments."""
+    def invoke(self, method_name, argument_list, emulator=None, trace=None,
+               max_steps=None, timeout=None):
+        """Exec the method with given name list of arguments, within the
+        budget of `max_steps` instructions and `timeout` seconds if given,
+        see Emulator.run."""
         method = self.get_method(method_name, argument_list)
         self.emulator = (
             smali.emulator.Emulator(current=self)
@@ -146,8 +195,10 @@ class JavaClassParser(object):
             else self.emulator
         )
         emulator = emulator or self.emulator
-        result = emulator.run(method.source_code,
+        result = emulator.run(method,
                               args=argument_list,
                               trace=trace,
-                              vm=emulator.vm)
+                              vm=emulator.vm,
+                              max_steps=max_steps,
+                              timeout=timeout)
         return result
@@ -48,6 +48,7 @@ class JavaMethod(object):
         self.qualifier = qualifier
         self.is_private = is_private
         self.is_static = is_static
+        self.decoded = None  # decoded instruction stream, see `decode`
 
     @property
     def is_static_constructor(self):
@@ -61,6 +62,28 @@ class JavaMethod(object):
     def is_static_public(self):
         return 'public' in self.qualifier and self.is_static
 
+    @property
+    def ins_count(self):
+        """Number of parameter registers, wide types take two of them."""
+        count = sum(2 if kind in ('J', 'D') else 1 for kind in self.input_types)
+        return count if self.is_static else count + 1
+
+    def decode(self, dispatch):
+        """Return the decoded form of the method, decoding it on first use."""
+        if self.decoded is None:
+            import smali.decoder  # imports smali.opcodes, which imports this module
+            self.decoded = smali.decoder.decode(
+                self.source_code, dispatch,
+                '{}->{}'.format(self.class_name, self.compact_representation()),
+                self.ins_count
+            )
+        return self.decoded
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['base_class'] = None  # set again by the class loading it
+        return state
+
     @staticmethod
     def from_source(cls, source_code):
         raise NotImplementedError()
@@ -73,7 +96,7 @@ class JavaMethod(object):
                 kwargs.update(new_args)
 
         return base_class_or_object.emulator.run(
-            self.source_code, args=new_kwargs if new_kwargs else kwargs,
+            self, args=new_kwargs if new_kwargs else kwargs,
             vm=base_class_or_object.emulator.vm
         )
 
@@ -1,10 +1,12 @@
 from .Integer import Integer
+from .object import Object
 from .string import String
 from .string_builder import StringBuilder
 
 
 __all__ = [
     'Integer',
+    'Object',
     'String',
     'StringBuilder'
 ]
\ No newline at end of file
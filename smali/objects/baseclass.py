@@ -7,6 +7,8 @@ class MethodResolutionFailure(Exception):
 
 class BaseClass(object):
     """base class for java classes"""
+    # descriptors of the interfaces implemented by a Python class
+    implements = ()
 
     def __init__(self, source=None, emulator=None):
         self.internal = source
@@ -21,13 +23,119 @@ class BaseClass(object):
         raise NotImplementedError()
 
     @classmethod
-    def get_method(cls, method_name):
+    def method_table(cls):
+        """Methods declared by the class by descriptor ('name(args)ret')."""
+        if '_method_table' not in cls.__dict__:
+            cls.link_class()
+        return cls._method_table
+
+    @classmethod
+    def overloads(cls, method_name):
+        """Methods declared by the class named `method_name`, whatever
+        their arguments."""
+        if '_method_table' not in cls.__dict__:
+            cls.link_class()
+        return cls._overloads.get(method_name, [])
+
+    @classmethod
+    def vtable(cls):
+        """(descriptor, method) of the virtual methods of the class,
+        inherited ones included, by slot."""
+        if '_method_table' not in cls.__dict__:
+            cls.link_class()
+        return cls._vtable
+
+    @classmethod
+    def vtable_slots(cls):
+        """Slot in the vtable of each virtual method descriptor."""
+        if '_method_table' not in cls.__dict__:
+            cls.link_class()
+        return cls._vtable_slots
+
+    @classmethod
+    def itable(cls):
+        """Vtable slot of each method of each interface implemented, by
+        interface descriptor then method descriptor."""
+        if '_method_table' not in cls.__dict__:
+            cls.link_class()
+        return cls._itable
+
+    @classmethod
+    def link_class(cls):
+        """Link the class under its Python base class, smali classes are
+        linked by their class loader instead (see ClassLoader.link)."""
+        base = cls.__mro__[1]
+        superclass = base if base is not BaseClass and issubclass(base, BaseClass) else None
+        cls.link(superclass, [(name, None) for name in cls.implements])
+
+    @classmethod
+    def link(cls, superclass=None, interfaces=()):
+        """Build the method tables of the class from its `methods`, the
+        vtable and itable from the ones of the superclass and of the
+        (descriptor, class or None) interfaces.
+
+        A virtual method keeps the slot of the method it overrides, so that
+        the slot of a method in a class is the one of its overrides in the
+        subclasses."""
         method_list_or_dict = cls.methods()
-        return (
-            [method for method in method_list_or_dict
-             if method.compact_representation() == method_name][0]
-             if isinstance(method_list_or_dict, list) else method_list_or_dict.get(method_name)
-        )
+        if isinstance(method_list_or_dict, list):
+            table = {}
+            for method in method_list_or_dict:
+                table.setdefault(method.compact_representation(), method)
+            virtual = [descriptor for descriptor, method in table.items()
+                       if not (method.is_static or method.is_private or descriptor.startswith('<'))]
+        else:
+            table = dict(method_list_or_dict)
+            virtual = [descriptor for descriptor in table
+                       if not (descriptor.startswith('<') or descriptor == 'new-instance')]
+        overloads = {}
+        for descriptor, method in table.items():
+            overloads.setdefault(descriptor.split('(', 1)[0], []).append(method)
+
+        vtable = list(superclass.vtable()) if superclass is not None else []
+        slots = dict(superclass.vtable_slots()) if superclass is not None else {}
+        for descriptor in virtual:
+            slot = slots.get(descriptor)
+            if slot is None:
+                slot = slots[descriptor] = len(vtable)
+                vtable.append(None)
+            vtable[slot] = (descriptor, table[descriptor])
+        itable = dict(superclass.itable()) if superclass is not None else {}
+        for name, interface in interfaces:
+            descriptors = set()
+            if interface is not None:
+                descriptors.update(descriptor for descriptor, _ in interface.vtable())
+                for inherited, methods in interface.itable().items():
+                    descriptors.update(methods)
+                    itable[inherited] = {descriptor: slots[descriptor]
+                                         for descriptor in methods if descriptor in slots}
+            itable[name] = {descriptor: slots[descriptor]
+                            for descriptor in descriptors if descriptor in slots}
+
+        cls._overloads = overloads
+        cls._vtable = vtable
+        cls._vtable_slots = slots
+        cls._itable = itable
+        cls._method_table = table  # set last, the class is linked
+
+    @classmethod
+    def unlink(cls):
+        """Drop the method tables, built again on first use."""
+        for name in ('_method_table', '_overloads', '_vtable', '_vtable_slots', '_itable'):
+            if name in cls.__dict__:
+                delattr(cls, name)
+
+    @classmethod
+    def get_method(cls, method_name):
+        """Method of a descriptor, declared by the class or inherited,
+        IndexError if there is none."""
+        try:
+            return cls.method_table()[method_name]
+        except KeyError:
+            slot = cls._vtable_slots.get(method_name)
+            if slot is None:
+                raise IndexError(method_name)
+            return cls._vtable[slot][1]
 
     @staticmethod
     def new_instance():
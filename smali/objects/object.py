@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# This file is part of the Smali Emulator.
+#
+# This file may be licensed under the terms of of the
+# GNU General Public License Version 3 (the ``GPL'').
+#
+# Software distributed under the License is distributed
+# on an ``AS IS'' basis, WITHOUT WARRANTY OF ANY KIND, either
+# express or implied. See the GPL for the specific language
+# governing rights and limitations.
+#
+# You should have received a copy of the GPL along with this
+# program. If not, go to http://www.gnu.org/licenses/gpl.html
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+from .baseclass import BaseClass
+
+
+class Object(BaseClass):
+    """Fake the java.lang.Object class, the root of the smali classes."""
+    @staticmethod
+    def name():
+        return 'java.lang.Object'
+
+    @staticmethod
+    def methods():
+        return {
+            'new-instance': Object.new_instance,
+            '<init>()V': Object.init,
+        }
+
+    @classmethod
+    def new_instance(cls):
+        return cls()
+
+    def init(self):
+        pass
@@ -20,6 +20,7 @@ from __future__ import print_function
 from __future__ import division
 
 import ast
+import operator
 import re
 import struct
 
@@ -38,32 +39,49 @@ class UnsupportedOperation(Exception):
 
 # Base class for all Dalvik opcodes ( see http://pallergabor.uw.hu/androidblog/dalvik_opcodes.html ).
 class OpCode(object):
-    trace = False
+    # Mnemonics handled by this opcode, entries ending with '*' are families
+    # matched by prefix (e.g. 'aget-*' handles 'aget-char', 'aget-byte', ...).
+    mnemonics = ()
+    # Positions of the `eval` operands resolved once when a method is decoded:
+    # jump labels are replaced by the index of the instruction they precede,
+    # literals by their value and strings by a String object, all taken from
+    # the constant pool of the method (see smali.decoder.ConstantPool). Labels
+    # of the data blocks (array-data, packed-switch) are replaced by their
+    # parsed content.
+    label_operands = ()
+    literal_operands = ()
+    string_operands = ()
+    data_operands = ()
+    # Positions of the register operands, resolved to slots of the register
+    # file, and of the register lists ('{v0, v1}') resolved to slot tuples.
+    register_operands = ()
+    register_list_operands = ()
+    # Positions of the method references ('Lcom/a/B;->f(I)I'), resolved to a
+    # CallSite of their own caching the method called.
+    call_operands = ()
 
     def __init__(self, expression):
         self.expression = re.compile(expression)
 
+    def __reduce__(self):
+        # decoded methods are pickled with the shared handlers, see `shared`
+        return (shared, (type(self).__name__,))
+
     @staticmethod
     def get_int_value(val):
+        if isinstance(val, int):  # already parsed when decoding
+            return val
         val = val.rstrip('t')  # for byte elements
         val = val.rstrip('s')  # for short elements
         val = val.rstrip('L')  # for longs
         return ast.literal_eval(val)
 
-    def parse(self, line, vm):
+    def match(self, line):
+        """Return the stripped operands of the line or None if it does not match."""
         m = self.expression.search(line)
         if m is None:
-            return False
-
-        if OpCode.trace is True:
-            print("%03d %s" % (vm.pc, line))
-
-        try:
-            self.eval(vm, *[x.strip() if x is not None else x for x in m.groups()])
-        except Exception as e:
-            vm.exception(e)
-
-        return True
+            return None
+        return tuple(x.strip() if x is not None else x for x in m.groups())
 
     @staticmethod
     def eval(vm, *args):
@@ -73,29 +91,172 @@ class OpCode(object):
         - args is the list of argument for this op code."""
         raise NotImplementedError()
 
+    def compile(self, *args):
+        """Return a closure taking the vm and executing this opcode with the
+        given decoded operands, used by the threaded backend.
+
+        Opcode classes override it with a specialized closure whenever the
+        operands allow it, the default one simply calls `eval`."""
+        evaluate = self.eval
+
+        def execute(vm):
+            evaluate(vm, *args)
+        return execute
+
+
+def shared(name):
+    """Return the shared instance of the opcode handler class `name`.
+
+    >>> shared('op_Nop') is shared('op_Nop')
+    True
+    """
+    handler = SHARED_HANDLERS.get(name)
+    if handler is None:
+        handler = SHARED_HANDLERS[name] = globals()[name]()
+    return handler
+
+
+SHARED_HANDLERS = {}  # class name -> handler instance, see `shared`
+
+
+class DispatchTable(object):
+    """Map the mnemonic of a line to its opcode handler.
+
+    The mnemonic is extracted once per line and resolved through a dict,
+    families declared with a trailing '*' are resolved by prefix the first
+    time a mnemonic is seen and memoized. Lines the selected handler does not
+    accept fall back to a linear scan over every handler.
+
+    >>> table = DispatchTable([op_Aget(), op_IfLt()])
+    >>> type(table.lookup('if-lt')).__name__
+    'op_IfLt'
+    >>> type(table.lookup('aget-char')).__name__
+    'op_Aget'
+    >>> table.lookup('if-ge') is None
+    True
+    """
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.table = {}
+        self.families = []
+        for handler in handlers:
+            for mnemonic in handler.mnemonics:
+                if mnemonic.endswith('*'):
+                    self.families.append((mnemonic[:-1], handler))
+                else:
+                    self.table.setdefault(mnemonic, handler)
+        # longest prefix first, so that 'move-result-*' would win over 'move-*'
+        self.families.sort(key=lambda family: len(family[0]), reverse=True)
+
+    def lookup(self, mnemonic):
+        """Return the handler for the given mnemonic or None."""
+        try:
+            return self.table[mnemonic]
+        except KeyError:
+            handler = None
+            for prefix, candidate in self.families:
+                if mnemonic.startswith(prefix):
+                    handler = candidate
+                    break
+            self.table[mnemonic] = handler
+            return handler
+
+    def decode(self, line):
+        """Return the handler of the line and its operands, (None, None) if
+        no handler is able to parse it."""
+        try:
+            handler = self.lookup(smali.parser.get_op_code(line))
+        except AttributeError:  # no mnemonic on this line
+            handler = None
+
+        args = handler.match(line) if handler is not None else None
+        if args is not None:
+            return handler, args
+
+        for handler in self.handlers:
+            args = handler.match(line)
+            if args is not None:
+                return handler, args
+
+        return None, None
+
+
+def compile_binary(operation, vx, vy, vz):
+    """Closure storing operation(vy, vz) into vx."""
+    def binary(vm):
+        registers = vm.registers
+        registers[vx] = operation(registers[vy], registers[vz])
+    return binary
+
+
+def compile_if(compare, vx, vy, target):
+    """Closure jumping to target if compare(vx, vy), None if the target is
+    not resolved."""
+    if not isinstance(target, int):
+        return None
+
+    def branch(vm):
+        registers = vm.registers
+        if compare(registers[vx], registers[vy]):
+            vm.pc = target
+    return branch
+
+
+def compile_ifz(compare, vx, target):
+    """Closure jumping to target if compare(vx, 0), None if the target is
+    not resolved."""
+    if not isinstance(target, int):
+        return None
+
+    def branch(vm):
+        if compare(vm.registers[vx], 0):
+            vm.pc = target
+    return branch
+
 
 class op_Const(OpCode):
     """Evaluate a constant object."""
+    mnemonics = ('const', 'const/*')
+    register_operands = (0,)
+    literal_operands = (1,)
+
     def __init__(self):
         OpCode.__init__(self, '^const(?:/\d+)? (.+),\s*(.+)')
 
     @staticmethod
     def eval(vm, vx, lit):
-        vm[vx] = OpCode.get_int_value(lit)
+        vm[vx] = lit
+
+    def compile(self, vx, lit):
+        def const(vm):
+            vm.registers[vx] = lit
+        return const
 
 
 class op_ConstString(OpCode):
     """Evaluate a constant string."""
+    mnemonics = ('const-string', 'const-string/jumbo')
+    register_operands = (0,)
+    string_operands = (1,)
+
     def __init__(self):
         OpCode.__init__(self, '^const-string(?:/jumbo)? (.+),\s*"(.*)"')
 
     @staticmethod
     def eval(vm, vx, s):
-        vm[vx] = smali.objects.String(s)
+        vm[vx] = s
+
+    def compile(self, vx, s):
+        def const_string(vm):
+            vm.registers[vx] = s
+        return const_string
 
 
 class op_Move(OpCode):
     """Evaluate a move."""
+    mnemonics = ('move', 'move-object', 'move/*', 'move-object/*')
+    register_operands = (1, 2)
+
     def __init__(self):
         OpCode.__init__(self, '^move(?:-object)?(/from\d+)? (.+),\s*(.+)')
 
@@ -103,9 +264,18 @@ class op_Move(OpCode):
     def eval(vm, is_from, vx, vy):
         vm[vx] = vm[vy]
 
+    def compile(self, is_from, vx, vy):
+        def move(vm):
+            registers = vm.registers
+            registers[vx] = registers[vy]
+        return move
+
 
 class op_MoveResult(OpCode):
     """MoveResult"""
+    mnemonics = ('move-result', 'move-result-object')
+    register_operands = (0,)
+
     def __init__(self):
         OpCode.__init__(self, '^move-result(?:-object)? (.+)')
 
@@ -113,8 +283,16 @@ class op_MoveResult(OpCode):
     def eval(vm, dest):
         vm[dest] = vm.return_v
 
+    def compile(self, dest):
+        def move_result(vm):
+            vm.registers[dest] = vm.return_v
+        return move_result
+
 
 class op_MoveException(OpCode):
+    mnemonics = ('move-exception',)
+    register_operands = (0,)
+
     def __init__(self):
         OpCode.__init__(self, '^move-exception (.+)')
 
@@ -124,126 +302,213 @@ class op_MoveException(OpCode):
 
 
 class op_IfLe(OpCode):
+    mnemonics = ('if-le',)
+    register_operands = (0, 1)
+    label_operands = (-1,)
+
     def __init__(self):
         OpCode.__init__(self, '^if-le (.+),\s*(.+),\s*(\:.+)')
 
     @staticmethod
     def eval(vm, vx, vy, label):
         if vm[vx] <= vm[vy]:
-            vm.goto(label)
+            vm.pc = label
+
+    def compile(self, vx, vy, label):
+        return compile_if(operator.le, vx, vy, label) or OpCode.compile(self, vx, vy, label)
 
 
 class op_IfGe(OpCode):
+    mnemonics = ('if-ge',)
+    register_operands = (0, 1)
+    label_operands = (-1,)
+
     def __init__(self):
         OpCode.__init__(self, '^if-ge (.+),\s*(.+),\s*(\:.+)')
 
     @staticmethod
     def eval(vm, vx, vy, label):
         if vm[vx] >= vm[vy]:
-            vm.goto(label)
+            vm.pc = label
+
+    def compile(self, vx, vy, label):
+        return compile_if(operator.ge, vx, vy, label) or OpCode.compile(self, vx, vy, label)
 
 
 class op_IfGez(OpCode):
+    mnemonics = ('if-gez',)
+    register_operands = (0,)
+    label_operands = (-1,)
+
     def __init__(self):
         OpCode.__init__(self, '^if-gez (.+),\s*(\:.+)')
         
     @staticmethod
     def eval(vm, vx, label):
         if vm[vx] >= 0:
-            vm.goto(label)
+            vm.pc = label
+
+    def compile(self, vx, label):
+        return compile_ifz(operator.ge, vx, label) or OpCode.compile(self, vx, label)
 
 
 class op_IfLtz(OpCode):
+    mnemonics = ('if-ltz',)
+    register_operands = (0,)
+    label_operands = (-1,)
+
     def __init__(self):
         OpCode.__init__(self, '^if-ltz (.+),\s*(\:.+)')
         
     @staticmethod
     def eval(vm, vx, label):
         if vm[vx] < 0:
-            vm.goto(label)
+            vm.pc = label
+
+    def compile(self, vx, label):
+        return compile_ifz(operator.lt, vx, label) or OpCode.compile(self, vx, label)
 
 
 class op_IfGt(OpCode):
+    mnemonics = ('if-gt',)
+    register_operands = (0, 1)
+    label_operands = (-1,)
+
     def __init__(self):
         OpCode.__init__(self, '^if-gt (.+),\s*(.+),\s*(\:.+)')
 
     @staticmethod
     def eval(vm, vx, vy, label):
         if vm[vx] > vm[vy]:
-            vm.goto(label)
+            vm.pc = label
+
+    def compile(self, vx, vy, label):
+        return compile_if(operator.gt, vx, vy, label) or OpCode.compile(self, vx, vy, label)
 
 
 class op_IfGtz(OpCode):
+    mnemonics = ('if-gtz',)
+    register_operands = (0,)
+    label_operands = (-1,)
+
     def __init__(self):
         OpCode.__init__(self, '^if-gtz (.+),\s*(\:.+)')
         
     @staticmethod
     def eval(vm, vx, label):
         if vm[vx] > 0:
-            vm.goto(label)
+            vm.pc = label
+
+    def compile(self, vx, label):
+        return compile_ifz(operator.gt, vx, label) or OpCode.compile(self, vx, label)
 
 
 class op_IfLez(OpCode):
+    mnemonics = ('if-lez',)
+    register_operands = (0,)
+    label_operands = (-1,)
+
     def __init__(self):
         OpCode.__init__(self, '^if-lez (.+),\s*(\:.+)')
 
     @staticmethod
     def eval(vm, vx, label):
         if vm[vx] <= 0:
-            vm.goto(label)
+            vm.pc = label
+
+    def compile(self, vx, label):
+        return compile_ifz(operator.le, vx, label) or OpCode.compile(self, vx, label)
 
 
 class op_IfEq(OpCode):
+    mnemonics = ('if-eq',)
+    register_operands = (0, 1)
+    label_operands = (-1,)
+
     def __init__(self):
         OpCode.__init__(self, '^if-eq (.+),\s*(.+),\s*(\:.+)')
 
     @staticmethod
     def eval(vm, vx, vy, label):
         if vm[vx] == vm[vy]:
-            vm.goto(label)
+            vm.pc = label
+
+    def compile(self, vx, vy, label):
+        return compile_if(operator.eq, vx, vy, label) or OpCode.compile(self, vx, vy, label)
 
 
 class op_IfNe(OpCode):
+    mnemonics = ('if-ne',)
+    register_operands = (0, 1)
+    label_operands = (-1,)
+
     def __init__(self):
         OpCode.__init__(self, '^if-ne (.+),\s*(.+),\s*(\:.+)')
 
     @staticmethod
     def eval(vm, vx, vy, label):
         if vm[vx] != vm[vy]:
-            vm.goto(label)
+            vm.pc = label
+
+    def compile(self, vx, vy, label):
+        return compile_if(operator.ne, vx, vy, label) or OpCode.compile(self, vx, vy, label)
 
 
 class op_IfLt(OpCode):
+    mnemonics = ('if-lt',)
+    register_operands = (0, 1)
+    label_operands = (-1,)
+
     def __init__(self):
         OpCode.__init__(self, '^if-lt (.+),\s*(.+),\s*(\:.+)')
 
     @staticmethod
     def eval(vm, vx, vy, label):
         if vm[vx] < vm[vy]:
-            vm.goto(label)
+            vm.pc = label
+
+    def compile(self, vx, vy, label):
+        return compile_if(operator.lt, vx, vy, label) or OpCode.compile(self, vx, vy, label)
 
 
 class op_IfEqz(OpCode):
+    mnemonics = ('if-eqz',)
+    register_operands = (0,)
+    label_operands = (-1,)
+
     def __init__(self):
         OpCode.__init__(self, '^if-eqz (.+),\s*(\:.+)')
 
     @staticmethod
     def eval(vm, vx, label):
         if vm[vx] == 0:
-            vm.goto(label)
+            vm.pc = label
+
+    def compile(self, vx, label):
+        return compile_ifz(operator.eq, vx, label) or OpCode.compile(self, vx, label)
 
 
 class op_IfNez(OpCode):
+    mnemonics = ('if-nez',)
+    register_operands = (0,)
+    label_operands = (-1,)
+
     def __init__(self):
         OpCode.__init__(self, '^if-nez (.+),\s*(\:.+)')
 
     @staticmethod
     def eval(vm, vx, label):
         if vm[vx] != 0:
-            vm.goto(label)
+            vm.pc = label
+
+    def compile(self, vx, label):
+        return compile_ifz(operator.ne, vx, label) or OpCode.compile(self, vx, label)
 
 
 class op_ArrayLength(OpCode):
+    mnemonics = ('array-length',)
+    register_operands = (0, 1)
+
     def __init__(self):
         OpCode.__init__(self, 'array-length (.+),\s*(.+)')
 
@@ -251,17 +516,31 @@ class op_ArrayLength(OpCode):
     def eval(vm, vx, vy):
         vm[vx] = len(vm[vy])
 
+    def compile(self, vx, vy):
+        def array_length(vm):
+            registers = vm.registers
+            registers[vx] = len(registers[vy])
+        return array_length
+
 
 class op_ArrayFillData(OpCode):
+    mnemonics = ('fill-array-data',)
+    register_operands = (0,)
+    data_operands = (1,)
+
     def __init__(self):
         OpCode.__init__(self, 'fill-array-data (.+),\s*(.+)')
 
     @staticmethod
-    def eval(vm, vx, label):
-        vm[vx] = vm.array_data[label]["elements"]
+    def eval(vm, vx, elements):
+        # the elements are shared by every run of the method
+        vm[vx] = list(elements)
 
 
 class op_Aget(OpCode):
+    mnemonics = ('aget', 'aget-*')
+    register_operands = (0, 1, 2)
+
     def __init__(self):
         OpCode.__init__(self, '^aget[\-a-z]* (.+),\s*(.+),\s*(.+)')
 
@@ -271,25 +550,55 @@ class op_Aget(OpCode):
         idx     = vm[vz]
         vm[vx] = arr[idx]
 
+    def compile(self, vx, vy, vz):
+        def aget(vm):
+            registers = vm.registers
+            registers[vx] = registers[vy][registers[vz]]
+        return aget
+
 
 class op_AddIntLit(OpCode):
+    mnemonics = ('add-int/lit8', 'add-int/lit16')
+    register_operands = (0, 1)
+    literal_operands = (2,)
+
     def __init__(self):
         OpCode.__init__(self, '^add-int/lit\d+ (.+),\s*(.+),\s*(.+)')
 
     @staticmethod
     def eval(vm, vx, vy, lit):
-        vm[vx] = eval( "%s + %s" % ( vm[vy], lit ) )
+        vm[vx] = vm[vy] + lit
+
+    def compile(self, vx, vy, lit):
+        def add_int_lit(vm):
+            registers = vm.registers
+            registers[vx] = registers[vy] + lit
+        return add_int_lit
 
 
 class op_MulIntLit(OpCode):
+    mnemonics = ('mul-int/lit8', 'mul-int/lit16')
+    register_operands = (0, 1)
+    literal_operands = (2,)
+
     def __init__(self):
         OpCode.__init__(self, '^mul-int/lit\d+ (.+),\s*(.+),\s*(.+)')
 
     @staticmethod
     def eval(vm, vx, vy, lit):
-        vm[vx] = eval("%s * %s" % (vm[vy], lit))
+        vm[vx] = vm[vy] * lit
+
+    def compile(self, vx, vy, lit):
+        def mul_int_lit(vm):
+            registers = vm.registers
+            registers[vx] = registers[vy] * lit
+        return mul_int_lit
+
 
 class op_MulNum2Addr(OpCode):
+    mnemonics = ('mul-int/2addr', 'mul-long/2addr', 'mul-float/2addr', 'mul-double/2addr')
+    register_operands = (1, 2)
+
     def __init__(self):
         OpCode.__init__(self, '^mul-(\w+)/2addr (.+),\s*(.+)')
 
@@ -297,8 +606,14 @@ class op_MulNum2Addr(OpCode):
     def eval(vm, kind, vx, vy):
         vm[vx] = vm[vx] * vm[vy]
 
+    def compile(self, kind, vx, vy):
+        return compile_binary(operator.mul, vx, vx, vy)
+
 
 class op_XorInt2Addr(OpCode):
+    mnemonics = ('xor-int', 'xor-int/2addr')
+    register_operands = (0, 1)
+
     def __init__(self):
         OpCode.__init__(self, '^xor-int(?:/2addr)? (.+),\s*(.+)')
 
@@ -310,10 +625,21 @@ class op_XorInt2Addr(OpCode):
         else:
             vm[vx] ^= ord(vm[vy])
 
+    def compile(self, vx, vy):
+        def xor_int_2addr(vm):
+            registers = vm.registers
+            value = registers[vy]
+            registers[vx] ^= int(value) if isinstance(value, int) else ord(value)
+        return xor_int_2addr
+
 
 class op_XorIntLit(OpCode):
     #xor-int/lit8 v0, v0, 0x26
 
+    mnemonics = ('xor-int/lit8', 'xor-int/lit16')
+    register_operands = (0, 1)
+    literal_operands = (2,)
+
     def __init__(self):
         OpCode.__init__(self, '^xor-int/lit\d+ (.+),\s*(.+),\s*(.+)')
 
@@ -323,11 +649,22 @@ class op_XorIntLit(OpCode):
             ii = int(vm[vy])
         else:
             ii = ord(vm[vy])
-        vm[vx] = ii ^ OpCode.get_int_value(lit)
+        vm[vx] = ii ^ lit
+
+    def compile(self, vx, vy, lit):
+        def xor_int_lit(vm):
+            registers = vm.registers
+            value = registers[vy]
+            registers[vx] = (int(value) if isinstance(value, int) else ord(value)) ^ lit
+        return xor_int_lit
 
 
 class op_OrIntLiteral(OpCode):
 
+    mnemonics = ('or-int/lit8', 'or-int/lit16')
+    register_operands = (1, 2)
+    literal_operands = (3,)
+
     def __init__(self):
         OpCode.__init__(self, '^or-int/lit(\d+) (.+),\s*(.+),\s*(.+)')
 
@@ -335,7 +672,7 @@ class op_OrIntLiteral(OpCode):
     def eval(vm, size, vx, vy, literal):
         """
         >>> vm = {'v0': 1, 'v1': 2, 'v2': 16}
-        >>> op_OrIntLiteral.eval(vm, 8, 'v2', 'v1', '0x3')
+        >>> op_OrIntLiteral.eval(vm, 8, 'v2', 'v1', 0x3)
         >>> vm == {'v0': 1, 'v1': 2, 'v2': (0x3 | vm['v1'])}
         True
         """
@@ -343,19 +680,39 @@ class op_OrIntLiteral(OpCode):
             ii = int(vm[vy])
         else:
             ii = ord(vm[vy])
-        vm[vx] = ii | OpCode.get_int_value(literal)
+        vm[vx] = ii | literal
+
+    def compile(self, size, vx, vy, literal):
+        def or_int_lit(vm):
+            registers = vm.registers
+            value = registers[vy]
+            registers[vx] = (int(value) if isinstance(value, int) else ord(value)) | literal
+        return or_int_lit
 
 
 class op_DivIntLit(OpCode):
+    mnemonics = ('div-int/lit8', 'div-int/lit16')
+    register_operands = (0, 1)
+    literal_operands = (2,)
+
     def __init__(self):
         OpCode.__init__(self, '^div-int/lit\d+ (.+),\s*(.+),\s*(.+)')
 
     @staticmethod
     def eval(vm, vx, vy, lit):
-        vm[vx] = vm[vy] // OpCode.get_int_value(lit)
+        vm[vx] = vm[vy] // lit
+
+    def compile(self, vx, vy, lit):
+        def div_int_lit(vm):
+            registers = vm.registers
+            registers[vx] = registers[vy] // lit
+        return div_int_lit
 
 
 class op_DivInt(OpCode):
+    mnemonics = ('div-int',)
+    register_operands = (0, 1, 2)
+
     def __init__(self):
         OpCode.__init__(self, '^div-int (.+),\s*(.+),\s*(.+)')
 
@@ -363,17 +720,33 @@ class op_DivInt(OpCode):
     def eval(vm, vx, vy, vz):
         vm[vx] = vm[vy] // vm[vz]
 
+    def compile(self, vx, vy, vz):
+        return compile_binary(operator.floordiv, vx, vy, vz)
+
 
 class op_DivIntLit(OpCode):
+    mnemonics = ('div-int/lit8', 'div-int/lit16')
+    register_operands = (0, 1)
+    literal_operands = (2,)
+
     def __init__(self):
         OpCode.__init__(self, '^div-int/lit\d+ (.+),\s*(.+),\s*(.+)')
 
     @staticmethod
     def eval(vm, vx, vy, lit):
-        vm[vx] = vm[vy] // OpCode.get_int_value(lit)
+        vm[vx] = vm[vy] // lit
+
+    def compile(self, vx, vy, lit):
+        def div_int_lit(vm):
+            registers = vm.registers
+            registers[vx] = registers[vy] // lit
+        return div_int_lit
 
 
 class op_AddInt(OpCode):
+    mnemonics = ('add-int',)
+    register_operands = (0, 1, 2)
+
     def __init__(self):
         OpCode.__init__(self, '^add-int (.+),\s*(.+),\s*(.+)')
 
@@ -381,8 +754,14 @@ class op_AddInt(OpCode):
     def eval(vm, vx, vy, vz):
         vm[vx] = vm[vy] + vm[vz]
 
+    def compile(self, vx, vy, vz):
+        return compile_binary(operator.add, vx, vy, vz)
+
 
 class op_SubInt(OpCode):
+    mnemonics = ('sub-int',)
+    register_operands = (0, 1, 2)
+
     def __init__(self):
         OpCode.__init__(self, '^sub-int (.+),\s*(.+),\s*(.+)')
 
@@ -390,8 +769,14 @@ class op_SubInt(OpCode):
     def eval(vm, vx, vy, vz):
         vm[vx] = vm[vy] - vm[vz]
 
+    def compile(self, vx, vy, vz):
+        return compile_binary(operator.sub, vx, vy, vz)
+
 
 class op_MulInt(OpCode):
+    mnemonics = ('mul-int',)
+    register_operands = (0, 1, 2)
+
     def __init__(self):
         OpCode.__init__(self, '^mul-int (.+),\s*(.+),\s*(.+)')
 
@@ -399,8 +784,14 @@ class op_MulInt(OpCode):
     def eval(vm, vx, vy, vz):
         vm[vx] = vm[vy] * vm[vz]
 
+    def compile(self, vx, vy, vz):
+        return compile_binary(operator.mul, vx, vy, vz)
+
 
 class op_RemInt(OpCode):
+    mnemonics = ('rem-int',)
+    register_operands = (0, 1, 2)
+
     def __init__(self):
         OpCode.__init__(self, '^rem-int (.+),\s*(.+),\s*(.+)')
 
@@ -408,13 +799,21 @@ class op_RemInt(OpCode):
     def eval(vm, vx, vy, vz):
         vm[vx] = vm[vy] % vm[vz]
 
+    def compile(self, vx, vy, vz):
+        return compile_binary(operator.mod, vx, vy, vz)
+
 
 class op_DivLong(op_DivInt):
+    mnemonics = ('div-long',)
+
     def __init__(self):
         OpCode.__init__(self, r'^div-long (.+),\s*(.+),\s*(.+)')
 
 
 class op_SubLong2Addr(OpCode):
+    mnemonics = ('sub-long/2addr',)
+    register_operands = (0, 1)
+
     def __init__(self):
         OpCode.__init__(self, '^sub-long/2addr (.+),\s*(.+)')
 
@@ -422,8 +821,14 @@ class op_SubLong2Addr(OpCode):
     def eval(vm, vx, vy):
         vm[vx] = vm[vx] - vm[vy]
 
+    def compile(self, vx, vy):
+        return compile_binary(operator.sub, vx, vx, vy)
+
 
 class op_RemLong2Addr(OpCode):
+    mnemonics = ('rem-long/2addr',)
+    register_operands = (0, 1)
+
     def __init__(self):
         OpCode.__init__(self, r'^rem-long/2addr (.+),\s*(.+)')
 
@@ -431,8 +836,14 @@ class op_RemLong2Addr(OpCode):
     def eval(vm, vx, vy):
         vm[vx] = vm[vx] % vm[vy]
 
+    def compile(self, vx, vy):
+        return compile_binary(operator.mod, vx, vx, vy)
+
 
 class op_AndInt(OpCode):
+    mnemonics = ('and-int',)
+    register_operands = (0, 1, 2)
+
     def __init__(self):
         OpCode.__init__(self, '^and-int (.+),\s*(.+),\s*(.+)')
 
@@ -440,17 +851,33 @@ class op_AndInt(OpCode):
     def eval(vm, vx, vy, vz):
         vm[vx] = vm[vy] & vm[vz]
 
+    def compile(self, vx, vy, vz):
+        return compile_binary(operator.and_, vx, vy, vz)
+
 
 class op_AndIntLit(OpCode):
+    mnemonics = ('and-int/lit8', 'and-int/lit16')
+    register_operands = (0, 1)
+    literal_operands = (2,)
+
     def __init__(self):
         OpCode.__init__(self, '^and-int/lit\d+ (.+),\s*(.+),\s*(.+)')
 
     @staticmethod
     def eval(vm, vx, vy, lit):
-        vm[vx] = int(vm[vy]) & OpCode.get_int_value(lit)
+        vm[vx] = int(vm[vy]) & lit
+
+    def compile(self, vx, vy, lit):
+        def and_int_lit(vm):
+            registers = vm.registers
+            registers[vx] = int(registers[vy]) & lit
+        return and_int_lit
 
 
 class op_AndInt2Addr(OpCode):
+    mnemonics = ('and-int/2addr',)
+    register_operands = (0, 1)
+
     def __init__(self):
         OpCode.__init__(self, '^and-int/2addr (.+),\s*(.+)')
 
@@ -464,8 +891,17 @@ class op_AndInt2Addr(OpCode):
         """
         vm[vx] = int(vm[vy]) & int(vm[vx])
 
+    def compile(self, vx, vy):
+        def and_int_2addr(vm):
+            registers = vm.registers
+            registers[vx] = int(registers[vy]) & int(registers[vx])
+        return and_int_2addr
+
 
 class op_OrInt(OpCode):
+    mnemonics = ('or-int',)
+    register_operands = (0, 1, 2)
+
     def __init__(self):
         OpCode.__init__(self, '^or-int (.+),\s*(.+),\s*(.+)')
 
@@ -473,19 +909,37 @@ class op_OrInt(OpCode):
     def eval(vm, vx, vy, vz):
         vm[vx] = vm[vy] | vm[vz]
 
+    def compile(self, vx, vy, vz):
+        return compile_binary(operator.or_, vx, vy, vz)
+
 
 class op_ShlIntLit(OpCode):
     # shl-int/lit8 vx, vy, lit8
+    mnemonics = ('shl-int/lit8',)
+    register_operands = (0, 1)
+    literal_operands = (2,)
+
     def __init__(self):
         OpCode.__init__(self, '^shl-int/lit\d+ (.+),\s*(.+),\s*(.+)')
 
     @staticmethod
     def eval(vm, vx, vy, lit):
-        vm[vx] = vm[vy] << (OpCode.get_int_value(lit) & 0x1f)
+        vm[vx] = vm[vy] << (lit & 0x1f)
+
+    def compile(self, vx, vy, lit):
+        shift = lit & 0x1f
+
+        def shl_int_lit(vm):
+            registers = vm.registers
+            registers[vx] = registers[vy] << shift
+        return shl_int_lit
 
 
 class op_ShlInt(OpCode):
     # shl-int/lit8 vx, vy, lit8
+    mnemonics = ('shl-int',)
+    register_operands = (0, 1, 2)
+
     def __init__(self):
         OpCode.__init__(self, '^shl-int (.+),\s+(.+),\s+(.+)')
 
@@ -499,17 +953,34 @@ class op_ShlInt(OpCode):
         """
         vm[vx] = (vm[vy] << (vm[vz] & 0x1f)) & 0xffffffff
 
+    def compile(self, vx, vy, vz):
+        def shl_int(vm):
+            registers = vm.registers
+            registers[vx] = (registers[vy] << (registers[vz] & 0x1f)) & 0xffffffff
+        return shl_int
+
 
 class op_GoTo(OpCode):
+    mnemonics = ('goto', 'goto/*')
+    label_operands = (0,)
+
     def __init__(self):
         OpCode.__init__(self, '^goto(?:/\d+)? (:.+)')
 
     @staticmethod
     def eval(vm, label):
-        vm.goto(label)
+        vm.pc = label
+
+    def compile(self, label):
+        def goto(vm):
+            vm.pc = label
+        return goto
 
 
 class op_NewInstance(OpCode):
+    mnemonics = ('new-instance',)
+    register_operands = (0,)
+
     def __init__(self):
         OpCode.__init__(self, '^new-instance (.+),\s*(.+)')
 
@@ -519,6 +990,9 @@ class op_NewInstance(OpCode):
 
 
 class op_NewArray(OpCode):
+    mnemonics = ('new-array',)
+    register_operands = (0, 1)
+
     def __init__(self):
         OpCode.__init__(self, '^new-array (.+),\s*(.+),\s*(.+)')
 
@@ -526,8 +1000,17 @@ class op_NewArray(OpCode):
     def eval(vm, vx, vy, klass):
         vm[vx] = [""] * vm[vy]
 
+    def compile(self, vx, vy, klass):
+        def new_array(vm):
+            registers = vm.registers
+            registers[vx] = [""] * registers[vy]
+        return new_array
+
 
 class op_APut(OpCode):
+    mnemonics = ('aput', 'aput-*')
+    register_operands = (0, 1, 2)
+
     def __init__(self):
         OpCode.__init__(self, '^aput(?:-[a-z]+)? (.+),\s*(.+),\s*(.+)')
 
@@ -542,50 +1025,178 @@ class op_APut(OpCode):
             arr.append(val)
         vm[vy] = arr
 
+    def compile(self, vx, vy, vz):
+        def aput(vm):
+            registers = vm.registers
+            idx = int(registers[vz])
+            arr = registers[vy]
+            if len(arr) > idx:
+                arr[idx] = registers[vx]
+            elif idx == len(arr):
+                arr.append(registers[vx])
+        return aput
+
+
+# receiver classes whose method a virtual call site caches, other receivers
+# look their method up at each call
+POLYMORPHIC_ENTRIES = 4
+
+
+class CallSite(object):
+    """Method reference of an invoke instruction, with the method it last
+    resolved to.
+
+    A static call caches the decoded code of its method, other calls the
+    method of each class of receiver seen, up to POLYMORPHIC_ENTRIES of
+    them. Virtual calls find it at the vtable slot the method has in the
+    class of the reference (see BaseClass.link), interface calls through the
+    itable of the receiver class. The cache is valid while the class loader
+    and its `generation` are the ones it was filled with."""
+    __slots__ = ('reference', 'klass', 'method', 'loader', 'generation', 'target',
+                 'receivers', 'slot')
+
+    def __init__(self, reference):
+        self.reference = reference
+        self.klass, self.method = reference.split(';->')
+        self.forget(None)
+
+    def forget(self, loader):
+        self.loader = loader
+        self.generation = loader.generation if loader is not None else None
+        self.target = None
+        self.receivers = {}
+        self.slot = None  # vtable slot of the method in the class of the reference
+
+    def static(self, vm):
+        """Decoded code of the static method called."""
+        loader = vm.emu.class_loader
+        if self.loader is not loader or self.generation != loader.generation:
+            self.forget(loader)
+        target = self.target
+        if target is None:
+            target = self.target = op_Invoke.resolve_static(vm, self.klass, self.method)
+            self.generation = loader.generation  # the class may just have been loaded
+        return target
+
+    def virtual(self, vm, invoke_type, this_object):
+        """Method called on `this_object`."""
+        loader = vm.emu.class_loader
+        if self.loader is not loader or self.generation != loader.generation:
+            self.forget(loader)
+        receiver = this_object.__class__
+        method = self.receivers.get(receiver)
+        if method is None:
+            method = self.dispatch(vm, invoke_type, receiver)
+            if method is None:
+                raise smali.objects.baseclass.MethodResolutionFailure(
+                    "Failed to resolve method for name {}".format(self.method))
+            if len(self.receivers) < POLYMORPHIC_ENTRIES:
+                self.receivers[receiver] = method
+        return method
+
+    def dispatch(self, vm, invoke_type, receiver):
+        """Method of a receiver class for this call, None if it has none."""
+        vtable = receiver.vtable()
+        if invoke_type == 'virtual':
+            if self.slot is None:
+                referenced = vm.emu.class_loader.find_class(self.klass + ';')
+                slots = referenced.vtable_slots() if referenced is not None else {}
+                self.slot = slots.get(self.method, -1)
+            slot = self.slot
+            # the receiver may not extend the class when it is not loaded
+            if 0 <= slot < len(vtable) and vtable[slot][0] == self.method:
+                return vtable[slot][1]
+        elif invoke_type == 'interface':
+            slot = receiver.itable().get(self.klass + ';', {}).get(self.method)
+            if slot is not None:
+                return vtable[slot][1]
+        else:  # direct and super calls run the method of the class of the reference
+            referenced = vm.emu.class_loader.find_class(self.klass + ';')
+            if referenced is not None:
+                receiver = referenced
+        try:
+            return receiver.get_method(self.method)
+        except IndexError:
+            return None
+
+    def __getstate__(self):
+        return self.reference  # the cached methods are not pickled
+
+    def __setstate__(self, reference):
+        self.__init__(reference)
+
+    def __str__(self):
+        return self.reference
+
+    def __repr__(self):
+        return 'CallSite({!r})'.format(self.reference)
+
 
 class op_Invoke(OpCode):
+    mnemonics = ('invoke-*',)
+    register_list_operands = (1,)
+    call_operands = (2,)
+
     def __init__(self):
         OpCode.__init__(self, '^invoke-([a-z]+) \{(.*)\},\s*(.+)')
 
     @staticmethod
     def eval(vm, invoke_type, args, call):
-        args = [arg.strip() for arg in args.split(',')]
-        klass, method  = call.split(';->')
-        if invoke_type == 'direct' or invoke_type == 'virtual':
-            """Method call on an instance object. The class loader 
-            is irrelevant since we already have an python object at hand."""
-            this_object, args = vm[args[0]], args[1:]
-            arg_values = [vm[arg] for arg in args]
-            vm.return_v = this_object.invoke(method, arg_values)
-        elif invoke_type == 'static':
-            """The `this` object is not existant in this case.
-            We need to make a call to the class loader for this static method."""
-            arg_values = [vm[arg] for arg in args]
-            complete_class_name = klass + ';'
-            java_type_class_name = smali.parser.extract_class_name(complete_class_name)
-            if java_type_class_name in vm.emu.class_loader.loaded_classes:
-                java_class = vm.emu.class_loader.loaded_classes[java_type_class_name]
-            elif complete_class_name in vm.emu.class_loader.loaded_classes:
-                java_class = vm.emu.class_loader.loaded_classes[complete_class_name]
-            else:
-                raise UnavailableClass("Unable to load class {} from class loader".format(klass))
+        op_Invoke.invoke(vm, invoke_type, args, call, nested=True)
 
-            try:
-                java_method = java_class.get_method(method)
-            except IndexError:
-                raise UnavailableMethod("Unable to find method {} in class {}".format(method, klass))
-
-            new_frame = vm.get_new_frame()
-            parameters = {'p{}'.format(position): vm[value] for position, value in enumerate(args)}
-            vm.emu.vm = new_frame
-            vm.return_v = vm.emu.run(java_method.source_code, args=parameters, vm=new_frame)
-            vm.clean_vm()
+    @staticmethod
+    def resolve_static(vm, klass, method):
+        """Return the decoded code of a static method of a loaded class."""
+        java_class = vm.emu.class_loader.find_class(klass + ';')
+        if java_class is None:
+            raise UnavailableClass("Unable to load class {} from class loader".format(klass))
 
+        try:
+            java_method = java_class.get_method(method)
+        except IndexError:
+            raise UnavailableMethod("Unable to find method {} in class {}".format(method, klass))
+        return java_method.decode(vm.emu.dispatch)
+
+    @staticmethod
+    def enter(vm, invoke_type, args, call):
+        """Start the method in a new frame the run loop continues with (see
+        Emulator.enter)."""
+        op_Invoke.invoke(vm, invoke_type, args, call, nested=False)
+
+    @staticmethod
+    def invoke(vm, invoke_type, args, call, nested):
+        """Call the method of the instruction. Static methods, and methods
+        of smali classes called on an instance with `this` as p0, run in a
+        new frame: in a nested run if `nested`, else in the run loop of the
+        caller. Methods implemented in Python (see smali.objects) are
+        called at once."""
+        if invoke_type == 'static':
+            arguments = [vm[arg] for arg in args]
+            code = call.static(vm)
+        elif invoke_type in ('direct', 'virtual', 'interface', 'super'):
+            # resolved from the class of the instance, see CallSite.dispatch
+            this_object = vm[args[0]]
+            arg_values = [vm[arg] for arg in args[1:]]
+            if not isinstance(this_object, smali.objects.baseclass.BaseClass):
+                vm.return_v = this_object.invoke(call.method, arg_values)
+                return
+            method = call.virtual(vm, invoke_type, this_object)
+            if not hasattr(method, 'decode'):  # not a JavaMethod
+                vm.return_v = method(this_object, *arg_values)
+                return
+            arguments = [this_object] + arg_values
+            code = method.decode(vm.emu.dispatch)
         else:
             raise UnsupportedOperation("OpCode not implemented for {}".format(invoke_type))
-
+        if nested:
+            vm.return_v = vm.emu.call(code, arguments)
+        else:
+            vm.emu.enter(code, arguments)
 
 class op_IntToType(OpCode):
+    mnemonics = ('int-to-*',)
+    register_operands = (1, 2)
+
     def __init__(self):
         OpCode.__init__(self, '^int-to-([a-z]+) (.+),\s*(.+)')
 
@@ -602,31 +1213,70 @@ class op_IntToType(OpCode):
         else:
             vm.emu.fatal("Unsupported type '%s' ." % ctype)
 
+    def compile(self, ctype, vx, vy):
+        if ctype == 'long':
+            def int_to_type(vm):
+                registers = vm.registers
+                registers[vx] = registers[vy] & 0xFFFFFFFFFFFFFFFF
+        elif ctype == 'int':
+            def int_to_type(vm):
+                registers = vm.registers
+                registers[vx] = registers[vy] & 0xFFFFFFFF
+        elif ctype == 'char':
+            def int_to_type(vm):
+                registers = vm.registers
+                registers[vx] = chr(registers[vy] & 0xFFFF)
+        elif ctype == 'byte':
+            def int_to_type(vm):
+                registers = vm.registers
+                registers[vx] = struct.pack('>i', registers[vy])[-1]
+        else:
+            return OpCode.compile(self, ctype, vx, vy)
+        return int_to_type
+
 
 class op_LongToType(op_IntToType):
+    mnemonics = ('long-to-*',)
+
     def __init__(self):
         OpCode.__init__(self, '^long-to-([a-z]+) (.+),\s*(.+)')
 
 
 class op_SPut(OpCode):
+    mnemonics = ('sput', 'sput-*')
+    register_operands = (0,)
+
     def __init__(self):
         OpCode.__init__(self, '^sput(?:-[a-z]+)?\s+(.+),\s*(.+)')
 
     @staticmethod
     def eval(vm, vx, staticVariableName):
-        vm.variables[staticVariableName] = vm.variables[vx]
+        vm.variables[staticVariableName] = vm[vx]
 
 
 class op_SGet(OpCode):
+    mnemonics = ('sget', 'sget-*')
+    register_operands = (0,)
+
     def __init__(self):
         OpCode.__init__(self, '^sget(?:-[a-z]+)?\s+(.+),\s*(.+)')
 
     @staticmethod
     def eval(vm, vx, staticVariableName):
-        vm.variables[vx] = vm.variables[staticVariableName]
+        try:
+            vm[vx] = vm.variables[staticVariableName]
+        except KeyError:
+            # first use of the class: load it if needed and run its <clinit>
+            class_name = staticVariableName.split('->', 1)[0]
+            if not vm.emu.class_loader.initialize(class_name, vm.emu):
+                raise
+            vm[vx] = vm.variables[staticVariableName]
 
 
 class op_Return(OpCode):
+    mnemonics = ('return', 'return-*')
+    register_operands = (1,)
+
     def __init__(self):
         OpCode.__init__(self, '^return(-[a-z]*)*\s*(.+)*')
 
@@ -647,35 +1297,55 @@ class op_Return(OpCode):
         else:
             vm.emu.fatal("Unsupported return type.")
 
+    def compile(self, ctype, vx):
+        if (ctype is None and vx is None) or ctype == '-void':
+            def return_void(vm):
+                vm.return_v = None
+                vm.stop = True
+            return return_void
+        return OpCode.compile(self, ctype, vx)
+
 
 class op_RemIntLit(OpCode):
+    mnemonics = ('rem-int/lit8', 'rem-int/lit16')
+    register_operands = (0, 1)
+    literal_operands = (2,)
+
     def __init__(self):
         OpCode.__init__(self, '^rem-int/lit\d+ (.+),\s*(.+),\s*(.+)')
 
     @staticmethod
     def eval(vm, vx, vy, lit):
-        vm[vx] = int(vm[vy]) % OpCode.get_int_value(lit)
+        vm[vx] = int(vm[vy]) % lit
+
+    def compile(self, vx, vy, lit):
+        def rem_int_lit(vm):
+            registers = vm.registers
+            registers[vx] = int(registers[vy]) % lit
+        return rem_int_lit
 
 
 class op_PackedSwitch(OpCode):
+    mnemonics = ('packed-switch',)
+    register_operands = (0,)
+    data_operands = (1,)
+
     def __init__(self):
         OpCode.__init__(self, '^packed-switch (.+),\s*(.+)')
 
     @staticmethod
-    def eval(vm, vx, table):
-        val = vm[vx]
-        switch = vm.packed_switches.get(table, {})
-        cases = switch.get('cases', [])
-        case_idx = val - switch.get('first_value')
-
-        if case_idx >= len(cases) or case_idx < 0:
-            return
-
-        case_label = cases[case_idx]
-
-        vm.goto(case_label)
+    def eval(vm, vx, switch):
+        # the table is (first value, instruction index of each case)
+        first_value, targets = switch
+        case = vm[vx] - first_value
+        if 0 <= case < len(targets):
+            vm.pc = targets[case]
 
 class op_RSubIntLiteral(OpCode):
+    mnemonics = ('rsub-int/lit8',)
+    register_operands = (1, 2)
+    literal_operands = (3,)
+
     def __init__(self):
         OpCode.__init__(self, '^rsub-int/lit(\d+) (.+),\s*(.+),\s*(.+)')
 
@@ -684,19 +1354,22 @@ class op_RSubIntLiteral(OpCode):
         """
         >>> vm = {'v0': 1, 'v1': 2, 'v2': 4}
         >>> # perform v1 - 0x3 and store the result into v2
-        >>> op_RSubIntLiteral.eval(vm, 8, 'v2', 'v1', '0x3')
+        >>> op_RSubIntLiteral.eval(vm, 8, 'v2', 'v1', 0x3)
         >>> vm  # v2 is 0x3 - v1 = 0x3 - 2 = 1
         {'v0': 1, 'v1': 2, 'v2': 1}
         """
         register_size = int(register_size)  # 8, 16 or 32 bytes
         source = vm[source]
-        constant = OpCode.get_int_value(constant)
         result = constant - source
         assert all(-(2 ** (register_size - 1)) <= x <= (2 ** (register_size - 1) - 1)
                    for x in (source, constant, result))
         vm[destination] = result
 
 class op_RSubInt(OpCode):
+    mnemonics = ('rsub-int',)
+    register_operands = (0, 1)
+    literal_operands = (2,)
+
     def __init__(self):
         OpCode.__init__(self, '^rsub-int\s+(.+),\s*(.+),\s*(.+)')
 
@@ -705,48 +1378,77 @@ class op_RSubInt(OpCode):
         """
         >>> vm = {'v0': 1, 'v1': 2, 'v2': 4}
         >>> # perform v1 - 0x3 and store the result into v2
-        >>> op_RSubInt.eval(vm, 'v2', 'v1', '0x32')
+        >>> op_RSubInt.eval(vm, 'v2', 'v1', 0x32)
         >>> vm  # v2 is 0x32 - v1 = 0x32 - 2 = 48
         {'v0': 1, 'v1': 2, 'v2': 48}
         """
         source = vm[source]
-        constant = OpCode.get_int_value(constant)
         result = constant - source
         vm[destination] = result
 
+    def compile(self, destination, source, constant):
+        def rsub_int(vm):
+            registers = vm.registers
+            registers[destination] = constant - registers[source]
+        return rsub_int
+
 
 class op_ShrIntLit(OpCode):
     """For ushr-int opcode.
 
     >>> vm = {'v0': 65535, 'v1': 18}
-    >>> op_ShrIntLit.eval(vm, 'v1', 'v0', '0x8')
+    >>> op_ShrIntLit.eval(vm, 'v1', 'v0', 0x8)
     >>> vm == {'v0': 65535, 'v1': 255}
     True
     """
 
+    mnemonics = ('shr-int/lit8',)
+    register_operands = (0, 1)
+    literal_operands = (2,)
+
     def __init__(self):
         OpCode.__init__(self, '^shr-int/lit\d+\s+(\w+),\s+(\w+),\s+(\-?0x[0-9a-f]+)')
 
     @staticmethod
     def eval(vm, dest, source, constant):
-        vm[dest] = vm[source] >> (OpCode.get_int_value(constant) & 0x1f)
+        vm[dest] = vm[source] >> (constant & 0x1f)
+
+    def compile(self, dest, source, constant):
+        shift = constant & 0x1f
+
+        def shr_int_lit(vm):
+            registers = vm.registers
+            registers[dest] = registers[source] >> shift
+        return shr_int_lit
 
 
 class op_UshrIntLit(OpCode):
     """For ushr-int opcode.
 
     >>> vm = {'v0': 65535, 'v1': 18}
-    >>> op_UshrIntLit.eval(vm, 'v1', 'v0', '0x8')
+    >>> op_UshrIntLit.eval(vm, 'v1', 'v0', 0x8)
     >>> vm == {'v0': 65535, 'v1': 255}
     True
     """
 
+    mnemonics = ('ushr-int/lit8',)
+    register_operands = (0, 1)
+    literal_operands = (2,)
+
     def __init__(self):
         OpCode.__init__(self, '^ushr-int/lit\d+\s+(\w+),\s+(\w+),\s+(\-?0x[0-9a-f]+)')
 
     @staticmethod
     def eval(vm, dest, source, constant):
-        vm[dest] = vm[source] >> (OpCode.get_int_value(constant) & 0x1f)
+        vm[dest] = vm[source] >> (constant & 0x1f)
+
+    def compile(self, dest, source, constant):
+        shift = constant & 0x1f
+
+        def shr_int_lit(vm):
+            registers = vm.registers
+            registers[dest] = registers[source] >> shift
+        return shr_int_lit
 
 
 class op_UshrInt(OpCode):
@@ -758,6 +1460,9 @@ class op_UshrInt(OpCode):
     True
     """
 
+    mnemonics = ('ushr-int',)
+    register_operands = (0, 1, 2)
+
     def __init__(self):
         OpCode.__init__(self, '^ushr-int\s+(\w+),\s+(\w+),\s+(\w+)')
 
@@ -765,6 +1470,12 @@ class op_UshrInt(OpCode):
     def eval(vm, dest, source, constant):
         vm[dest] = vm[source] >> (vm[constant] & 0x1f)
 
+    def compile(self, dest, source, constant):
+        def ushr_int(vm):
+            registers = vm.registers
+            registers[dest] = registers[source] >> (registers[constant] & 0x1f)
+        return ushr_int
+
 
 class op_Nop(OpCode):
     """For nop opcode.
@@ -774,6 +1485,8 @@ class op_Nop(OpCode):
     >>> vm
     {'v0': 1}
     """
+    mnemonics = ('nop',)
+
     def __init__(self):
         OpCode.__init__(self, '^nop$')
 
@@ -781,8 +1494,16 @@ class op_Nop(OpCode):
     def eval(*args):
         pass
 
+    def compile(self, *args):
+        def nop(vm):
+            pass
+        return nop
+
 
 class op_AddInt2Addr(OpCode):
+    mnemonics = ('add-int/2addr',)
+    register_operands = (0, 1)
+
     def __init__(self):
         OpCode.__init__(self, r'^add-int/2addr (.+),\s*(.+)')
 
@@ -800,8 +1521,14 @@ class op_AddInt2Addr(OpCode):
         result = source1 + source2
         vm[source_and_dest] = result
 
+    def compile(self, source_and_dest, source_register):
+        return compile_binary(operator.add, source_and_dest, source_register, source_and_dest)
+
 
 class op_SubInt2Addr(OpCode):
+    mnemonics = ('sub-int/2addr',)
+    register_operands = (0, 1)
+
     def __init__(self):
         OpCode.__init__(self, r'^sub-int/2addr (.+),\s*(.+)')
 
@@ -819,8 +1546,14 @@ class op_SubInt2Addr(OpCode):
         result = source2 - source1
         vm[source_and_dest] = result
 
+    def compile(self, source_and_dest, source_register):
+        return compile_binary(operator.sub, source_and_dest, source_and_dest, source_register)
+
 
 class op_OrInt2Addr(OpCode):
+    mnemonics = ('or-int/2addr',)
+    register_operands = (0, 1)
+
     def __init__(self):
         OpCode.__init__(self, r'^or-int/2addr (.+),\s*(.+)')
 
@@ -840,8 +1573,14 @@ class op_OrInt2Addr(OpCode):
         result = source1 | source2
         vm[source_and_dest] = result
 
+    def compile(self, source_and_dest, source_register):
+        return compile_binary(operator.or_, source_and_dest, source_register, source_and_dest)
+
 
 class op_NegInt(OpCode):
+    mnemonics = ('neg-int',)
+    register_operands = (0, 1)
+
     def __init__(self):
         OpCode.__init__(self, r'^neg-int (.+),\s*(.+)')
 
@@ -856,4 +1595,8 @@ class op_NegInt(OpCode):
         """
         vm[dest] = -vm[source]
 
-
+    def compile(self, dest, source):
+        def neg_int(vm):
+            registers = vm.registers
+            registers[dest] = -registers[source]
+        return neg_int
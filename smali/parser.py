@@ -164,6 +164,61 @@ def get_method_name_and_signature(source_line):
     return qualifiers, method_name, parse_argument_list(argument_list), return_type
 
 
+class ClassOutline(object):
+    """Declarations of a class, as found by `scan_class`."""
+    def __init__(self):
+        self.class_name = None
+        self.super_class = None
+        self.interfaces = []
+        self.fields = []        # (qualifiers, name, type)
+        self.methods = {}       # (qualifiers, name, argument types, return type) -> Source
+        self.method_lines = {}  # same keys -> index of the .method and .end method lines
+
+
+def scan_class(smali_source_code):
+    """Find the declarations of a class in a single pass over its lines,
+    the lines of a method being only checked for its end.
+
+    >>> outline = scan_class(smali.source.Source(lines=[
+    ...     '.class public Lcom/a/B;', '.super Ljava/lang/Object;',
+    ...     '.implements Ljava/lang/Runnable;', '.field private static x:I',
+    ...     '.method public static f(I)I', '.locals 0', 'return p0', '.end method']))
+    >>> outline.class_name, outline.super_class, outline.interfaces
+    ('Lcom/a/B;', 'Ljava/lang/Object;', ['Ljava/lang/Runnable;'])
+    >>> outline.fields
+    [('private static', 'x', 'I')]
+    >>> outline.method_lines
+    {('public static', 'f', ('I',), 'I'): (4, 7)}
+    """
+    outline = ClassOutline()
+    lines = smali_source_code.lines
+    signature, start = None, None
+    for position, line in enumerate(lines):
+        if line[:1] != '.':
+            continue
+        if signature is not None:
+            if line == '.end method':
+                outline.methods[signature] = smali.source.Source(lines=lines[start:position + 1])
+                outline.method_lines[signature] = (start, position)
+                signature = None
+        elif line.startswith('.method'):
+            match = START_METHOD_PATTERN.match(line)
+            if match:
+                qualifiers, method_name, argument_list, return_type = match.group(1, 2, 3, 4)
+                signature = (qualifiers, method_name, parse_argument_list(argument_list), return_type)
+                start = position
+        elif line.startswith('.field'):
+            outline.fields.append(get_field_name_and_type(line))
+        elif line.startswith('.class'):
+            if outline.class_name is None:
+                outline.class_name = get_classname_from_declaration_line(line)
+        elif line.startswith('.super'):
+            outline.super_class = line.split()[-1]
+        elif line.startswith('.implements'):
+            outline.interfaces.append(line.split()[-1])
+    return outline
+
+
 def extract_methods(smali_source_code):
     """
     :param smali_source_code: Source
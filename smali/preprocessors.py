@@ -23,33 +23,24 @@ from smali.opcodes import OpCode
 
 
 class TryCatchPreprocessor:
-    """Pre process try/catch blocks."""
-    # TODO: Save exception type for specific catch.
+    """Pre process the .catch and .catchall directives of try/catch blocks."""
+    #   .catch Ljava/lang/Exception; {:try_start_0 .. :try_end_0} :catch_0
+    #   .catchall {:try_start_0 .. :try_end_0} :catchall_0
+    DIRECTIVE = re.compile(r'^\.catch(?:all|\s+(\S+))\s*\{\s*(:\S+)\s*\.\.\s*(:\S+)\s*\}\s*(:\S+)')
 
     @staticmethod
     def check(line):
-        return line.startswith(':try_start_')
+        return line.startswith('.catch')
 
     @staticmethod
-    def process(vm, line, index, lines ):
+    def process(vm, line, index, lines):
         """
-        Will search the '.catch' directive and update the VM accordingly.
+        Record the (exception type, start label, end label, handler label) of
+        the directive, the type being None for a .catchall.
         """
-        # get block identifier
-        block_id = line.split('_')[2]
-        # search for next pattern:
-        #
-        #   .catch Ljava/lang/Exception; {:try_start_BLOCK_ID .. :try_end_BLOCK_ID} :LABEL
-        #
-        expression = '^\.catch [^\s]+ \{:try_start_%s[ \.]+:try_end_%s\}\s*(\:.+)' % (block_id, block_id)
-        for nindex, nline in enumerate(lines[index + 1:]):
-            # TODO: Save exception type for specific catch.
-            m = re.search(expression, nline)
-            if m:
-                label = m.group(1)
-                eindex = nindex + index + 1
-                vm.catch_blocks.append((index, eindex, label))
-                break
+        m = TryCatchPreprocessor.DIRECTIVE.match(line)
+        if m:
+            vm.catch_blocks.append(m.group(1, 2, 3, 4))
 
 
 class PackedSwitchPreprocessor:
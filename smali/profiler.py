@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+# This file is part of the Smali Emulator.
+#
+# This file may be licensed under the terms of of the
+# GNU General Public License Version 3 (the ``GPL'').
+#
+# Software distributed under the License is distributed
+# on an ``AS IS'' basis, WITHOUT WARRANTY OF ANY KIND, either
+# express or implied. See the GPL for the specific language
+# governing rights and limitations.
+#
+# You should have received a copy of the GPL along with this
+# program. If not, go to http://www.gnu.org/licenses/gpl.html
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""
+Execution profiler.
+
+A `Profiler` attached to an emulator (see `Emulator(profile=True)`) listens
+to its events (see smali.events) and accumulates, over all the runs of the
+emulator including the nested ones, the executions and the time of every
+opcode, method and instruction. The time of an instruction is the time from
+its step event to the next event, the time of a method includes the methods
+it calls.
+
+Profiled runs execute one instruction at a time, without superinstructions
+nor compiled methods, so the times compare handlers and methods with each
+other rather than measure the optimized backends.
+
+A `SamplingProfiler` instead records the stack of the emulated methods every
+few instructions or microseconds, when the run loops check the budget of the
+run (see Emulator.check_budget), so that the runs keep their backend and
+speed. Its samples are written in the collapsed stack format of flamegraph
+tools.
+"""
+import collections
+import json
+import time
+
+import smali.events
+
+clock = time.perf_counter
+
+# columns of each table, see Profiler.table
+COLUMNS = {
+    'opcodes': ('count', 'time'),
+    'methods': ('calls', 'steps', 'time'),
+    'lines': ('count', 'time'),
+}
+
+HEADERS = {
+    'opcodes': '{:>10} {:>12}  opcode'.format('count', 'time (ms)'),
+    'methods': '{:>10} {:>10} {:>12}  method'.format('calls', 'steps', 'time (ms)'),
+    'lines': '{:>10} {:>12}  method:pc instruction'.format('count', 'time (ms)'),
+}
+
+
+class Profiler(object):
+    """Counters of the runs of the emulators it is attached to.
+
+    `opcodes` maps a mnemonic to its [count, time], `methods` a method name
+    to its [calls, steps, time] and `lines` a (method name, pc) to the
+    [count, time, text] of the instruction, times being in seconds. Runs of a
+    source rather than of a method are named '<source>'."""
+    def __init__(self):
+        self.opcodes = {}
+        self.methods = {}
+        self.lines = {}
+        self.emulators = []
+        self.running = None  # (opcode counters, line counters, start) of the last step
+        self.calls = []      # (method counters, start) of the running methods
+
+    def attach(self, emulator):
+        emulator.subscribe(smali.events.STEP, self.step)
+        emulator.subscribe(smali.events.CALL, self.call)
+        emulator.subscribe(smali.events.RETURN, self.ret)
+        self.emulators.append(emulator)
+        return self
+
+    def detach(self, emulator):
+        emulator.unsubscribe(smali.events.STEP, self.step)
+        emulator.unsubscribe(smali.events.CALL, self.call)
+        emulator.unsubscribe(smali.events.RETURN, self.ret)
+        self.emulators.remove(emulator)
+
+    def reset(self):
+        self.opcodes.clear()
+        self.methods.clear()
+        self.lines.clear()
+        self.running = None
+        del self.calls[:]
+
+    # -- event callbacks
+
+    def stop(self, now):
+        """End the time of the running instruction."""
+        if self.running is not None:
+            opcode, line, start = self.running
+            opcode[1] += now - start
+            line[1] += now - start
+            self.running = None
+
+    def step(self, event):
+        now = clock()
+        self.stop(now)
+        method = event.method or '<source>'
+        opcode = self.opcodes.get(event.opcode)
+        if opcode is None:
+            opcode = self.opcodes[event.opcode] = [0, 0.0]
+        line = self.lines.get((method, event.pc))
+        if line is None:
+            line = self.lines[(method, event.pc)] = [0, 0.0, event.instruction.text]
+        opcode[0] += 1
+        line[0] += 1
+        if self.calls:
+            self.calls[-1][0][1] += 1
+        self.running = (opcode, line, clock())
+
+    def call(self, event):
+        now = clock()
+        self.stop(now)
+        # frames left over by a run which raised are gone
+        del self.calls[max(len(event.vm.frames) - 1, 0):]
+        method = event.method or '<source>'
+        counters = self.methods.get(method)
+        if counters is None:
+            counters = self.methods[method] = [0, 0, 0.0]
+        counters[0] += 1
+        self.calls.append((counters, now))
+
+    def ret(self, event):
+        now = clock()
+        self.stop(now)
+        if self.calls:
+            counters, start = self.calls.pop()
+            counters[2] += now - start
+
+    # -- reports
+
+    def rows(self, kind='opcodes', sort='time'):
+        """(name, counters) of a table, the highest `sort` column first."""
+        column = COLUMNS[kind].index(sort)
+        table = getattr(self, kind)
+        return sorted(table.items(), key=lambda item: (-item[1][column], str(item[0])))
+
+    def table(self, kind='opcodes', sort='time', limit=None):
+        """Text table of the `opcodes`, `methods` or `lines` counters sorted
+        by one of their columns, the first `limit` rows only if given."""
+        rows = self.rows(kind, sort)[:limit]
+        lines = [HEADERS[kind]]
+        for name, counters in rows:
+            if kind == 'methods':
+                calls, steps, seconds = counters
+                lines.append('{:>10} {:>10} {:>12.3f}  {}'.format(calls, steps, seconds * 1000, name))
+            elif kind == 'lines':
+                count, seconds, text = counters
+                lines.append('{:>10} {:>12.3f}  {}:{} {}'.format(
+                    count, seconds * 1000, name[0], name[1], text))
+            else:
+                count, seconds = counters
+                lines.append('{:>10} {:>12.3f}  {}'.format(count, seconds * 1000, name))
+        return '\n'.join(lines)
+
+    def as_dict(self):
+        """Counters by table, as plain values."""
+        return {
+            'opcodes': {name: {'count': count, 'time': seconds}
+                        for name, (count, seconds) in self.opcodes.items()},
+            'methods': {name: {'calls': calls, 'steps': steps, 'time': seconds}
+                        for name, (calls, steps, seconds) in self.methods.items()},
+            'lines': [{'method': method, 'pc': pc, 'instruction': text,
+                       'count': count, 'time': seconds}
+                      for (method, pc), (count, seconds, text) in sorted(self.lines.items())],
+        }
+
+    def to_json(self, **kwargs):
+        """JSON document of `as_dict`, `kwargs` are given to json.dumps."""
+        kwargs.setdefault('sort_keys', True)
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def __repr__(self):
+        return self.table(limit=10)
+
+
+# steps between two looks at the clock of a sampler taking timed samples
+POLL_STEPS = 128
+
+
+class SamplingProfiler(object):
+    """Samples of the stacks of the emulated methods, taken every `steps`
+    instructions or every `interval` seconds.
+
+    `stacks` maps a stack, a tuple of frame names from the outermost, to its
+    weight: the instructions run, or the microseconds elapsed, since the
+    previous sample. A frame is named after its method without the ';' of
+    its descriptors, '<source>' for a source run directly, followed by its
+    source line if `lines` is True.
+    Compiled methods report their instructions by batches (see
+    smali.compiler), so their samples are coarser."""
+    def __init__(self, steps=None, interval=None, lines=False):
+        if (steps is None) == (interval is None):
+            raise ValueError("Sample every given steps or interval")
+        self.steps = steps
+        self.interval = interval
+        self.lines = lines
+        self.stacks = collections.Counter()
+        self.stats = None  # Stats of the sampled run
+        self.last = None   # steps count, or time, of the last sample
+
+    def attach(self, emulator):
+        emulator.sampler = self
+        emulator.vm.checkpoint = 0  # sample from the next instruction
+        return self
+
+    def detach(self, emulator):
+        emulator.sampler = None
+
+    def sample(self, vm, stats):
+        """Record the stack if it is time to, return the steps count at
+        which to call again."""
+        if stats is not self.stats:  # a new run
+            self.stats = stats
+            self.last = stats.steps if self.steps is not None else clock()
+        elif self.steps is not None:
+            if stats.steps - self.last >= self.steps:
+                self.record(vm, stats.steps - self.last)
+                self.last = stats.steps
+        else:
+            now = clock()
+            if now - self.last >= self.interval:
+                self.record(vm, int((now - self.last) * 1000000))
+                self.last = now
+        if self.steps is not None:
+            return self.last + self.steps
+        return stats.steps + POLL_STEPS
+
+    def record(self, vm, weight):
+        frames = [(frame.code, frame.pc) for frame in vm.frames if frame.code is not None]
+        frames.append((vm.code, vm.pc))
+        stack = tuple(self.frame(code, pc) for code, pc in frames if code is not None)
+        if stack:
+            self.stacks[stack] += weight
+
+    def frame(self, code, pc):
+        # ';' separates the frames of a collapsed stack
+        name = (code.name or '<source>').replace(';', '')
+        if self.lines:
+            return '{}:{}'.format(name, code.line_number(pc))
+        return name
+
+    def collapsed(self):
+        """Samples in the collapsed stack format, one 'frame;frame weight'
+        line per stack."""
+        return ''.join(
+            '{} {}\n'.format(';'.join(stack), weight)
+            for stack, weight in sorted(self.stacks.items())
+        )
+
+    def write(self, path):
+        with open(path, 'w') as output:
+            output.write(self.collapsed())
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# This file is part of the Smali Emulator.
+#
+# This file may be licensed under the terms of of the
+# GNU General Public License Version 3 (the ``GPL'').
+#
+# Software distributed under the License is distributed
+# on an ``AS IS'' basis, WITHOUT WARRANTY OF ANY KIND, either
+# express or implied. See the GPL for the specific language
+# governing rights and limitations.
+#
+# You should have received a copy of the GPL along with this
+# program. If not, go to http://www.gnu.org/licenses/gpl.html
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""
+Superinstructions.
+
+A peephole pass over a decoded method fusing the instruction sequences listed
+in FUSION_TABLE into a single instruction, executed by one Python function
+(see smali.compiler.compile_sequence), so the run loop dispatches once for
+the whole sequence.
+
+A sequence is only fused if no label, hence no jump target and no try/catch
+boundary, stands between its instructions, and only its last instruction may
+jump or return. vm.pc is kept up to date between the fused instructions, so
+exceptions are caught exactly as when they run one by one.
+
+The table is ordered by priority, longer patterns first; new patterns found
+by profiling a corpus can be appended with `add_pattern`.
+"""
+import smali.compiler
+from smali.opcodes import (
+    op_AddIntLit,
+    op_Aget,
+    op_APut,
+    op_Const,
+    op_GoTo,
+    op_IfLt,
+    op_IfGe,
+    op_IntToType,
+    op_PackedSwitch,
+    op_Return,
+    op_SGet,
+    op_XorInt2Addr,
+    op_XorIntLit,
+)
+
+FUSION_TABLE = [
+    # decryption loops: load, xor, convert and store one character
+    (op_Aget, op_XorInt2Addr, op_IntToType, op_APut),
+    (op_Aget, op_XorIntLit, op_IntToType, op_APut),
+    # loading a character from a static key table
+    (op_SGet, op_Const, op_Aget, op_IntToType),
+    (op_Const, op_Aget, op_IntToType),
+    # loop counters
+    (op_AddIntLit, op_GoTo),
+    (op_AddIntLit, op_IfLt),
+    (op_AddIntLit, op_IfGe),
+    (op_Aget, op_IntToType),
+    (op_Const, op_APut),
+]
+
+
+class Superinstruction(object):
+    """Consecutive instructions executed at once, quacks like an Instruction."""
+    handler = None
+    args = ()
+
+    def __init__(self, parts, function):
+        self.parts = parts        # the fused Instruction objects
+        self.function = function  # executes all of them
+        self.text = ' / '.join(part.text for part in parts)
+
+    def execute(self, vm):
+        try:
+            self.function(vm)
+        except Exception as e:
+            vm.exception(e)
+
+    def compile(self):
+        return self.function
+
+    def __repr__(self):
+        return 'Superinstruction({!r})'.format(self.text)
+
+
+def add_pattern(pattern):
+    """Add a sequence of opcode handler classes to the fusion table."""
+    pattern = tuple(pattern)
+    if pattern not in FUSION_TABLE:
+        FUSION_TABLE.append(pattern)
+        FUSION_TABLE.sort(key=len, reverse=True)
+
+
+def is_straight(instruction):
+    """True if the instruction always falls through to the next one."""
+    handler = instruction.handler
+    return (handler is not None and not handler.label_operands
+            and not isinstance(handler, (op_Return, op_PackedSwitch)))
+
+
+def sequence(instructions, targets, start, length):
+    """Indexes of the `length` instructions starting at `start`, None if a
+    label (one of the `targets`) or the end of the method comes first."""
+    positions = list(range(start, start + length))
+    if positions[-1] >= len(instructions) or any(index in targets for index in positions[1:]):
+        return None
+    return positions
+
+
+def match(instructions, targets, start, table):
+    """Return the indexes of the longest pattern matching at start."""
+    for pattern in table:
+        positions = sequence(instructions, targets, start, len(pattern))
+        if positions is None:
+            continue
+        parts = [instructions[index] for index in positions]
+        if (all(type(part.handler) is kind for part, kind in zip(parts, pattern))
+                and all(is_straight(part) for part in parts[:-1])):
+            return positions
+    return None
+
+
+def fuse(instructions, labels, table=None):
+    """Return a copy of the instruction list where each fused sequence is
+    replaced, at the index of its first instruction, by a Superinstruction.
+    The other instructions of the sequence stay in place."""
+    table = FUSION_TABLE if table is None else table
+    targets = set(labels.values())
+    fused = list(instructions)
+    index = 0
+    while index < len(instructions):
+        positions = match(instructions, targets, index, table)
+        if positions is None:
+            index += 1
+            continue
+        parts = [instructions[position] for position in positions]
+        function = smali.compiler.compile_sequence(parts, positions)
+        if function is not None:
+            fused[index] = Superinstruction(parts, function)
+        index = positions[-1] + 1
+    return fused
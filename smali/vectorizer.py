@@ -0,0 +1,536 @@
+# -*- coding: utf-8 -*-
+# This file is part of the Smali Emulator.
+#
+# This file may be licensed under the terms of of the
+# GNU General Public License Version 3 (the ``GPL'').
+#
+# Software distributed under the License is distributed
+# on an ``AS IS'' basis, WITHOUT WARRANTY OF ANY KIND, either
+# express or implied. See the GPL for the specific language
+# governing rights and limitations.
+#
+# You should have received a copy of the GPL along with this
+# program. If not, go to http://www.gnu.org/licenses/gpl.html
+# or write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""
+Vectorized execution of array transform loops.
+
+Counted loops of the shape
+
+    :loop
+    if-ge vI, vN, :end
+    ...     straight-line code loading array elements and computing
+    ...     values stored with aput at the index vI
+    add-int/lit8 vI, vI, 0x1
+    goto :loop
+
+are recognized in the decoded method and run as a whole, every instruction
+of the body being applied to all the iterations at once. Only this shape is
+recognized: loops testing their exit at the bottom, or with another test
+than if-ge at the top, run instruction by instruction. The arrays are NumPy
+arrays when NumPy is installed (the ``vector`` extra), plain lists otherwise.
+
+Nothing is written before the loop is known to run as it would instruction
+by instruction: indexes in bounds, arrays holding only ints or only chars,
+no array both read and written, no value depending on a previous iteration.
+Every instruction of the body is checked, including those whose value is
+overwritten later in the iteration. Otherwise the loop runs instruction by
+instruction.
+"""
+import operator
+
+from smali.opcodes import (
+    op_AddInt,
+    op_AddInt2Addr,
+    op_AddIntLit,
+    op_Aget,
+    op_AndInt,
+    op_AndIntLit,
+    op_APut,
+    op_ArrayLength,
+    op_Const,
+    op_GoTo,
+    op_IfGe,
+    op_IntToType,
+    op_Move,
+    op_OrInt,
+    op_OrIntLiteral,
+    op_RemInt,
+    op_RemIntLit,
+    op_SubInt,
+    op_SubInt2Addr,
+    op_XorInt2Addr,
+    op_XorIntLit,
+)
+
+try:
+    import numpy
+except ImportError:  # optional, the lists operations are used instead
+    numpy = None
+
+# loops with fewer iterations are not worth the setup
+MIN_ITERATIONS = 16
+
+# array elements are limited to this magnitude so that no operation of the
+# body overflows the 64 bits integers of NumPy
+ELEMENT_LIMIT = 2 ** 31
+VALUE_LIMIT = 2 ** 62
+
+
+class NotVectorizable(Exception):
+    pass
+
+
+# Expression nodes, built from the loop body.
+INDEX = ('index',)
+
+
+def invariant(slot):
+    return ('invariant', slot)
+
+
+def constant(value):
+    return ('const', value)
+
+
+# Loop body instructions: handler -> (position of the destination register
+# operand, function building the node of the value it stores). The
+# function receives `read`, returning the node of a register slot.
+RULES = {
+    op_Const: (0, lambda read, vx, lit: constant(lit)),
+    op_Move: (1, lambda read, is_from, vx, vy: read(vy)),
+    op_ArrayLength: (0, lambda read, vx, vy: ('len', read(vy))),
+    op_Aget: (0, lambda read, vx, vy, vz: ('load', read(vy), read(vz))),
+    op_AddIntLit: (0, lambda read, vx, vy, lit: ('add', read(vy), constant(lit))),
+    op_XorIntLit: (0, lambda read, vx, vy, lit: ('xor_any', read(vy), constant(lit))),
+    op_OrIntLiteral: (1, lambda read, size, vx, vy, lit: ('or_any', read(vy), constant(lit))),
+    op_XorInt2Addr: (0, lambda read, vx, vy: ('xor', read(vx), read(vy))),
+    op_AndIntLit: (0, lambda read, vx, vy, lit: ('and', read(vy), constant(lit))),
+    op_RemIntLit: (0, lambda read, vx, vy, lit: ('rem', read(vy), constant(lit))),
+    op_AddInt: (0, lambda read, vx, vy, vz: ('add', read(vy), read(vz))),
+    op_SubInt: (0, lambda read, vx, vy, vz: ('sub', read(vy), read(vz))),
+    op_AndInt: (0, lambda read, vx, vy, vz: ('and', read(vy), read(vz))),
+    op_OrInt: (0, lambda read, vx, vy, vz: ('or', read(vy), read(vz))),
+    op_RemInt: (0, lambda read, vx, vy, vz: ('rem', read(vy), read(vz))),
+    op_AddInt2Addr: (0, lambda read, vx, vy: ('add', read(vy), read(vx))),
+    op_SubInt2Addr: (0, lambda read, vx, vy: ('sub', read(vx), read(vy))),
+    op_IntToType: (1, lambda read, ctype, vx, vy: ('to_' + ctype, read(vy))),
+}
+
+# operations on int values only, as the opcodes raise or do something else
+# with chars (e.g. int('5'))
+INT_OPERATIONS = {
+    'add': operator.add,
+    'sub': operator.sub,
+    'and': operator.and_,
+    'or': operator.or_,
+    'rem': operator.mod,
+}
+
+# operations accepting chars by their code, on the second operand for xor
+ANY_OPERATIONS = {
+    'xor_any': operator.xor,
+    'or_any': operator.or_,
+    'xor': operator.xor,
+}
+
+CONVERSIONS = {
+    'to_char': 0xFFFF,
+    'to_int': 0xFFFFFFFF,
+    'to_byte': 0xFF,
+}
+
+
+class ListOperations(object):
+    """Array operations on lists of Python ints."""
+    @staticmethod
+    def arange(start, stop):
+        return list(range(start, stop))
+
+    @staticmethod
+    def array(values):
+        return values
+
+    @staticmethod
+    def is_array(values):
+        return isinstance(values, list)
+
+    @staticmethod
+    def take(values, index):
+        if isinstance(index, list):
+            return [values[position] for position in index]
+        return values[index]
+
+    @staticmethod
+    def binary(function, a, b):
+        if isinstance(a, list):
+            if isinstance(b, list):
+                return [function(x, y) for x, y in zip(a, b)]
+            return [function(x, b) for x in a]
+        if isinstance(b, list):
+            return [function(a, y) for y in b]
+        return function(a, b)
+
+    @staticmethod
+    def bounds(values):
+        if isinstance(values, list):
+            return min(values), max(values)
+        return values, values
+
+    @staticmethod
+    def tolist(values, count):
+        if isinstance(values, list):
+            return values
+        return [values] * count
+
+
+class NumpyOperations(ListOperations):
+    """Array operations on NumPy arrays of 64 bits ints."""
+    @staticmethod
+    def arange(start, stop):
+        return numpy.arange(start, stop, dtype=numpy.int64)
+
+    @staticmethod
+    def array(values):
+        return numpy.array(values, dtype=numpy.int64)
+
+    @staticmethod
+    def is_array(values):
+        return isinstance(values, numpy.ndarray)
+
+    @staticmethod
+    def take(values, index):
+        return values[index]
+
+    @staticmethod
+    def binary(function, a, b):
+        return function(a, b)
+
+    @staticmethod
+    def bounds(values):
+        if isinstance(values, numpy.ndarray):
+            return int(values.min()), int(values.max())
+        return int(values), int(values)
+
+    @staticmethod
+    def tolist(values, count):
+        if isinstance(values, numpy.ndarray):
+            return values.tolist()
+        return [int(values)] * count
+
+
+OPERATIONS = NumpyOperations() if numpy is not None else ListOperations()
+
+
+class VectorLoop(object):
+    """A recognized loop and the nodes of its body."""
+    def __init__(self, header, back_edge, exit, index, limit, assignments, stores, nodes=()):
+        self.header = header        # index of the if-ge, the goto target
+        self.back_edge = back_edge  # index of the goto
+        self.exit = exit            # index the if-ge jumps to
+        self.index = index          # slot of vI
+        self.limit = limit          # slot of vN
+        self.assignments = assignments  # slot -> node of its last value
+        self.stores = stores        # (array node, value node) stored at vI
+        self.nodes = nodes          # every node of the body, in order
+
+    def run(self, vm, operations=None):
+        """Run the whole loop from its header, return False and leave the vm
+        untouched if it can not be done at once."""
+        registers = vm.registers
+        start, stop = registers[self.index], registers[self.limit]
+        if type(start) is not int or type(stop) is not int:
+            return False
+        if stop - start < MIN_ITERATIONS:
+            return False
+        try:
+            evaluation = Evaluation(registers, start, stop, operations or OPERATIONS)
+            for node in self.nodes:  # overwritten values may raise too
+                evaluation.evaluate(node)
+            stores = [
+                (evaluation.array(array), evaluation.stored(value))
+                for array, value in self.stores
+            ]
+            values = {
+                slot: evaluation.last(node)
+                for slot, node in self.assignments.items()
+            }
+            evaluation.check_aliasing([array for array, _ in stores])
+        except (NotVectorizable, ArithmeticError, TypeError, ValueError, IndexError):
+            return False
+
+        for array, elements in stores:
+            array[start:stop] = elements
+        for slot, value in values.items():
+            registers[slot] = value
+        registers[self.index] = stop
+        vm.pc = self.exit
+        # the instructions of the iterations, the header exiting the loop is
+        # counted by the run loop dispatching it
+        vm.emu.charge((stop - start) * (self.back_edge - self.header + 1))
+        return True
+
+
+class Evaluation(object):
+    """Values of the nodes of a loop body for the iterations start..stop."""
+    def __init__(self, registers, start, stop, operations):
+        self.registers = registers
+        self.start = start
+        self.stop = stop
+        self.operations = operations
+        self.values = {}    # id(node) -> (values, kind)
+        self.elements = {}  # id(array) -> (elements, kind)
+        self.loaded = []    # arrays read by the loop
+
+    def array(self, node):
+        """The list an array node refers to, stored at the loop index."""
+        values, kind = self.evaluate(node)
+        if kind != 'array' or self.start < 0 or self.stop > len(values):
+            raise NotVectorizable(node)
+        return values
+
+    def stored(self, node):
+        """The list of the values stored by the loop for a value node."""
+        values, kind = self.evaluate(node)
+        count = self.stop - self.start
+        if kind == 'array':
+            return [values] * count
+        values = self.operations.tolist(values, count)
+        return [chr(value) for value in values] if kind == 'char' else values
+
+    def last(self, node):
+        """Value of a node at the last iteration."""
+        values, kind = self.evaluate(node)
+        if kind == 'array':
+            return values
+        if self.operations.is_array(values):
+            values = values[-1]
+        return chr(values) if kind == 'char' else int(values)
+
+    def check_aliasing(self, stored):
+        if any(array is loaded for array in stored for loaded in self.loaded):
+            raise NotVectorizable('array read and written')
+
+    def evaluate(self, node):
+        key = id(node)
+        if key not in self.values:
+            self.values[key] = self.compute(node)
+        return self.values[key]
+
+    def compute(self, node):
+        operations = self.operations
+        kind = node[0]
+        if kind == 'index':
+            return operations.arange(self.start, self.stop), 'int'
+        if kind == 'const':
+            return node[1], 'int'
+        if kind == 'invariant':
+            return self.register(self.registers[node[1]])
+        if kind == 'len':
+            return len(self.evaluate_array(node[1])), 'int'
+        if kind == 'load':
+            array = self.evaluate_array(node[1])
+            index = self.evaluate_int(node[2])
+            low, high = operations.bounds(index)
+            if low < 0 or high >= len(array):
+                raise NotVectorizable('index out of bounds')
+            elements, element_kind = self.array_elements(array)
+            return operations.take(elements, index), element_kind
+        if kind in INT_OPERATIONS:
+            a, b = self.evaluate_int(node[1]), self.evaluate_int(node[2])
+            if kind == 'rem':
+                low, high = operations.bounds(b)
+                if low <= 0 <= high:
+                    raise NotVectorizable('division by zero')
+            return self.limited(operations.binary(INT_OPERATIONS[kind], a, b)), 'int'
+        if kind in ANY_OPERATIONS:
+            if kind == 'xor':
+                a = self.evaluate_int(node[1])
+            else:
+                a = self.evaluate_code(node[1])
+            b = self.evaluate_code(node[2])
+            return operations.binary(ANY_OPERATIONS[kind], a, b), 'int'
+        if kind in CONVERSIONS:
+            value = self.evaluate_int(node[1])
+            if kind == 'to_byte':  # struct.pack('>i', value) must succeed
+                low, high = operations.bounds(value)
+                if low < -ELEMENT_LIMIT or high >= ELEMENT_LIMIT:
+                    raise NotVectorizable('not an int')
+            value = operations.binary(operator.and_, value, CONVERSIONS[kind])
+            return value, 'char' if kind == 'to_char' else 'int'
+        raise NotVectorizable(node)
+
+    def register(self, value):
+        if type(value) is int:
+            return value, 'int'
+        if isinstance(value, str) and len(value) == 1:
+            return ord(value), 'char'
+        if isinstance(value, list):
+            return value, 'array'
+        raise NotVectorizable(value)
+
+    def evaluate_array(self, node):
+        values, kind = self.evaluate(node)
+        if kind != 'array':
+            raise NotVectorizable(node)
+        return values
+
+    def evaluate_int(self, node):
+        values, kind = self.evaluate(node)
+        if kind != 'int':
+            raise NotVectorizable(node)
+        return values
+
+    def evaluate_code(self, node):
+        """Value of an int or a char node, chars by their code."""
+        values, kind = self.evaluate(node)
+        if kind not in ('int', 'char'):
+            raise NotVectorizable(node)
+        return values
+
+    def limited(self, values):
+        low, high = self.operations.bounds(values)
+        if low <= -VALUE_LIMIT or high >= VALUE_LIMIT:
+            raise NotVectorizable('overflow')
+        return values
+
+    def array_elements(self, array):
+        key = id(array)
+        if key not in self.elements:
+            self.loaded.append(array)
+            if all(type(value) is int for value in array):
+                codes, kind = array, 'int'
+            elif all(isinstance(value, str) and len(value) == 1 for value in array):
+                codes, kind = [ord(value) for value in array], 'char'
+            else:
+                raise NotVectorizable('mixed array')
+            if codes and (min(codes) < -ELEMENT_LIMIT or max(codes) >= ELEMENT_LIMIT):
+                raise NotVectorizable('element too large')
+            self.elements[key] = self.operations.array(codes), kind
+        return self.elements[key]
+
+
+class LoopInstruction(object):
+    """Header of a recognized loop, quacks like an Instruction.
+
+    Runs the whole loop if it can, the header instruction otherwise. Once
+    declined for a vm, the loop is not tried again until it exits so that it
+    does not get tried on each iteration."""
+    args = ()
+
+    def __init__(self, loop, header):
+        self.loop = loop
+        self.header = header  # the if-ge Instruction
+        self.handler = header.handler
+        self.text = header.text
+        self.declined = None  # vm running the loop one instruction at a time
+
+    def execute(self, vm):
+        if self.declined is not vm:
+            if self.loop.run(vm):
+                return
+            self.declined = vm
+        self.header.execute(vm)
+        if vm.pc == self.loop.exit:
+            self.declined = None
+
+    def compile(self):
+        header = self.header.compile()
+        run, exit = self.loop.run, self.loop.exit
+
+        def vector_loop(vm):
+            if self.declined is not vm:
+                if run(vm):
+                    return
+                self.declined = vm
+            header(vm)
+            if vm.pc == exit:
+                self.declined = None
+        return vector_loop
+
+    def __repr__(self):
+        return 'LoopInstruction({!r})'.format(self.text)
+
+
+def recognize(instructions, labels, back_edge):
+    """Return the VectorLoop closed by the goto at `back_edge`, or None."""
+    header = instructions[back_edge].args[0]
+    if header >= back_edge or type(instructions[header].handler) is not op_IfGe:
+        return None
+    index, limit, exit = instructions[header].args
+    if not isinstance(exit, int) or exit <= back_edge:
+        return None
+    if any(header < target <= back_edge for target in labels.values()):
+        return None  # entered from elsewhere or a try/catch boundary
+
+    body = instructions[header + 1:back_edge]
+    if not body or type(body[-1].handler) is not op_AddIntLit \
+            or tuple(body[-1].args) != (index, index, 1):
+        return None
+    body = body[:-1]
+
+    written = set()
+    for instruction in body:
+        rule = RULES.get(type(instruction.handler))
+        if rule is not None and rule[0] is not None:
+            written.add(instruction.args[rule[0]])
+    if index in written or limit in written:
+        return None
+
+    assignments = {}
+    stores = []
+    nodes = []
+
+    def read(slot):
+        if slot in assignments:
+            return assignments[slot]
+        if slot == index:
+            return INDEX
+        if slot in written:  # value of the previous iteration
+            raise NotVectorizable(slot)
+        return invariant(slot)
+
+    try:
+        for instruction in body:
+            handler, args = instruction.handler, instruction.args
+            if type(handler) is op_APut:
+                value, array, position = args
+                if read(position) is not INDEX:
+                    return None
+                stores.append((read(array), read(value)))
+                nodes.extend(stores[-1])
+                continue
+            rule = RULES.get(type(handler))
+            if rule is None:
+                return None
+            destination, build = rule
+            assignments[args[destination]] = build(read, *args)
+            nodes.append(assignments[args[destination]])
+    except NotVectorizable:
+        return None
+    if not stores:
+        return None
+    return VectorLoop(header, back_edge, exit, index, limit, assignments, stores, nodes)
+
+
+def find_loops(instructions, labels):
+    """Map the index of the header of each recognized loop to its
+    VectorLoop. Only loops closed by a goto back to an if-ge header are
+    candidates, see the module docstring."""
+    loops = {}
+    for position, instruction in enumerate(instructions):
+        if type(instruction.handler) is op_GoTo:
+            loop = recognize(instructions, labels, position)
+            if loop is not None:
+                loops[loop.header] = loop
+    return loops
+
+
+def vectorize(instructions, loops):
+    """Return a copy of the instruction list with a LoopInstruction at the
+    header of each loop."""
+    instructions = list(instructions)
+    for header, loop in loops.items():
+        instructions[header] = LoopInstruction(loop, instructions[header])
+    return instructions
@@ -19,7 +19,9 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
 import re
-import copy
+import sys
+import smali.emulator
+import smali.events
 import smali.parser
 
 
@@ -32,70 +34,167 @@ class MethodUnavailable(Exception):
     pass
 
 
+class Unset(object):
+    """Value of a named register which was never written."""
+    def __repr__(self):
+        return 'Unset'
+
+
+UNSET = Unset()
+
+
+class Frame(object):
+    """A suspended method: its register file, the index of its next
+    instruction, its decoded code and its return slot."""
+    __slots__ = ('registers', 'pc', 'code', 'return_v')
+
+    def __init__(self, registers, pc, code, return_v):
+        self.registers = registers
+        self.pc = pc
+        self.code = code
+        self.return_v = return_v
+
+
 class VM(object):
     """The virtual machine used by the emulator.
 
-    A new virtual machine must be use for each frame!.
+    The registers of the running method live in the `registers` list, indexed
+    by the slots the decoder resolved the register operands to. Accessing the
+    vm by name (`vm['v0']`) goes through the `slots` of the method layout,
+    names which are not registers (static fields) are kept in `variables`.
+
+    Calling a method suspends the running one in a Frame on the `frames`
+    stack, see `push_frame` and `pop_frame`.
     """
     LOCAL_VAR_NAME_PATTERN = re.compile('(p|v)\d+')
+    REGISTER_NAME_PATTERN = re.compile(r'^([pv])(\d+)$')
 
     def __init__(self, emulator):
 
         # we need the emulator instance in order to call its 'fatal' method.
         # also, we are going to store the set of loaded classes into this object
         self.emu = emulator
-        self.labels = {}  # map of jump labels to opcodes offsets
         self.variables = {}  # variables container
-        self.catch_blocks = []  # try/catch blocks container with opcodes offsets
-        self.packed_switches = {}  # packed switches containers
-        self.array_data = {}  # array data blocks
+        self.registers = []  # register file of the running method
+        self.slots = {}  # register name -> index in `registers`
+        self.locals = 0  # number of local registers, pN follow them
+        self.named = ()  # registers not following the vN/pN convention
+        self.code = None  # DecodedMethod of the running method
+        self.frames = []  # suspended callers of the running method
+        self.catch_blocks = ()  # HandlerTable of the running method
         self.exceptions = []  # list of thrown exceptions
         self.result = None  # holds the result of the last method invocation
         self.return_v = None  # holds the return value of the method ( used by return-* opcodes )
         self.stop = False  # set to true when a return-* opcode is executed
         self.pc = 0  # current opcode index
+        self.checkpoint = sys.maxsize  # steps count at which the budget of the run is checked
 
     def __getitem__(self, name):
-        return self.variables[name]
+        if name.__class__ is int:
+            return self.registers[name]
+        slot = self.slots.get(name)
+        if slot is None:
+            return self.variables[name]
+        return self.registers[slot]
 
     def __setitem__(self, name, value):
-        self.variables[name] = value
+        if name.__class__ is int:
+            self.registers[name] = value
+            return
+        slot = self.slot(name)
+        if slot is None:
+            self.variables[name] = value
+        else:
+            self.registers[slot] = value
+
+    def slot(self, name):
+        """Return the slot of a register name, None if it is not a register.
+
+        vN and pN registers the method does not use get a slot on first use."""
+        slot = self.slots.get(name)
+        if slot is None:
+            match = self.REGISTER_NAME_PATTERN.match(name)
+            if match is None:
+                return None
+            number = int(match.group(2))
+            slot = number if match.group(1) == 'v' else self.locals + number
+            self.slots = dict(self.slots)  # the layout ones are shared
+            self.slots[name] = slot
+            if slot >= len(self.registers):
+                self.registers.extend([None] * (slot + 1 - len(self.registers)))
+        return slot
+
+    def allocate(self, layout):
+        """Set up the register file of a method from its RegisterLayout."""
+        self.registers = [None] * layout.size
+        self.slots = layout.slots
+        self.locals = layout.locals
+        self.named = layout.named
+        for name in layout.named:
+            # keep the value given before the method runs, if any
+            self.registers[layout.slots[name]] = self.variables.pop(name, UNSET)
+
+    def push_frame(self, code, arguments=()):
+        """Suspend the running method and start `code`, a DecodedMethod, its
+        parameter registers holding the `arguments` values."""
+        self.frames.append(Frame(self.registers, self.pc, self.code, self.return_v))
+        self.allocate(code.layout)
+        start = code.layout.locals
+        self.registers[start:start + len(arguments)] = arguments
+        self.code = code
+        self.catch_blocks = code.catch_blocks
+        self.pc = 0
+        self.return_v = None
+        self.stop = False
+
+    def pop_frame(self):
+        """Resume the caller of the running method, return the value the
+        method returned."""
+        result = self.return_v
+        frame = self.frames.pop()
+        self.registers, self.pc, self.code = frame.registers, frame.pc, frame.code
+        self.return_v = frame.return_v
+        if frame.code is None:
+            self.slots, self.locals, self.named, self.catch_blocks = {}, 0, (), ()
+        else:
+            layout = frame.code.layout
+            self.slots, self.locals, self.named = layout.slots, layout.locals, layout.named
+            self.catch_blocks = frame.code.catch_blocks
+        self.stop = False
+        return result
 
     def fatal(self, message):
         self.emu.fatal(message)
 
-    def goto(self, label):
-        self.pc = self.labels[label]
-
     def exception(self, e):
+        if isinstance(e, (smali.emulator.BudgetExceeded, smali.emulator.StackOverflow)):
+            raise e  # ends the run, whatever the catch blocks
         self.exceptions.append(e)
 
         # check if this operation is surrounded by a try/catch block
-        for block in self.catch_blocks:
-            start, end, label = block
-            if start <= self.pc <= end:
-                self.goto(label)
-                return
+        # vm.pc follows the failed instruction
+        target = self.catch_blocks.find(self.pc - 1, e) if self.catch_blocks else None
+        hooks = self.emu.hooks
+        if hooks.active:
+            hooks.fire(smali.events.EXCEPTION, self, self.code, self.pc - 1,
+                       target=target, exception=e)
+        if target is not None:
+            self.pc = target
+            return
 
         # nope, report unhandled exception
         self.emu.fatal("Unhandled exception '%s'." % str(e) )
 
     def new_instance(self, klass):
         class_name = klass if klass else 'empty'
-        java_class_name = smali.parser.extract_class_name(klass) if klass else 'empty'
 
         """Fix This; the new-instance opcode should be resolved according to the base class
         being given on the line. Then the class resolver contained in the emulator member
         must be used to resolve the base class, then invoke the corresponding new_instance
         method."""
 
-        if java_class_name in self.emu.class_loader.loaded_classes:
-            java_class = self.emu.class_loader.loaded_classes[java_class_name]
-
-        elif class_name in self.emu.class_loader.loaded_classes:
-            java_class = self.emu.class_loader.loaded_classes[class_name]
-
-        else:
+        java_class = self.emu.class_loader.find_class(class_name)
+        if java_class is None:
             raise MethodUnavailable("Could not find method {}".format(class_name))
 
         return java_class()
@@ -115,24 +214,10 @@ class VM(object):
     def is_local_variable(cls, var):
         return cls.LOCAL_VAR_NAME_PATTERN.match(var)
 
-    def get_new_frame(self):
-        new_vm = VM(self.emu)
-        new_vm.variables = self.backup_local_variables()
-        return new_vm
-
-    def clean_vm(self):
-        self.clean_local_variables()
-        self.stop = False
-        self.pc = 0  # start line number for running source code
-
-    def clean_local_variables(self):
-        backup = self.backup_local_variables()
-        [self.variables.pop(key) for key in backup]
-        return backup
-
-    def backup_local_variables(self):
-        return {key: value for key, value in self.variables.items() if self.is_local_variable(key)}
-
-
-
-
+    def save_named(self):
+        """Copy the registers named outside of the vN/pN convention to
+        `variables`, where they stay readable by name."""
+        for name in self.named:
+            value = self.registers[self.slots[name]]
+            if value is not UNSET:
+                self.variables[name] = value
@@ -0,0 +1,72 @@
+import os
+import shutil
+
+import pytest
+
+import smali.cache
+import smali.classloader
+import smali.emulator
+import smali.parser
+
+from tests.test_scripting_api import get_file_path
+
+DB_INTERFACE = get_file_path('completeclass', 'db_interface_0x000a.smali')
+EXPECTED = u"7C5C0EF672A277BC964A193201C7EB977CF0991A3B02A5F8ED9D1029833E2F30"
+
+
+def run(cl, path):
+    loaded_class = cl.load_class(path)
+    new_object = loaded_class(emulator=smali.emulator.Emulator(class_loader=cl))
+    new_object.invoke('<clinit>()V', {})
+    return new_object.invoke('a(III)Ljava/lang/String;', {'p0': 0x4, 'p1': 362, 'p2': 0})
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_classes_are_loaded_from_their_image(backend, tmp_path, monkeypatch):
+    cache = str(tmp_path / 'cache')
+    assert run(smali.classloader.ClassLoader(cache=cache, backend=backend), DB_INTERFACE) == EXPECTED
+    assert len(os.listdir(cache)) == 1
+
+    def parse(*args):
+        raise AssertionError("parsed again")
+    monkeypatch.setattr(smali.parser, 'scan_class', parse)
+    cl = smali.classloader.ClassLoader(cache=cache, backend=backend)
+    assert run(cl, DB_INTERFACE) == EXPECTED
+    loaded_class = cl.load_class(DB_INTERFACE)
+    assert all(method.decoded is not None for method in loaded_class.parsed_class.methods)
+    assert loaded_class.parsed_class.filepath == DB_INTERFACE
+
+
+def test_changed_or_unreadable_images_are_parsed_again(tmp_path):
+    path = str(tmp_path / 'Class.smali')
+    shutil.copy(DB_INTERFACE, path)
+    cache = smali.cache.ClassCache(str(tmp_path / 'cache'))
+    cache.load(path)
+    with open(path, 'a') as fd:
+        fd.write('\n# changed\n')
+    cache.load(path)
+    images = sorted(os.listdir(cache.directory))
+    assert len(images) == 2
+    for image in images:
+        with open(os.path.join(cache.directory, image), 'wb') as fd:
+            fd.write(b'truncated')
+    assert run(smali.classloader.ClassLoader(cache=cache), path) == EXPECTED
+    assert sorted(os.listdir(cache.directory)) == images
+
+
+def test_a_tree_is_warmed_up(tmp_path):
+    cache = smali.cache.ClassCache(str(tmp_path / 'cache'))
+    tree = os.path.dirname(DB_INTERFACE)
+    count = cache.warm(tree)
+    assert count == len([name for name in os.listdir(tree) if name.endswith('.smali')])
+    # files of the same content share their image
+    assert 0 < len(os.listdir(cache.directory)) <= count
+
+
+def test_a_tree_is_warmed_up_in_the_order_it_is_loaded(tmp_path, monkeypatch):
+    cache = smali.cache.ClassCache(str(tmp_path / 'cache'))
+    tree = os.path.dirname(os.path.dirname(DB_INTERFACE))
+    loaded = []
+    monkeypatch.setattr(cache, 'load', loaded.append)
+    assert cache.warm(tree) == len(loaded)
+    assert loaded == list(smali.classloader.smali_files(tree))
@@ -0,0 +1,262 @@
+import os
+
+import pytest
+
+import smali.classloader
+import smali.emulator
+import smali.objects
+import smali.opcodes
+
+MAIN = """.class public Lcom/example/Main;
+.super Ljava/lang/Object;
+
+.method public static run(I)I
+    .locals 1
+
+    sget v0, Lcom/example/Keys;->key:I
+
+    add-int/2addr v0, p0
+
+    invoke-static {v0}, Lcom/example/util/Twice;->twice(I)I
+
+    move-result v0
+
+    return v0
+.end method
+"""
+
+KEYS = """.class public final Lcom/example/Keys;
+.super Ljava/lang/Object;
+
+.field public static key:I
+
+.method static constructor <clinit>()V
+    .locals 1
+
+    const/16 v0, 0x10
+
+    sput v0, Lcom/example/Keys;->key:I
+
+    return-void
+.end method
+"""
+
+TWICE = """.class public Lcom/example/util/Twice;
+.super Ljava/lang/Object;
+
+.method public static twice(I)I
+    .locals 1
+
+    mul-int/lit8 v0, p0, 0x2
+
+    return v0
+.end method
+"""
+
+SHAPE = """.class public Lcom/example/Shape;
+.super Ljava/lang/Object;
+
+.method public constructor <init>()V
+    .locals 0
+
+    invoke-direct {p0}, Ljava/lang/Object;-><init>()V
+
+    return-void
+.end method
+
+.method public area()I
+    .locals 1
+
+    const/4 v0, 0x1
+
+    return v0
+.end method
+
+.method public describe()I
+    .locals 1
+
+    invoke-virtual {p0}, Lcom/example/Shape;->area()I
+
+    move-result v0
+
+    add-int/lit8 v0, v0, 0x64
+
+    return v0
+.end method
+"""
+
+NAMED = """.class public interface abstract Lcom/example/Named;
+.super Ljava/lang/Object;
+
+.method public abstract name()I
+.end method
+"""
+
+SQUARE = """.class public Lcom/example/Square;
+.super Lcom/example/Shape;
+.implements Lcom/example/Named;
+
+.method public constructor <init>()V
+    .locals 0
+
+    invoke-direct {p0}, Lcom/example/Shape;-><init>()V
+
+    return-void
+.end method
+
+.method public area()I
+    .locals 1
+
+    const/4 v0, 0x4
+
+    return v0
+.end method
+
+.method public name()I
+    .locals 1
+
+    const/4 v0, 0x7
+
+    return v0
+.end method
+
+.method public base()I
+    .locals 1
+
+    invoke-super {p0}, Lcom/example/Shape;->area()I
+
+    move-result v0
+
+    return v0
+.end method
+"""
+
+SHAPES = """.class public Lcom/example/Shapes;
+.super Ljava/lang/Object;
+
+.method public static run()I
+    .locals 3
+
+    new-instance v0, Lcom/example/Square;
+
+    invoke-direct {v0}, Lcom/example/Square;-><init>()V
+
+    invoke-virtual {v0}, Lcom/example/Shape;->describe()I
+
+    move-result v1
+
+    invoke-interface {v0}, Lcom/example/Named;->name()I
+
+    move-result v2
+
+    add-int/2addr v1, v2
+
+    invoke-virtual {v0}, Lcom/example/Square;->base()I
+
+    move-result v2
+
+    add-int/2addr v1, v2
+
+    new-instance v0, Lcom/example/Shape;
+
+    invoke-direct {v0}, Lcom/example/Shape;-><init>()V
+
+    invoke-virtual {v0}, Lcom/example/Shape;->describe()I
+
+    move-result v2
+
+    add-int/2addr v1, v2
+
+    return v1
+.end method
+"""
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """apktool-like tree, one of the classes in a file not named after it."""
+    for path, source in (('smali/com/example/Main.smali', MAIN),
+                         ('smali/com/example/Keys.smali', KEYS),
+                         ('smali_classes2/com/example/util/a.smali', TWICE),
+                         ('smali/com/example/Unused.smali', '.class public Lcom/example/Unused;\n'),
+                         ('shapes/Shape.smali', SHAPE), ('shapes/Named.smali', NAMED),
+                         ('shapes/Square.smali', SQUARE), ('shapes/Shapes.smali', SHAPES)):
+        path = tmp_path / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(source)
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_classes_are_loaded_on_first_use(tree, backend):
+    cl = smali.classloader.ClassLoader(root=os.path.join(tree, 'smali'), backend=backend)
+    cl.index(os.path.join(tree, 'smali_classes2'))
+    assert sorted(cl.class_paths) == [
+        'Lcom/example/Keys;', 'Lcom/example/Main;', 'Lcom/example/Unused;',
+        'Lcom/example/util/Twice;',
+    ]
+    assert not any(name.startswith('Lcom/example/') for name in cl.loaded_classes)
+    main = cl.find_class('Lcom/example/Main;')
+    new_object = main(emulator=smali.emulator.Emulator(class_loader=cl))
+    assert new_object.invoke('run(I)I', {'p0': 5}) == 42
+    assert new_object.invoke('run(I)I', {'p0': 1}) == 34
+    assert sorted(name for name in cl.loaded_classes if name.startswith('Lcom/example/')) == [
+        'Lcom/example/Keys;', 'Lcom/example/Main;', 'Lcom/example/util/Twice;',
+    ]
+    assert cl.initialized == {'Lcom/example/Keys;'}
+
+
+def test_unknown_classes_are_still_unavailable(tree):
+    cl = smali.classloader.ClassLoader(root=tree)
+    assert cl.find_class('Lcom/example/Missing;') is None
+    emulator = smali.emulator.Emulator(class_loader=cl)
+    with pytest.raises(smali.opcodes.UnavailableClass):
+        smali.opcodes.op_Invoke.resolve_static(emulator.vm, 'Lcom/example/Missing', 'f()V')
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_classes_are_loaded_in_bulk(tree, workers, tmp_path):
+    cache = str(tmp_path / 'cache')
+    cl = smali.classloader.ClassLoader(cache=cache)
+    filenames = [filename for directory in ('smali', 'smali_classes2')
+                 for filename in smali.classloader.smali_files(os.path.join(tree, directory))]
+    classes = cl.load_classes(filenames, workers=workers)
+    assert [loaded_class.__name__ for loaded_class in classes] == [
+        'Lcom/example/Keys;', 'Lcom/example/Main;', 'Lcom/example/Unused;',
+        'Lcom/example/util/Twice;',
+    ]
+    assert all(cl.loaded_classes[loaded_class.__name__] is loaded_class for loaded_class in classes)
+    assert [loaded_class.parsed_class.filepath for loaded_class in classes] == filenames
+    assert all(method.decoded is not None
+               for loaded_class in classes for method in loaded_class.parsed_class.methods)
+    new_object = classes[1](emulator=smali.emulator.Emulator(class_loader=cl))
+    assert new_object.invoke('run(I)I', {'p0': 5}) == 42
+
+    # the second time the images come from the cache
+    assert len(os.listdir(cache)) == 4
+    cl = smali.classloader.ClassLoader(cache=cache)
+    classes = cl.load_classes(filenames, workers=workers)
+    assert [loaded_class.parsed_class.filepath for loaded_class in classes] == filenames
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_virtual_calls_dispatch_through_the_class_hierarchy(tree, backend):
+    cl = smali.classloader.ClassLoader(root=os.path.join(tree, 'shapes'), backend=backend)
+    shapes = cl.find_class('Lcom/example/Shapes;')
+    new_object = shapes(emulator=smali.emulator.Emulator(class_loader=cl))
+    # 4 + 100 overridden, 7 by the interface, 1 from the superclass, 1 + 100
+    assert new_object.invoke('run()I', {}) == 213
+
+    shape, square = cl.find_class('Lcom/example/Shape;'), cl.find_class('Lcom/example/Square;')
+    slot = shape.vtable_slots()['area()I']
+    assert square.vtable_slots()['area()I'] == slot
+    assert square.vtable()[slot][1] is square.get_method('area()I')
+    assert square.get_method('describe()I') is shape.get_method('describe()I')
+    assert square.itable() == {'Lcom/example/Named;': {'name()I': square.vtable_slots()['name()I']}}
+    assert [descriptor for descriptor, _ in smali.objects.String.vtable()][:2] == [
+        'charAt(I)C', 'toCharArray()[C']
+
+    # loading the superclass again links its subclasses again
+    cl.load_class(shape.parsed_class.filepath)
+    assert '_vtable' not in square.__dict__
+    assert new_object.invoke('run()I', {}) == 213
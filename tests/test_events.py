@@ -0,0 +1,123 @@
+import pytest
+
+import smali.classloader
+import smali.emulator
+import smali.events
+import smali.source
+
+COUNT_DOWN = [
+    '.locals 1',
+    'move v0, p0',
+    ':goto_0',
+    'add-int/lit8 v0, v0, -0x1',
+    'if-nez v0, :goto_0',
+    ':try_start_0',
+    'div-int v0, p0, v0',
+    ':try_end_0',
+    '.catch Ljava/lang/ArithmeticException; {:try_start_0 .. :try_end_0} :catch_0',
+    'return v0',
+    ':catch_0',
+    'const/4 v0, -0x1',
+    'return v0',
+]
+
+CALLS = """
+.class public Lcom/example/Calls;
+.super Ljava/lang/Object;
+
+.method public static twice(I)I
+    .locals 1
+
+    mul-int/lit8 v0, p0, 0x2
+
+    return v0
+.end method
+
+.method public static quad(I)I
+    .locals 1
+
+    invoke-static {p0}, Lcom/example/Calls;->twice(I)I
+
+    move-result v0
+
+    invoke-static {v0}, Lcom/example/Calls;->twice(I)I
+
+    move-result v0
+
+    return v0
+.end method
+"""
+
+
+def record(emulator, *kinds):
+    events = []
+    for kind in kinds:
+        emulator.subscribe(kind, events.append)
+    return events
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_events_of_a_run(backend):
+    emulator = smali.emulator.Emulator(backend=backend)
+    source = smali.source.Source(lines=COUNT_DOWN)
+    events = record(emulator, *smali.events.EVENTS)
+    assert emulator.run(source, {'p0': 3}) == -1
+    kinds = [event.kind for event in events]
+    assert kinds[0] == smali.events.CALL and kinds[-1] == smali.events.RETURN
+    assert events[-1].value == -1
+    assert kinds.count(smali.events.STEP) == emulator.stats.steps == 10
+    branches = [event for event in events if event.kind == smali.events.BRANCH]
+    assert [(event.pc, event.target) for event in branches] == [(2, 1), (2, 1)]
+    exception, = [event for event in events if event.kind == smali.events.EXCEPTION]
+    assert isinstance(exception.exception, ZeroDivisionError)
+    assert (exception.pc, exception.target, exception.line) == (3, 5, 7)
+    assert [event.opcode for event in events[1:4]] == ['move', 'add-int/lit8', 'if-nez']
+
+
+def test_registers_are_copied_on_demand():
+    emulator = smali.emulator.Emulator()
+    snapshots = []
+    emulator.subscribe(smali.events.STEP, lambda event: snapshots.append(event.registers()))
+    emulator.run(smali.source.Source(lines=COUNT_DOWN), {'p0': 2})
+    assert snapshots[0] == {'v0': None, 'p0': 2}
+    assert snapshots[2] == {'v0': 1, 'p0': 2}
+
+
+def test_calls_and_returns_of_invoked_methods(tmp_path):
+    java_path = tmp_path / 'Calls.smali'
+    java_path.write_text(CALLS)
+    cl = smali.classloader.ClassLoader()
+    loaded_class = cl.load_class(str(java_path))
+    emulator = smali.emulator.Emulator(class_loader=cl)
+    new_object = loaded_class(emulator=emulator)
+    events = record(emulator, smali.events.CALL, smali.events.RETURN)
+    assert new_object.invoke('quad(I)I', {'p0': 3}) == 12
+    methods = [(event.kind, event.method.split('->')[1], event.value) for event in events]
+    assert methods == [
+        ('call', 'quad(I)I', None),
+        ('call', 'twice(I)I', None), ('return', 'twice(I)I', 6),
+        ('call', 'twice(I)I', None), ('return', 'twice(I)I', 12),
+        ('return', 'quad(I)I', 12),
+    ]
+
+
+def test_unsubscribed_runs_do_not_fire():
+    emulator = smali.emulator.Emulator()
+    events = []
+    emulator.subscribe(smali.events.STEP, events.append)
+    emulator.unsubscribe(smali.events.STEP, events.append)
+    assert not emulator.hooks.active
+    emulator.run(smali.source.Source(lines=COUNT_DOWN), {'p0': 3})
+    assert events == []
+    with pytest.raises(smali.events.UnknownEvent):
+        emulator.subscribe('jump', events.append)
+
+
+def test_traced_runs_print_each_instruction(capsys):
+    emulator = smali.emulator.Emulator()
+    emulator.run(smali.source.Source(lines=COUNT_DOWN[:5] + ['return v0']), {'p0': 1}, trace=True)
+    assert capsys.readouterr().out.splitlines() == [
+        '002 move v0, p0', '004 add-int/lit8 v0, v0, -0x1', '005 if-nez v0, :goto_0',
+        '006 return v0',
+    ]
+    assert not emulator.hooks.active
@@ -0,0 +1,22 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def modules():
+    for directory, _, filenames in os.walk(os.path.join(ROOT, 'smali')):
+        package = os.path.relpath(directory, ROOT).replace(os.sep, '.')
+        for filename in sorted(filenames):
+            if filename.endswith('.py'):
+                name = filename[:-3]
+                yield package if name == '__init__' else '{}.{}'.format(package, name)
+
+
+@pytest.mark.parametrize('module', sorted(modules()))
+def test_modules_import_on_their_own(module):
+    # in a new interpreter, so that no other module is imported first
+    subprocess.check_call([sys.executable, '-c', 'import ' + module], cwd=ROOT)
@@ -2,6 +2,7 @@
 import os
 import pytest
 import smali.javaclass
+import smali.objects
 
 
 
@@ -38,3 +39,22 @@ def test_meta_javaclass(filepath):
         )
     )
 
+
+def test_methods_are_indexed_by_descriptor_and_name():
+    filepath = os.path.join(os.path.dirname(__file__), 'completeclass', 'data_for_metaclass_loader.smali')
+    java_class = smali.javaclass.MetaJavaClass(filepath)
+    methods = java_class.methods()
+    assert methods is java_class.methods()  # not rebuilt by each call
+    assert all(method.base_class is java_class for method in methods)
+    for method in methods:
+        assert java_class.get_method(method.compact_representation()) is method
+        assert method in java_class.overloads(method.method_name)
+    with pytest.raises(IndexError):
+        java_class.get_method('missing()V')
+    assert len(java_class.overloads('a')) == 2
+
+    string = smali.objects.String
+    assert string.get_method('charAt(I)C') == string.charat
+    assert string.overloads('<init>') == [string.init_from_char_array, string.init_from_byte_array_and_code]
+    with pytest.raises(smali.objects.baseclass.MethodResolutionFailure):
+        string('abc').invoke('missing()V', [])
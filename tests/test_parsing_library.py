@@ -21,6 +21,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
 # stdlib
+import glob
 import os
 import os.path
 
@@ -33,6 +34,8 @@ from smali.parser import (
     extract_attribute_names,
     extract_method_names_and_signature,
     extract_methods,
+    get_classname_from_source,
+    scan_class,
 )
 
 @pytest.fixture
@@ -67,3 +70,19 @@ def test_read_method_list_and_method_extraction(filename):
     method_list = extract_method_names_and_signature(source_code)
     method_with_code = extract_methods(source_code)
     assert set(method_with_code.keys()) == set(method_list)
+
+
+@pytest.mark.parametrize('path', sorted(
+    glob.glob(os.path.join(os.path.dirname(__file__), '*', '*.smali'))
+))
+def test_single_pass_scan_finds_the_declarations(path):
+    source_code = get_source_from_file(path)
+    outline = scan_class(source_code)
+    assert outline.class_name == get_classname_from_source(source_code)
+    assert outline.fields == extract_attribute_names(source_code)
+    methods = extract_methods(source_code)
+    assert list(outline.methods) == list(methods)
+    for signature, (start, end) in outline.method_lines.items():
+        assert outline.methods[signature].lines == methods[signature].lines
+        assert source_code.lines[start].startswith('.method')
+        assert source_code.lines[end] == '.end method'
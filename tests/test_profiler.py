@@ -0,0 +1,128 @@
+import json
+
+import pytest
+
+import smali.classloader
+import smali.compiler
+import smali.emulator
+import smali.profiler
+import smali.source
+
+from tests.test_events import CALLS, COUNT_DOWN
+
+
+def test_profiles_count_opcodes_methods_and_lines_of_nested_calls(tmp_path):
+    java_path = tmp_path / 'Calls.smali'
+    java_path.write_text(CALLS)
+    cl = smali.classloader.ClassLoader()
+    loaded_class = cl.load_class(str(java_path))
+    emulator = smali.emulator.Emulator(class_loader=cl, profile=True)
+    new_object = loaded_class(emulator=emulator)
+    for _ in range(3):  # accumulated over the runs
+        assert new_object.invoke('quad(I)I', {'p0': 3}) == 12
+    profiler = emulator.profiler
+    assert profiler.opcodes['invoke-static'][0] == 6
+    assert profiler.opcodes['mul-int/lit8'][0] == 6
+    quad, twice = 'Lcom/example/Calls;->quad(I)I', 'Lcom/example/Calls;->twice(I)I'
+    assert profiler.methods[quad][:2] == [3, 15]
+    assert profiler.methods[twice][:2] == [6, 12]
+    # the time of a method includes its callees
+    assert profiler.methods[quad][2] >= profiler.methods[twice][2]
+    assert profiler.lines[(twice, 0)][0::2] == [6, 'mul-int/lit8 v0, p0, 0x2']
+    assert emulator.stats.profiler is profiler
+
+
+def test_profiles_are_exported_as_tables_and_json():
+    emulator = smali.emulator.Emulator(profile=True)
+    emulator.run(smali.source.Source(lines=COUNT_DOWN), {'p0': 3})
+    profiler = emulator.profiler
+    table = profiler.table(sort='count').splitlines()
+    assert table[0].split() == ['count', 'time', '(ms)', 'opcode']
+    assert table[1].split()[0::2] == ['3', 'add-int/lit8']
+    assert profiler.table('methods').splitlines()[1].split()[0::3] == ['1', '<source>']
+    assert profiler.table('lines', limit=2).count('\n') == 2
+    exported = json.loads(profiler.to_json())
+    assert exported['opcodes']['if-nez']['count'] == 3
+    assert exported['methods']['<source>']['steps'] == 10
+    assert [line['pc'] for line in exported['lines']] == [0, 1, 2, 3, 5, 6]
+    profiler.reset()
+    assert profiler.opcodes == profiler.methods == profiler.lines == {}
+
+
+def test_profiler_detaches():
+    emulator = smali.emulator.Emulator()
+    profiler = smali.profiler.Profiler().attach(emulator)
+    profiler.detach(emulator)
+    assert not emulator.hooks.active
+
+
+DEEP = """
+.class public Lcom/example/Loops;
+.super Ljava/lang/Object;
+
+.method public static spin(I)I
+    .locals 1
+
+    const/4 v0, 0x0
+
+    :goto_0
+    if-ge v0, p0, :cond_0
+
+    add-int/lit8 v0, v0, 0x1
+
+    goto :goto_0
+
+    :cond_0
+    return v0
+.end method
+
+.method public static outer(I)I
+    .locals 1
+
+    invoke-static {p0}, Lcom/example/Loops;->spin(I)I
+
+    move-result v0
+
+    return v0
+.end method
+"""
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_sampled_stacks_are_written_collapsed(backend, tmp_path):
+    java_path = tmp_path / 'Loops.smali'
+    java_path.write_text(DEEP)
+    cl = smali.classloader.ClassLoader(backend=backend)
+    loaded_class = cl.load_class(str(java_path))
+    emulator = smali.emulator.Emulator(class_loader=cl)
+    sampler = smali.profiler.SamplingProfiler(steps=100).attach(emulator)
+    new_object = loaded_class(emulator=emulator)
+    assert new_object.invoke('outer(I)I', {'p0': 3000}) == 3000
+    stack = ('Lcom/example/Loops->outer(I)I', 'Lcom/example/Loops->spin(I)I')
+    assert list(sampler.stacks) == [stack]
+    # compiled methods report their instructions by batches
+    steps = emulator.stats.steps
+    assert steps - 2 * smali.compiler.CHARGE_TICKS <= sampler.stacks[stack] <= steps
+    output = tmp_path / 'stacks.txt'
+    sampler.write(str(output))
+    frames, weight = output.read_text().split(' ')
+    assert frames.split(';') == list(stack) and int(weight) == sampler.stacks[stack]
+    sampler.detach(emulator)
+    assert emulator.sampler is None
+
+
+def test_samples_are_taken_on_time_with_lines(tmp_path):
+    java_path = tmp_path / 'Loops.smali'
+    java_path.write_text(DEEP)
+    cl = smali.classloader.ClassLoader(backend=smali.emulator.INTERPRETER)
+    loaded_class = cl.load_class(str(java_path))
+    emulator = smali.emulator.Emulator(class_loader=cl)
+    sampler = smali.profiler.SamplingProfiler(interval=0.0001, lines=True).attach(emulator)
+    new_object = loaded_class(emulator=emulator)
+    new_object.invoke('outer(I)I', {'p0': 20000})
+    assert sampler.stacks
+    # the invoke line of outer, and the loop lines of spin
+    assert len({stack[0] for stack in sampler.stacks}) == 1
+    assert all(stack[1].startswith('Lcom/example/Loops->spin(I)I:') for stack in sampler.stacks)
+    with pytest.raises(ValueError):
+        smali.profiler.SamplingProfiler()
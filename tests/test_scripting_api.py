@@ -1,13 +1,19 @@
 from __future__ import unicode_literals
 
 import os.path
+import sys
 
 import pytest
 
 import smali
 import smali.source
 import smali.emulator
+import smali.vm
 import smali.classloader
+import smali.compiler
+import smali.javaclass
+import smali.objects
+import smali.opcodes
 
 def get_file_path(datadir, filename):
     return os.path.join(
@@ -162,9 +168,10 @@ def test_exception_messages_0x0002_b(input_args, expected):
 
     ]
 )
-def test_static_decoding(filename, input_args, expected):
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_static_decoding(filename, input_args, expected, backend):
     java_path = get_file_path('completeclass', filename)
-    cl = smali.classloader.ClassLoader()
+    cl = smali.classloader.ClassLoader(backend=backend)
     loaded_class = cl.load_class(java_path)
     new_object = loaded_class(emulator=smali.emulator.Emulator(class_loader=cl))
     new_object.invoke('<clinit>()V', {})
@@ -201,3 +208,427 @@ def test_cur_class(filename, input_args, expected):
     new_object.invoke('<clinit>()V', {})
     res = new_object.invoke('a(III)Ljava/lang/String;', input_args)
     assert res == expected
+
+
+@pytest.mark.parametrize(
+    'input_args,expected', [
+        ({'p0': 3, 'p1': 4}, 10),
+        ({'p0': 5, 'p1': -1}, 9),
+    ]
+)
+def test_invoke_static_method_of_loaded_class(input_args, expected):
+    java_path = get_file_path('completeclass', 'static_calls.smali')
+    cl = smali.classloader.ClassLoader()
+    loaded_class = cl.load_class(java_path)
+    new_object = loaded_class(emulator=smali.emulator.Emulator(class_loader=cl))
+    assert new_object.invoke('run(II)I', input_args) == expected
+    # the callee is decoded once and kept on the method object
+    decoded = loaded_class.get_method('twice(I)I').decoded
+    assert decoded is not None
+    new_object.invoke('run(II)I', input_args)
+    assert loaded_class.get_method('twice(I)I').decoded is decoded
+
+
+def test_invoke_static_runs_in_a_frame_of_the_caller_vm():
+    java_path = get_file_path('completeclass', 'static_calls.smali')
+    cl = smali.classloader.ClassLoader()
+    loaded_class = cl.load_class(java_path)
+    emulator = smali.emulator.Emulator(class_loader=cl)
+    new_object = loaded_class(emulator=emulator)
+    assert new_object.invoke('run(II)I', {'p0': 3, 'p1': 4}) == 10
+    vm = emulator.vm
+    assert vm.frames == [] and vm.code is None and vm.registers == []
+    # the steps of the callee are counted with the ones of the caller
+    assert emulator.stats.steps == 4 + 2
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_call_sites_cache_their_method_until_classes_change(backend, monkeypatch):
+    resolved = []
+    resolve_static = smali.opcodes.op_Invoke.resolve_static
+
+    def counting(vm, klass, method):
+        resolved.append(method)
+        return resolve_static(vm, klass, method)
+    monkeypatch.setattr(smali.opcodes.op_Invoke, 'resolve_static', staticmethod(counting))
+    java_path = get_file_path('completeclass', 'static_calls.smali')
+    cl = smali.classloader.ClassLoader(backend=backend)
+    loaded_class = cl.load_class(java_path)
+    new_object = loaded_class(emulator=smali.emulator.Emulator(class_loader=cl))
+    for _ in range(3):
+        assert new_object.invoke('run(II)I', {'p0': 3, 'p1': 4}) == 10
+    assert resolved == ['twice(I)I']
+    site = loaded_class.get_method('run(II)I').decoded.instructions[0].args[2]
+    assert site.target is loaded_class.get_method('twice(I)I').decoded
+
+    # loading a class again invalidates the call sites
+    reloaded_class = cl.load_class(java_path)
+    assert new_object.invoke('run(II)I', {'p0': 3, 'p1': 4}) == 10
+    assert resolved == ['twice(I)I'] * 2
+    assert site.target is reloaded_class.get_method('twice(I)I').decoded
+
+    site = smali.opcodes.CallSite('Ljava/lang/String;->length()I')
+    vm = new_object.emulator.vm
+    assert site.virtual(vm, 'virtual', smali.objects.String('abc')) == smali.objects.String.length
+    assert site.receivers == {smali.objects.String: smali.objects.String.length}
+
+
+DEEP_CALLS = """
+.class public Lcom/example/Deep;
+.super Ljava/lang/Object;
+
+.method public static count(I)I
+    .locals 1
+
+    if-eqz p0, :cond_0
+
+    add-int/lit8 v0, p0, -0x1
+
+    invoke-static {v0}, Lcom/example/Deep;->count(I)I
+
+    move-result v0
+
+    add-int/lit8 v0, v0, 0x1
+
+    return v0
+
+    :cond_0
+    const/4 v0, 0x0
+
+    return v0
+.end method
+"""
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_deep_calls_do_not_recurse(backend, tmp_path):
+    java_path = tmp_path / 'Deep.smali'
+    java_path.write_text(DEEP_CALLS)
+    cl = smali.classloader.ClassLoader(backend=backend)
+    loaded_class = cl.load_class(str(java_path))
+    emulator = smali.emulator.Emulator(class_loader=cl)
+    new_object = loaded_class(emulator=emulator)
+    depth = sys.getrecursionlimit() * 2
+    assert new_object.invoke('count(I)I', {'p0': depth}) == depth
+    assert emulator.vm.frames == []
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_calls_deeper_than_max_depth_overflow(backend, tmp_path):
+    java_path = tmp_path / 'Deep.smali'
+    java_path.write_text(DEEP_CALLS)
+    cl = smali.classloader.ClassLoader(backend=backend)
+    loaded_class = cl.load_class(str(java_path))
+    emulator = smali.emulator.Emulator(class_loader=cl, max_depth=50)
+    new_object = loaded_class(emulator=emulator)
+    assert new_object.invoke('count(I)I', {'p0': 40}) == 40
+    with pytest.raises(smali.emulator.StackOverflow):
+        new_object.invoke('count(I)I', {'p0': 60})
+    assert emulator.vm.frames == []
+    assert new_object.invoke('count(I)I', {'p0': 40}) == 40
+
+
+DEEP_VIRTUAL_CALLS = """
+.class public Lcom/example/Counter;
+.super Ljava/lang/Object;
+
+.method public constructor <init>()V
+    .locals 0
+
+    invoke-direct {p0}, Ljava/lang/Object;-><init>()V
+
+    return-void
+.end method
+
+.method public count(I)I
+    .locals 1
+
+    if-eqz p1, :done
+
+    add-int/lit8 v0, p1, -0x1
+
+    invoke-virtual {p0, v0}, Lcom/example/Counter;->count(I)I
+
+    move-result v0
+
+    add-int/lit8 v0, v0, 0x1
+
+    return v0
+
+    :done
+    return p1
+.end method
+
+.method public static run(I)I
+    .locals 1
+
+    new-instance v0, Lcom/example/Counter;
+
+    invoke-direct {v0}, Lcom/example/Counter;-><init>()V
+
+    invoke-virtual {v0, p0}, Lcom/example/Counter;->count(I)I
+
+    move-result p0
+
+    return p0
+.end method
+"""
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_deep_instance_calls_do_not_recurse(backend, tmp_path):
+    java_path = tmp_path / 'Counter.smali'
+    java_path.write_text(DEEP_VIRTUAL_CALLS)
+    cl = smali.classloader.ClassLoader(backend=backend)
+    loaded_class = cl.load_class(str(java_path))
+    emulator = smali.emulator.Emulator(class_loader=cl, max_depth=sys.getrecursionlimit() * 4)
+    new_object = loaded_class(emulator=emulator)
+    depth = sys.getrecursionlimit() * 2
+    assert new_object.invoke('run(I)I', {'p0': depth}) == depth
+    assert emulator.vm.frames == []
+
+    emulator.max_depth = 50
+    with pytest.raises(smali.emulator.StackOverflow):
+        new_object.invoke('run(I)I', {'p0': 60})
+
+
+SPINNING = """
+.class public Lcom/example/Spin;
+.super Ljava/lang/Object;
+
+.method public static spin(I)I
+    .locals 1
+
+    :try_start_0
+    :goto_0
+    add-int/lit8 p0, p0, 0x1
+
+    goto :goto_0
+    :try_end_0
+    .catch Ljava/lang/Exception; {:try_start_0 .. :try_end_0} :catch_0
+
+    :catch_0
+    const/4 v0, 0x0
+
+    return v0
+.end method
+
+.method public static twice(I)I
+    .locals 1
+
+    mul-int/lit8 v0, p0, 0x2
+
+    return v0
+.end method
+"""
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_runs_stop_when_over_the_instruction_budget(backend, tmp_path):
+    java_path = tmp_path / 'Spin.smali'
+    java_path.write_text(SPINNING)
+    parsed_class = smali.javaclass.JavaClassParser(str(java_path))
+    emulator = smali.emulator.Emulator(backend=backend)
+    with pytest.raises(smali.emulator.BudgetExceeded) as info:
+        parsed_class.invoke('spin', {'p0': 0}, emulator=emulator, max_steps=20000)
+    # compiled methods charge their instructions by batches
+    assert 20000 < info.value.stats.steps <= 20000 + 2 * smali.compiler.CHARGE_TICKS
+    assert info.value.stats is emulator.stats
+    # the emulator is ready for the next run
+    assert emulator.vm.frames == []
+    assert parsed_class.invoke('twice', {'p0': 21}, emulator=emulator) == 42
+
+
+def test_runs_stop_at_their_deadline(tmp_path):
+    java_path = tmp_path / 'Spin.smali'
+    java_path.write_text(SPINNING)
+    parsed_class = smali.javaclass.JavaClassParser(str(java_path))
+    emulator = smali.emulator.Emulator()
+    with pytest.raises(smali.emulator.BudgetExceeded, match='Deadline'):
+        parsed_class.invoke('spin', {'p0': 0}, emulator=emulator, timeout=0.05)
+    assert emulator.stats.steps > 0
+    assert emulator.stats.execution >= 50
+
+
+def test_tiered_promotes_invoked_methods():
+    java_path = get_file_path('completeclass', 'static_calls.smali')
+    cl = smali.classloader.ClassLoader(backend=smali.emulator.TIERED)
+    loaded_class = cl.load_class(java_path)
+    emulator = smali.emulator.Emulator(
+        class_loader=cl,
+        promotions=((smali.emulator.THREADED, 2, 1000),
+                    (smali.emulator.COMPILED, 3, 1000)),
+    )
+    new_object = loaded_class(emulator=emulator)
+    run = loaded_class.get_method('run(II)I')
+    tiers = []
+    for _ in range(3):
+        assert new_object.invoke('run(II)I', {'p0': 3, 'p1': 4}) == 10
+        tiers.append(run.decoded.tier)
+    assert tiers == ['interpreter', 'threaded', 'compiled']
+    assert run.decoded.invocations == 3
+    # promotions of the callees are reported with the caller ones
+    assert emulator.stats.promotions == [
+        ('Lcom/example/Calls;->run(II)I', 'compiled'),
+        ('Lcom/example/Calls;->twice(I)I', 'compiled'),
+    ]
+
+
+def test_tiered_promotes_hot_loops_during_a_run():
+    source = smali.source.Source(lines=[
+        'const/4 v0, 0',
+        ':loop',
+        'if-ge v0, p0, :end',
+        'add-int/lit8 v0, v0, 1',
+        'goto :loop',
+        ':end',
+        'return v0',
+    ])
+    emulator = smali.emulator.Emulator(
+        backend=smali.emulator.TIERED,
+        promotions=((smali.emulator.THREADED, 10, 3),
+                    (smali.emulator.COMPILED, 10, 6)),
+    )
+    assert emulator.run(source, {'p0': 20}) == 20
+    assert emulator.stats.promotions == [
+        (None, smali.emulator.THREADED), (None, smali.emulator.COMPILED)
+    ]
+
+
+def test_registers_layout_follows_locals_directive():
+    java_path = get_file_path('completeclass', 'static_calls.smali')
+    cl = smali.classloader.ClassLoader()
+    loaded_class = cl.load_class(java_path)
+    new_object = loaded_class(emulator=smali.emulator.Emulator(class_loader=cl))
+    new_object.invoke('run(II)I', {'p0': 3, 'p1': 4})
+    layout = loaded_class.get_method('run(II)I').decoded.layout
+    # .locals 2: the parameters take the slots following the locals
+    assert layout.slots == {'v0': 0, 'v1': 1, 'p0': 2, 'p1': 3}
+    assert layout.size == 4
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_parameter_registers_alias_the_top_registers(backend):
+    source = smali.source.Source(lines=[
+        '.registers 2',
+        'add-int/lit8 v0, v1, 1',
+        'return v0',
+    ])
+    emulator = smali.emulator.Emulator(backend=backend)
+    # p0 is the last of the two registers, v1
+    assert emulator.run(source, {'p0': 41}) == 42
+
+
+def test_jump_targets_are_resolved_when_decoding():
+    source = smali.source.Source(lines=[
+        'packed-switch p0, :pswitch_data_0',
+        ':try_start_0',
+        'aget v0, p1, p0',
+        ':try_end_0',
+        '.catch Ljava/lang/Exception; {:try_start_0 .. :try_end_0} :catch_0',
+        'return v0',
+        ':catch_0',
+        'const/4 v0, -0x1',
+        'return v0',
+        ':pswitch_0',
+        'const/4 v0, 0x7',
+        'return v0',
+        ':pswitch_data_0',
+        '.packed-switch 0x3',
+        ':pswitch_0',
+        '.end packed-switch',
+    ])
+    emulator = smali.emulator.Emulator()
+    code = emulator.decode(source, {'p0': 0, 'p1': []})
+    assert code.catch_blocks.blocks == ((1, 2, 'Ljava/lang/Exception;', 3),)
+    assert code.instructions[0].args[1] == (3, (5,))
+    vm = smali.vm.VM(emulator)
+    for _ in range(2):  # the same vm does not pile up catch blocks
+        assert emulator.run(source, {'p0': 3, 'p1': []}, vm=vm) == 7
+        assert emulator.run(source, {'p0': 5, 'p1': []}, vm=vm) == -1
+    assert vm.catch_blocks == () and vm.frames == []
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_exceptions_go_to_the_innermost_handler_of_their_type(backend):
+    source = smali.source.Source(lines=[
+        '.locals 1',
+        ':try_start_0',
+        ':try_start_1',
+        'div-int v0, p0, p1',
+        'aget v0, p2, v0',
+        ':try_end_1',
+        '.catch Ljava/lang/ArithmeticException; {:try_start_1 .. :try_end_1} :catch_0',
+        'return v0',
+        ':try_end_0',
+        '.catchall {:try_start_0 .. :try_end_0} :catchall_0',
+        ':catch_0',
+        'const/4 v0, -0x1',
+        'return v0',
+        ':catchall_0',
+        'const/4 v0, -0x2',
+        'return v0',
+    ])
+    emulator = smali.emulator.Emulator(backend=backend)
+    code = emulator.decode(source, {'p0': 0, 'p1': 0, 'p2': []})
+    assert code.catch_blocks.blocks == (
+        (0, 2, 'Ljava/lang/ArithmeticException;', 3), (0, 3, None, 5),
+    )
+    for _ in range(20):  # up to the last tier
+        assert emulator.run(source, {'p0': 4, 'p1': 2, 'p2': [5, 6, 7]}) == 7
+        assert emulator.run(source, {'p0': 4, 'p1': 0, 'p2': [5, 6, 7]}) == -1
+        assert emulator.run(source, {'p0': 20, 'p1': 2, 'p2': [5, 6, 7]}) == -2
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_exceptions_skip_handlers_of_other_types(backend):
+    source = smali.source.Source(lines=[
+        '.locals 1',
+        ':try_start_0',
+        ':try_start_1',
+        'div-int v0, p0, p1',
+        ':try_end_1',
+        '.catch Ljava/io/IOException; {:try_start_1 .. :try_end_1} :catch_1',
+        'return v0',
+        ':try_end_0',
+        '.catch Ljava/lang/ArithmeticException; {:try_start_0 .. :try_end_0} :catch_0',
+        ':catch_1',
+        'const/4 v0, 0x1',
+        'return v0',
+        ':catch_0',
+        'const/4 v0, 0x2',
+        'return v0',
+    ])
+    emulator = smali.emulator.Emulator(backend=backend)
+    for _ in range(20):  # up to the last tier
+        assert emulator.run(source, {'p0': 4, 'p1': 2}) == 2
+        assert emulator.run(source, {'p0': 4, 'p1': 0}) == 2
+
+
+def test_only_executable_lines_are_decoded():
+    source = smali.source.Source(lines=[
+        '.locals 1',
+        '.annotation system Ldalvik/annotation/Throws;',
+        'value = {',
+        'Ljava/lang/Exception;',
+        '}',
+        '.end annotation',
+        '.line 12',
+        '# a comment',
+        'const/4 v0, 0x2',
+        ':goto_0',
+        '.local v0, "count":I',
+        'add-int/lit8 v0, v0, -0x1',
+        'if-nez v0, :goto_0',
+        'return v0',
+    ])
+    emulator = smali.emulator.Emulator()
+    code = emulator.decode(source)
+    assert [instruction.text for instruction in code.instructions] == [
+        'const/4 v0, 0x2', 'add-int/lit8 v0, v0, -0x1', 'if-nez v0, :goto_0', 'return v0'
+    ]
+    assert code.labels == {':goto_0': 1}
+    assert code.lines == [8, 11, 12, 13]
+    assert code.line_number(2) == 12
+    assert emulator.run(source) == 0
+    assert emulator.stats.steps == 6
@@ -43,13 +43,14 @@ def special_cmp(a, b):
         return False
 
 
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
 @pytest.mark.parametrize(
     'filename, expected_result, input_source',
     opcode_calls()
 )
-def test_all_files(filename, expected_result, input_source):
+def test_all_files(filename, expected_result, input_source, backend):
     assert filename.endswith('.smali')
-    cl = smali.classloader.ClassLoader()
+    cl = smali.classloader.ClassLoader(backend=backend)
     emulator = smali.emulator.Emulator(class_loader=cl)
     result = emulator.run_source(input_source)
     if expected_result.startswith('{') and expected_result.endswith('}'):
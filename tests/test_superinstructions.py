@@ -0,0 +1,101 @@
+import pytest
+
+import smali.emulator
+import smali.opcodes
+import smali.source
+import smali.superinstructions
+
+from smali.superinstructions import Superinstruction
+
+XOR_LOOP = [
+    '.locals 5',
+    'array-length v0, p0',
+    'new-array v1, v0, [C',
+    'const/4 v2, 0x0',
+    ':goto_0',
+    'if-ge v2, v0, :cond_0',
+    'aget v3, p0, v2',
+    'xor-int/lit8 v4, v3, 0x5a',
+    'int-to-char v4, v4',
+    'aput-char v4, v1, v2',
+    'add-int/lit8 v2, v2, 0x1',
+    'goto :goto_0',
+    ':cond_0',
+    'return-object v1',
+]
+
+
+def decode(lines, args=None):
+    emulator = smali.emulator.Emulator()
+    return emulator, emulator.decode(smali.source.Source(lines=lines), args)
+
+
+def test_sequences_are_fused():
+    emulator, code = decode(XOR_LOOP, {'p0': []})
+    fused = [instruction for instruction in code.fused
+             if isinstance(instruction, Superinstruction)]
+    assert [len(instruction.parts) for instruction in fused] == [4, 2]
+    # the decoded instructions are left untouched
+    assert not any(isinstance(instruction, Superinstruction)
+                   for instruction in code.instructions)
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_fused_loop_result(backend):
+    emulator = smali.emulator.Emulator(backend=backend)
+    data = [ord(c) ^ 0x5a for c in 'secret']
+    result = emulator.run(smali.source.Source(lines=XOR_LOOP), {'p0': data})
+    assert ''.join(result) == 'secret'
+
+
+def test_labels_are_not_fused_over():
+    emulator, code = decode([
+        'const/4 v0, 0x1',
+        ':label',
+        'const/4 v1, 0x2',
+        'aput v0, v2, v1',
+        'return-void',
+    ])
+    kinds = [type(instruction).__name__ for instruction in code.fused if instruction]
+    assert kinds == ['Instruction', 'Superinstruction', 'Instruction', 'Instruction']
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_exception_inside_fused_sequence_is_caught(backend):
+    source = smali.source.Source(lines=[
+        'const/4 v2, 0x5',
+        'const/4 v1, 0x0',
+        ':try_start_0',
+        'aget v1, p0, v2',
+        'int-to-char v1, v1',
+        ':try_end_0',
+        '.catch Ljava/lang/Exception; {:try_start_0 .. :try_end_0} :catch_0',
+        'return v1',
+        ':catch_0',
+        'move-exception v0',
+        'const/4 v1, 0x7',
+        'return v1',
+    ])
+    emulator = smali.emulator.Emulator(backend=backend)
+    assert emulator.run(source, {'p0': [1, 2]}) == 7
+
+
+def test_add_pattern():
+    table = list(smali.superinstructions.FUSION_TABLE)
+    try:
+        pattern = (smali.opcodes.op_Const, smali.opcodes.op_Const)
+        smali.superinstructions.add_pattern(pattern)
+        assert pattern in smali.superinstructions.FUSION_TABLE
+        emulator, code = decode(['const/4 v0, 0x1', 'const/4 v1, 0x2', 'return-void'])
+        assert isinstance(code.fused[0], Superinstruction)
+    finally:
+        smali.superinstructions.FUSION_TABLE[:] = table
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_fused_instructions_are_counted_as_steps(backend):
+    source = smali.source.Source(lines=XOR_LOOP)
+    emulator = smali.emulator.Emulator(backend=backend)
+    emulator.run(source, {'p0': [1, 2, 3]})
+    # 3 before the loop, 7 for each iteration, the exit test and the return
+    assert emulator.stats.steps == 3 + 3 * 7 + 2
@@ -0,0 +1,158 @@
+import pytest
+
+import smali.emulator
+import smali.source
+import smali.vectorizer
+
+from smali.vectorizer import LoopInstruction
+
+OPERATIONS = [smali.vectorizer.ListOperations()]
+if smali.vectorizer.numpy is not None:
+    OPERATIONS.append(smali.vectorizer.NumpyOperations())
+
+KEY_LOOP = [
+    '.locals 7',
+    'array-length v0, p0',
+    'new-array v1, v0, [I',
+    'array-length v5, p1',
+    'const/4 v2, 0x0',
+    ':goto_0',
+    'if-ge v2, v0, :cond_0',
+    'aget v3, p0, v2',
+    'rem-int v4, v2, v5',
+    'aget v4, p1, v4',
+    'xor-int/2addr v3, v4',
+    'and-int/lit16 v3, v3, 0xff',
+    'aput v3, v1, v2',
+    'add-int/lit8 v2, v2, 0x1',
+    'goto :goto_0',
+    ':cond_0',
+    'return-object v1',
+]
+
+SHIFT_LOOP = [
+    '.locals 5',
+    'array-length v0, p0',
+    'new-array v1, v0, [C',
+    'const/4 v2, 0x0',
+    ':goto_0',
+    'if-ge v2, v0, :cond_0',
+    'aget v3, p0, v2',
+    'add-int/lit8 v3, v3, 0x3',
+    'int-to-char v4, v3',
+    'aput-char v4, v1, v2',
+    'add-int/lit8 v2, v2, 0x1',
+    'goto :goto_0',
+    ':cond_0',
+    'return v4',
+]
+
+
+def decode(lines, args=None):
+    emulator = smali.emulator.Emulator()
+    return emulator.decode(smali.source.Source(lines=lines), args)
+
+
+def run(lines, args, backend, operations, monkeypatch):
+    monkeypatch.setattr(smali.vectorizer, 'OPERATIONS', operations)
+    emulator = smali.emulator.Emulator(backend=backend)
+    return emulator.run(smali.source.Source(lines=lines), args)
+
+
+def test_loops_are_recognized():
+    code = decode(KEY_LOOP, {'p0': [], 'p1': []})
+    assert list(code.vector_loops) == [4]
+    assert isinstance(code.fused[4], LoopInstruction)
+
+
+def test_loop_carried_values_are_not_recognized():
+    code = decode([
+        'const/4 v1, 0x0',
+        ':goto_0',
+        'if-ge v2, v0, :cond_0',
+        'aget v3, p0, v2',
+        'add-int v1, v1, v3',
+        'aput v1, p1, v2',
+        'add-int/lit8 v2, v2, 0x1',
+        'goto :goto_0',
+        ':cond_0',
+        'return v1',
+    ], {'p0': [], 'p1': []})
+    assert code.vector_loops == {}
+
+
+@pytest.mark.parametrize('operations', OPERATIONS)
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_key_loop(backend, operations, monkeypatch):
+    data = list(range(200, 300))
+    key = [0x13, 0x37, 0x42]
+    result = run(KEY_LOOP, {'p0': data, 'p1': key}, backend, operations, monkeypatch)
+    assert result == [(x ^ key[i % 3]) & 0xff for i, x in enumerate(data)]
+
+
+@pytest.mark.parametrize('operations', OPERATIONS)
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_char_loop_leaves_last_values_in_registers(backend, operations, monkeypatch):
+    data = [ord(c) - 3 for c in 'vectorized loops']
+    result = run(SHIFT_LOOP, {'p0': data}, backend, operations, monkeypatch)
+    assert result == 's'
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_declined_loop_runs_one_instruction_at_a_time(backend, monkeypatch):
+    # a value too large for the array operations
+    data = list(range(30)) + [2 ** 40]
+    result = run(KEY_LOOP, {'p0': data, 'p1': [1]}, backend, OPERATIONS[0], monkeypatch)
+    assert result == [(x ^ 1) & 0xff for x in data]
+
+
+def test_array_read_and_written_is_declined():
+    registers = [list(range(20)), 20, 0]
+    loop = smali.vectorizer.VectorLoop(
+        header=1, back_edge=3, exit=4, index=2, limit=1,
+        assignments={}, stores=[(('invariant', 0), ('load', ('invariant', 0), ('index',)))],
+    )
+
+    class VM(object):
+        pc = 2
+
+    vm = VM()
+    vm.registers = registers
+    assert loop.run(vm) is False
+    assert vm.pc == 2 and registers[2] == 0
+
+
+@pytest.mark.parametrize('operations', OPERATIONS)
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_overwritten_values_are_checked(backend, operations, monkeypatch):
+    lines = [
+        '.locals 4',
+        'array-length v1, p0',
+        'new-array v2, v1, [I',
+        'const/4 v0, 0x0',
+        ':try_start_0',
+        ':goto_0',
+        'if-ge v0, v1, :cond_0',
+        'aget v3, p1, v0',  # out of bounds once p1 is exhausted
+        'aget v3, p0, v0',
+        'aput v3, v2, v0',
+        'add-int/lit8 v0, v0, 0x1',
+        'goto :goto_0',
+        ':cond_0',
+        ':try_end_0',
+        '.catch Ljava/lang/ArrayIndexOutOfBoundsException; {:try_start_0 .. :try_end_0} :catch_0',
+        'return-object v2',
+        ':catch_0',
+        'const/4 v2, -0x1',
+        'return v2',
+    ]
+    args = {'p0': list(range(40)), 'p1': list(range(20))}
+    assert run(lines, args, backend, operations, monkeypatch) == -1
+
+
+@pytest.mark.parametrize('backend', smali.emulator.BACKENDS)
+def test_vectorized_iterations_are_counted_as_steps(backend):
+    emulator = smali.emulator.Emulator(backend=backend)
+    emulator.run(smali.source.Source(lines=KEY_LOOP), {'p0': list(range(40)), 'p1': [3, 4]})
+    # 4 before the loop, 9 for each iteration, the exit test and the return
+    assert emulator.stats.steps == 4 + 40 * 9 + 2
@@ -5,7 +5,7 @@ from __future__ import unicode_literals
 """Exec Smali Files.
 
 Usage:
-    exec.py -i File.smali -m methodName [-p methodParameters]
+    exec.py -i File.smali -m methodName [-p methodParameters] [--profile] [--flamegraph <file>]
 
 Options:
     -h --help        Show this screen.
@@ -14,10 +14,16 @@ Options:
     -p <parameters>  A list of parameters to give as arguments.
                      If not provided, the script will introspect the method
                      and give insights about what parameters are expected.
+    --profile        Print the opcodes, methods and instructions run, with
+                     their count and time.
+    --flamegraph <file>  Write the stacks of the emulated methods, sampled
+                     every 1000 instructions, to a file in the collapsed
+                     format of flamegraph tools.
 """
 
 from docopt import docopt
 import smali.emulator
+import smali.profiler
 import ast
 
 
@@ -25,9 +31,17 @@ def main(arguments):
     filename = arguments.get('-i')
     parameters = arguments.get('-p')
     parameters = ast.literal_eval(parameters) if parameters else {}
-    emu = smali.emulator.Emulator()
+    emu = smali.emulator.Emulator(profile=arguments.get('--profile'))
+    flamegraph = arguments.get('--flamegraph')
+    if flamegraph:
+        sampler = smali.profiler.SamplingProfiler(steps=1000).attach(emu)
     result = emu.run_file(filename, parameters)
     print(result)
+    if flamegraph:
+        sampler.write(flamegraph)
+    if emu.profiler is not None:
+        for kind in ('opcodes', 'methods', 'lines'):
+            print('\n' + emu.profiler.table(kind))
 
 
 if __name__ == '__main__':
@@ -28,11 +28,9 @@ def main(arguments):
 
 def inspect_exceptions(filename):
     """Inspect exceptions in the smali file."""
-    emu = smali.emulator.Emulator(
-        source=smali.source.get_source_from_file(filename)
-    )
-    emu.preproc_source()
-    print(emu.vm.catch_blocks)
+    emu = smali.emulator.Emulator()
+    code = emu.decode(smali.source.get_source_from_file(filename))
+    print(code.catch_blocks)
 
 
 def inspect_methods(filename):
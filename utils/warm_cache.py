@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""Parse and decode the smali files of a tree into a class cache.
+
+Usage:
+    warm_cache.py -c <directory> [-j <workers>] <tree>...
+
+Options:
+    -h --help        Show this screen.
+    -c <directory>   The cache directory, as given to ClassLoader(cache=...).
+    -j <workers>     The number of processes parsing the files [default: one per CPU].
+"""
+
+from docopt import docopt
+import smali.cache
+import smali.classloader
+
+
+def main(arguments):
+    """Main method."""
+    cache = smali.cache.ClassCache(arguments.get('-c'))
+    workers = arguments.get('-j')
+    workers = int(workers) if workers and workers.isdigit() else None
+    for tree in arguments.get('<tree>'):
+        cl = smali.classloader.ClassLoader(cache=cache)
+        count = len(cl.load_classes(smali.classloader.smali_files(tree), workers=workers))
+        print('{}: {} classes'.format(tree, count))
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))